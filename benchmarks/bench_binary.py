@@ -0,0 +1,33 @@
+"""Compare the JSON text frames with the binary frames of
+:mod:`socketio.binary`, for an event carrying numbers (like the samples
+of the ``live_cpu_graph`` example).
+
+Needs the ``msgpack`` package::
+
+  PYTHONPATH=. python benchmarks/bench_binary.py
+
+"""
+import random
+import timeit
+
+from socketio import binary, packet
+
+
+def main(number=20000):
+    codec = binary.get_codec('msgpack')
+    if codec is None:
+        print("msgpack is not installed")
+        return
+    samples = [random.random() * 100 for i in range(64)]
+    pkt = packet.Packet(type='event', name='cpu_data',
+                        args=[{'points': samples, 'ts': 1350000000}],
+                        endpoint='/cpu')
+    for label, encode in (('json', lambda: packet.encode(pkt)),
+                          ('msgpack', lambda: binary.encode(pkt, codec))):
+        seconds = timeit.timeit(encode, number=number)
+        print("%-8s %5d bytes %8.0f ns/op" % (label, len(encode()),
+                                             seconds / number * 1e9))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,38 @@
+"""Compare the JSON backends of :mod:`socketio.defaultjson` on a few
+typical payloads::
+
+  PYTHONPATH=. python benchmarks/bench_json.py
+
+"""
+import random
+import timeit
+
+from socketio import defaultjson
+
+PAYLOADS = {
+    'chat': {'name': 'msg_to_room',
+             'args': ['john', 'Hello everybody, how are you doing?']},
+    'samples': {'name': 'cpu_data',
+                'args': [{'points': [random.random() * 100
+                                     for i in range(64)],
+                          'ts': 1350000000}]},
+    'nested': {'name': 'state',
+               'args': [{u'us\xe9r%d' % i: {'rooms': ['/r%d' % j
+                                                     for j in range(5)],
+                                           'nick': u'中文',
+                                           'away': i % 2 == 0}
+                         for i in range(20)}]},
+}
+
+
+def main(number=20000):
+    for label, payload in sorted(PAYLOADS.items()):
+        print(label)
+        for name in defaultjson.available_backends():
+            dumps = defaultjson.get_backend(name).dumps
+            seconds = timeit.timeit(lambda: dumps(payload), number=number)
+            print("  %-10s %8.0f ns/op" % (name, seconds / number * 1e9))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+"""Micro-benchmark of the packet codec.
+
+Run it from the root of the repository, before and after touching
+``socketio/packet.py``::
+
+  PYTHONPATH=. python benchmarks/bench_packet.py
+
+"""
+import timeit
+
+from socketio import packet
+
+
+ENCODE = [
+    ('heartbeat', {'type': 'heartbeat'}),
+    ('message', {'type': 'message', 'data': 'hello', 'endpoint': '/chat'}),
+    ('event', {'type': 'event', 'name': 'update', 'args': [1, 'two'],
+               'endpoint': '/chat'}),
+    ('event+ack', {'type': 'event', 'name': 'update', 'args': [1],
+                   'endpoint': '/chat', 'id': 42, 'ack': 'data'}),
+    ('ack', {'type': 'ack', 'ackId': 42, 'args': ['ok'],
+             'endpoint': '/chat'}),
+]
+
+DECODE = [
+    ('heartbeat', '2::'),
+    ('noop', '8::'),
+    ('message', '3::/chat:hello'),
+    ('event', '5::/chat:{"name":"update","args":[1,"two"]}'),
+    ('event+ack', '5:42+:/chat:{"name":"update","args":[1]}'),
+]
+
+
+def bench(label, func, arg, number):
+    seconds = timeit.timeit(lambda: func(arg), number=number)
+    print("%-8s %-10s %8.0f ns/op" % (func.__name__, label,
+                                     seconds / number * 1e9))
+
+
+def main(number=100000):
+    for label, pkt in ENCODE:
+        bench(label, packet.encode, pkt, number)
+    for label, raw in DECODE:
+        bench(label, packet.decode, raw, number)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+"""Benchmark of the decoding of batched polling payloads, from 1 to 10k
+frames, against the previous slicing parser::
+
+  PYTHONPATH=. python benchmarks/bench_payload.py
+
+"""
+import timeit
+
+from socketio.transports import XHRPollingTransport
+
+
+def decode_payload_slicing(payload):
+    """The previous implementation, that copies the rest of the payload
+    after each frame."""
+    payload = payload.decode('utf-8')
+    if payload[0] == u"\ufffd":
+        ret = []
+        while len(payload) != 0:
+            len_end = payload.find(u"\ufffd", 1)
+            length = int(payload[1:len_end])
+            msg_start = len_end + 1
+            msg_end = length + msg_start
+            message = payload[msg_start:msg_end]
+            ret.append(message)
+            payload = payload[msg_end:]
+        return ret
+    return [payload]
+
+
+def main():
+    decode_payload = XHRPollingTransport(None, {}).decode_payload
+    message = u'5:::{"name":"move","args":[{"x":12,"y":34}]}'
+    frame = u'\ufffd%d\ufffd%s' % (len(message), message)
+    for count in (1, 10, 100, 1000, 10000):
+        payload = (frame * count).encode('utf-8')
+        number = max(1, 10000 // count)
+        assert decode_payload(payload) == decode_payload_slicing(payload)
+        results = []
+        for func in (decode_payload_slicing, decode_payload):
+            seconds = timeit.timeit(lambda: func(payload), number=number)
+            results.append(seconds / number * 1e6)
+        print("%5d frames: slicing %10.1f us, indexed %10.1f us" %
+              (count, results[0], results[1]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""Compare the routing of a polling request by :class:`SocketIOHandler`,
+before (three regular expressions, and a ``parse_qs`` per write) and
+after (:class:`socketio.handler.Router`, query string parsed once)::
+
+  PYTHONPATH=. python benchmarks/bench_router.py
+
+"""
+import re
+import timeit
+
+from six.moves.urllib.parse import parse_qs
+
+from socketio.handler import Router
+
+RE_REQUEST_URL = re.compile(r"""
+    ^/(?P<resource>.+?)
+     /1
+     /(?P<transport_id>[^/]+)
+     /(?P<sessid>[^/]+)/?$
+     """, re.X)
+RE_HANDSHAKE_URL = re.compile(r"^/(?P<resource>.+?)/1/$", re.X)
+RE_DISCONNECT_URL = re.compile(r"""
+    ^/(?P<resource>.+?)
+     /(?P<protocol_version>[^/]+)
+     //(?P<sessid>[^/]+)/?$
+     """, re.X)
+
+PATH = '/socket.io/1/jsonp-polling/1234567890123'
+QUERY_STRING = 't=1350000000000&i=1'
+
+
+def before(path=PATH, query_string=QUERY_STRING, resource='socket.io'):
+    if not path.lstrip('/').startswith(resource + '/'):
+        return
+    request_tokens = RE_REQUEST_URL.match(path)
+    handshake_tokens = RE_HANDSHAKE_URL.match(path)
+    disconnect_tokens = RE_DISCONNECT_URL.match(path)
+    if handshake_tokens:
+        return
+    elif disconnect_tokens:
+        tokens = disconnect_tokens.groupdict()
+    else:
+        tokens = request_tokens.groupdict()
+    query_string.startswith('disconnect')
+    # JSONPolling.write, then write_smart
+    parse_qs(query_string)
+    parse_qs(query_string)
+    return tokens['sessid'], tokens['transport_id']
+
+
+def after(path=PATH, query_string=QUERY_STRING,
+          router=Router('socket.io')):
+    request = router.match(path, query_string)
+    request.query_string.startswith('disconnect')
+    request.query
+    request.query
+    return request.sessid, request.transport_id
+
+
+def main(number=100000):
+    assert before() == after()
+    for label, route in (('before', before), ('after', after)):
+        seconds = timeit.timeit(route, number=number)
+        print("%-7s %8.0f requests/s" % (label, number / seconds))
+
+
+if __name__ == '__main__':
+    main()
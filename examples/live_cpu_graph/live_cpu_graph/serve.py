@@ -17,7 +17,8 @@ class CPUNamespace(BaseNamespace, BroadcastMixin):
 
                 if prev:
                     percent = (sum(vals) - sum(prev))
-                    self.emit('cpu_data', {'point': percent})
+                    self.emit('cpu_data', {'point': percent},
+                              conflate_key='cpu_data')
                 prev = vals
                 gevent.sleep(0.1)
         self.spawn(sendcpu)
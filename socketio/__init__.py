@@ -37,9 +37,11 @@ def socketio_manage(environ, namespaces, request=None, error_handler=None,
     error handler.
 
     The ``json_loads`` and ``json_dumps`` are overrides for the default
-    ``json.loads`` and ``json.dumps`` function calls.  Override these at
-    the top-most level here.  This will affect all sockets created by this
-    socketio manager, and all namespaces inside.
+    ``json.loads`` and ``json.dumps`` function calls.  They can also be the
+    name of one of the backends of :mod:`socketio.defaultjson`, like
+    ``'fast'``.  Override these at the top-most level here.  This will
+    affect all sockets created by this socketio manager, and all namespaces
+    inside.
 
     This function will block the current "view" or "controller" in your
     framework to do the recv/send on the socket, and dispatch incoming messages
@@ -0,0 +1,135 @@
+"""Binary payload codecs, for the websocket transport.
+
+By default, the payloads of the packets are JSON text, and every frame
+is a text frame.  A client connecting through the websocket transport can
+ask for a binary codec instead, by adding a ``binary`` parameter to the
+query string of the websocket URL::
+
+  ws://example.com/socket.io/1/websocket/<sessid>?binary=msgpack
+
+If the server allows that codec (see the ``binary_codecs`` option of
+:class:`~socketio.server.SocketIOServer`), the 'event', 'json' and 'ack'
+packets are then sent as binary websocket frames, keeping the Socket.IO
+header in front of the encoded payload::
+
+  '5:1+:/chat:' + msgpack.packb({'name': 'sample', 'args': [...]})
+
+The client can send its packets in the same way, in binary frames.  Text
+frames are still used for the other packets (heartbeats, connect, ...),
+and are always accepted, so the client must handle both.  The polling
+transports never negotiate a codec and stay on JSON text.
+
+This pays off for events carrying lots of numbers, like sensor samples or
+coordinates, which are both smaller and faster to encode with msgpack.
+
+The ``msgpack`` codec is available when the `msgpack
+<https://pypi.python.org/pypi/msgpack>`_ package is installed.  You can
+add your own with :func:`register_codec`.
+"""
+from socketio import packet
+
+
+class BinaryFrame(bytes):
+    """An encoded packet to send, or that was received, in a binary
+    websocket frame, rather than a text one."""
+
+    __slots__ = ()
+
+
+class Codec(object):
+    """A named pair of ``dumps``/``loads`` functions, converting payloads
+    to and from bytes."""
+
+    __slots__ = ('name', 'dumps', 'loads')
+
+    def __init__(self, name, dumps, loads):
+        self.name = name
+        self.dumps = dumps
+        self.loads = loads
+
+    def __repr__(self):
+        return '<Codec %s>' % self.name
+
+
+_codecs = {}
+
+
+def register_codec(name, dumps, loads):
+    """Make the codec ``name`` available to the clients.  It must also be
+    listed in the ``binary_codecs`` option of the server to be used."""
+    codec = _codecs[name] = Codec(name, dumps, loads)
+    return codec
+
+
+def get_codec(name):
+    """Return the :class:`Codec` registered as ``name``, or None."""
+    return _codecs.get(name)
+
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    pass
+else:
+    register_codec(
+        'msgpack',
+        lambda data: msgpack.packb(data, use_bin_type=True),
+        lambda data: msgpack.unpackb(data, raw=False))
+
+
+def encode(pkt, codec):
+    """Encode ``pkt`` with ``codec``, as a :class:`BinaryFrame`.
+
+    Returns None for the packets without a payload to encode, which are
+    sent as text by :func:`socketio.packet.encode`.
+    """
+    msg_type = pkt['type']
+    endpoint = pkt.get('endpoint', '')
+    if msg_type == 'event':
+        d = {'name': pkt['name']}
+        if 'args' in pkt and pkt['args'] != []:
+            d['args'] = list(pkt['args'])
+        payload = codec.dumps(d)
+    elif msg_type == 'json':
+        payload = codec.dumps(pkt['data'])
+    elif msg_type == 'ack':
+        header = '6::%s:%s+' % (endpoint, pkt['ackId'])
+        return BinaryFrame(header.encode('utf-8') +
+                           codec.dumps(list(pkt.get('args', ()))))
+    else:
+        return None
+    if 'id' in pkt:
+        header = '%d:%s%s:%s:' % (packet.MSG_TYPES[msg_type], pkt['id'],
+                                  '+' if pkt['ack'] == 'data' else '',
+                                  endpoint)
+    else:
+        header = packet._prefix(msg_type, endpoint) + ':'
+    return BinaryFrame(header.encode('utf-8') + payload)
+
+
+def decode(frame, codec):
+    """Decode a binary ``frame`` received from the client into a packet
+    dict.
+
+    Frames of the packet types without a payload are decoded as text.
+    """
+    parts = bytes(frame).split(b':', 3)
+    if len(parts) < 4 or parts[0] not in (b'4', b'5', b'6'):
+        return packet.decode(bytes(frame))
+    msg_type, msg_id, endpoint, data = parts
+
+    decoded_msg = {'type': packet.MSG_VALUES[int(msg_type)],
+                   'endpoint': endpoint.decode('utf-8')}
+    if msg_id:
+        packet._decode_id(decoded_msg, msg_id.decode('ascii'))
+    if msg_type == b'5':
+        data = codec.loads(data)
+        decoded_msg['name'] = data.pop('name')
+        decoded_msg['args'] = data.get('args', [])
+    elif msg_type == b'4':
+        decoded_msg['data'] = codec.loads(data)
+    else:
+        ack_id, data = data.split(b'+', 1)
+        decoded_msg['ackId'] = int(ack_id)
+        decoded_msg['args'] = codec.loads(data)
+    return decoded_msg
@@ -0,0 +1,168 @@
+"""The outbound queue of a :class:`~socketio.virtsocket.Socket`, holding the
+encoded messages waiting to be picked up by the transport.
+
+A client that stops polling, or a websocket whose TCP window is stalled,
+would otherwise accumulate messages until the process runs out of memory.
+The :class:`ClientQueue` can be bounded, in number of messages and in
+bytes, and applies one of these policies when a new message doesn't fit:
+
+``drop-oldest``
+  Make room by dropping the messages that have been waiting the longest.
+
+``drop-newest``
+  Drop the message being queued.
+
+``disconnect``
+  Drop the message being queued, and disconnect the slow consumer.
+
+Configure it with the ``client_queue_max_messages``,
+``client_queue_max_bytes`` and ``client_queue_policy`` options of the
+:class:`~socketio.server.SocketIOServer`.
+
+Messages can also be *conflated*: when a message is queued with a key
+(see :meth:`ClientQueue.conflate`), it replaces the message still waiting
+in the queue with the same key, keeping its position.  For feeds where
+only the latest value matters, a client that falls behind then catches
+up with one message instead of hundreds of stale ones.
+"""
+from gevent.queue import Queue
+
+
+DROP_OLDEST = 'drop-oldest'
+DROP_NEWEST = 'drop-newest'
+DISCONNECT = 'disconnect'
+
+POLICIES = (DROP_OLDEST, DROP_NEWEST, DISCONNECT)
+
+
+class SlowConsumer(Exception):
+    """Raised by :meth:`ClientQueue.put_nowait` the first time a message
+    doesn't fit, with the ``disconnect`` policy."""
+
+
+class _Conflated(object):
+    """Holds a keyed message in the queue, so that it can be replaced in
+    place."""
+
+    __slots__ = ('key', 'item')
+
+    def __init__(self, key, item):
+        self.key = key
+        self.item = item
+
+    def __len__(self):
+        return len(self.item)
+
+
+class ClientQueue(Queue):
+    """A :class:`gevent.queue.Queue` that keeps track of the size of the
+    messages it holds, and enforces the limits described above.
+
+    ``None`` is used to tell the transports to stop, so it is never
+    counted, nor dropped.
+    """
+
+    def __init__(self, max_messages=None, max_bytes=None,
+                 policy=DROP_OLDEST):
+        if policy not in POLICIES:
+            raise ValueError("policy should be one of: %s" % (POLICIES, ))
+        Queue.__init__(self)
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.size_bytes = 0
+        #: Number of messages dropped from this queue
+        self.dropped = 0
+        #: Whether a message didn't fit, with the ``disconnect`` policy
+        self.overflowed = False
+        self._conflated = {}  # key -> _Conflated still in the queue
+        #: Called with no arguments each time a message is queued, if set.
+        #: The :class:`~socketio.transports.WebsocketPump` uses it.
+        self.on_put = None
+
+    def _put(self, item):
+        if item is not None:
+            self.size_bytes += len(item)
+        self.queue.append(item)
+        if self.on_put is not None:
+            self.on_put()
+
+    def _get(self):
+        item = self.queue.popleft()
+        if item is not None:
+            self.size_bytes -= len(item)
+            if type(item) is _Conflated:
+                del self._conflated[item.key]
+                item = item.item
+        return item
+
+    def _fits(self, size):
+        if (self.max_messages is not None
+                and len(self.queue) >= self.max_messages):
+            return False
+        if (self.max_bytes is not None
+                and self.size_bytes + size > self.max_bytes):
+            return False
+        return True
+
+    def put_nowait(self, item):
+        """Queue ``item``, applying the policy if it doesn't fit.
+
+        Returns the number of messages that were dropped (the new one, or
+        the oldest ones).  Raises :exc:`SlowConsumer` the first time a
+        message is dropped with the ``disconnect`` policy.
+
+        With ``drop-oldest``, a single message larger than ``max_bytes`` is
+        still queued, once everything else is gone.
+        """
+        if item is None or self._fits(len(item)):
+            Queue.put_nowait(self, item)
+            return 0
+
+        if self.policy == DROP_OLDEST:
+            dropped = 0
+            size = len(item)
+            while self.queue and self.queue[0] is not None \
+                    and not self._fits(size):
+                self._get()
+                dropped += 1
+            Queue.put_nowait(self, item)
+            self.dropped += dropped
+            return dropped
+
+        self.dropped += 1
+        if self.policy == DISCONNECT and not self.overflowed:
+            self.overflowed = True
+            raise SlowConsumer("client_queue is full: %d messages, %d bytes"
+                               % (len(self.queue), self.size_bytes))
+        return 1
+
+    def conflated_item(self, key):
+        """Return the message still queued with ``key``, or None."""
+        slot = self._conflated.get(key)
+        if slot is None:
+            return None
+        return slot.item
+
+    def conflate(self, key, item):
+        """Queue ``item``, or replace the message queued with the same
+        ``key`` if it wasn't sent yet.
+
+        Returns the number of messages that were dropped, like
+        :meth:`put_nowait`.  Replacing a message doesn't count as a drop.
+        """
+        slot = self._conflated.get(key)
+        if slot is not None:
+            self.size_bytes += len(item) - len(slot.item)
+            slot.item = item
+            return 0
+        slot = self._conflated[key] = _Conflated(key, item)
+        try:
+            dropped = self.put_nowait(slot)
+        except SlowConsumer:
+            del self._conflated[key]
+            raise
+        if dropped and self.policy != DROP_OLDEST:
+            # It was the new message that got dropped
+            del self._conflated[key]
+        return dropped
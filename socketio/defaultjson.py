@@ -1,10 +1,33 @@
+"""JSON backends used to encode and decode the packets.
+
+The ``default`` backend sorts the keys of the objects and turns the
+:class:`~decimal.Decimal` objects into floats.  It is what was always
+used, and is kept as the default so that the output doesn't change.
+
+The ``fast`` backend doesn't sort the keys, doesn't escape non-ASCII
+characters, and uses the fastest encoder installed, in this order:
+``orjson``, ``simplejson`` (for its C speedups) and the standard
+``json`` module.  Decimals are still supported.
+
+Each encoder found is also registered under its own name.  Select a
+backend with the ``json_backend`` option of the
+:class:`~socketio.server.SocketIOServer`, or per socket by passing its
+name to :func:`socketio.socketio_manage` as ``json_dumps`` and
+``json_loads``.  You can register your own with :func:`register_backend`.
+"""
+import decimal
+import json as stdlib_json
+
 ### default json loaders
 try:
     import simplejson as json
     json_decimal_args = {"use_decimal": True}  # pragma: no cover
+    # Same as json.dumps(data, separators=..., sort_keys=True, ...), without
+    # building a new encoder on each call
+    _default_encoder = json.JSONEncoder(separators=(',', ':'),
+                                        sort_keys=True, use_decimal=True)
 except ImportError:
     import json
-    import decimal
 
     class DecimalEncoder(json.JSONEncoder):
         def default(self, o):
@@ -12,11 +35,93 @@ except ImportError:
                 return float(o)
             return super(DecimalEncoder, self).default(o)
     json_decimal_args = {"cls": DecimalEncoder}
+    _default_encoder = DecimalEncoder(separators=(',', ':'), sort_keys=True)
+
 
 def default_json_dumps(data):
-    return json.dumps(data, separators=(',', ':'),
-                      sort_keys=True,
-                      **json_decimal_args)
+    return _default_encoder.encode(data)
+
 
 def default_json_loads(data):
     return json.loads(data)
+
+
+class JSONBackend(object):
+    """A named pair of ``dumps``/``loads`` functions, working with text."""
+
+    __slots__ = ('name', 'dumps', 'loads')
+
+    def __init__(self, name, dumps, loads):
+        self.name = name
+        self.dumps = dumps
+        self.loads = loads
+
+    def __repr__(self):
+        return '<JSONBackend %s>' % self.name
+
+
+_backends = {}
+
+
+def register_backend(name, dumps, loads):
+    """Register a JSON backend under ``name``, replacing any other one."""
+    backend = _backends[name] = JSONBackend(name, dumps, loads)
+    return backend
+
+
+def get_backend(name):
+    """Return the :class:`JSONBackend` registered as ``name``.
+
+    Raises :exc:`ValueError` if there is none.
+    """
+    try:
+        return _backends[name]
+    except KeyError:
+        raise ValueError("Unknown JSON backend: %s (available: %s)" %
+                         (name, ", ".join(sorted(_backends))))
+
+
+def available_backends():
+    """Return the names of the registered backends."""
+    return sorted(_backends)
+
+
+def _decimal_to_float(o):
+    if isinstance(o, decimal.Decimal):
+        return float(o)
+    raise TypeError("%r is not JSON serializable" % (o, ))
+
+
+register_backend('default', default_json_dumps, default_json_loads)
+
+_json_encoder = stdlib_json.JSONEncoder(separators=(',', ':'),
+                                        ensure_ascii=False,
+                                        default=_decimal_to_float)
+register_backend('json', _json_encoder.encode, stdlib_json.loads)
+_fastest = 'json'
+
+try:
+    import simplejson
+except ImportError:
+    pass
+else:
+    _simplejson_encoder = simplejson.JSONEncoder(separators=(',', ':'),
+                                                 ensure_ascii=False,
+                                                 use_decimal=True)
+    register_backend('simplejson', _simplejson_encoder.encode,
+                     simplejson.loads)
+    _fastest = 'simplejson'
+
+try:
+    import orjson
+except ImportError:
+    pass
+else:
+    def orjson_dumps(data, _dumps=orjson.dumps,
+                     _option=orjson.OPT_NON_STR_KEYS):
+        return _dumps(data, default=_decimal_to_float,
+                      option=_option).decode('utf-8')
+    register_backend('orjson', orjson_dumps, orjson.loads)
+    _fastest = 'orjson'
+
+register_backend('fast', _backends[_fastest].dumps, _backends[_fastest].loads)
@@ -0,0 +1,176 @@
+"""permessage-deflate compression (:rfc:`7692`) for the websocket transport.
+
+When the ``websocket_deflate`` option of the
+:class:`~socketio.server.SocketIOServer` is set, and the client offers the
+extension in the ``Sec-WebSocket-Extensions`` header of its handshake, the
+text and binary messages of at least ``websocket_deflate_min_size`` bytes
+are sent compressed.  The client may then compress its messages too.
+
+The events of chat and dashboard applications are repetitive JSON, which
+compresses well, especially with *context takeover*: each message is then
+compressed with the previous ones as the dictionary.  This costs a
+compressor and a decompressor, with their 32KB windows, per websocket.  Set
+``websocket_deflate_context_takeover`` to False to compress each message on
+its own, and ask the client to do the same.  A client can also ask for it.
+
+The compression is accounted for in ``SocketIOServer.metrics``:
+
+``websocket.deflate.bytes_in``, ``websocket.deflate.bytes_out``
+  Size of the messages compressed, before and after compression.  Their
+  ratio is the compression ratio.
+
+``websocket.deflate.seconds``
+  CPU time spent compressing.
+
+and likewise for the messages received, under ``websocket.inflate.*``.
+
+A small compressed message can inflate to a huge one.  The messages
+received that would inflate beyond ``websocket_max_message_size`` bytes
+are rejected, counted as ``websocket.inflate.rejected``, and the websocket
+is closed with status 1009 (message too big).
+"""
+import time
+import zlib
+
+from geventwebsocket.exceptions import FrameTooLargeException
+
+try:
+    _cpu_time = time.process_time
+except AttributeError:  # pragma: no cover
+    _cpu_time = time.clock
+
+EXTENSION = 'permessage-deflate'
+
+_TAIL = b'\x00\x00\xff\xff'
+
+
+class PerMessageDeflate(object):
+    """Compresses the messages sent on a websocket, and decompresses the
+    messages received, with the parameters negotiated during the
+    handshake."""
+
+    def __init__(self, server_no_context_takeover=False,
+                 client_no_context_takeover=False, server_max_window_bits=None,
+                 min_size=0, max_size=None, metrics=None):
+        self.server_no_context_takeover = server_no_context_takeover
+        self.client_no_context_takeover = client_no_context_takeover
+        self.server_max_window_bits = server_max_window_bits
+        self.min_size = min_size
+        self.max_size = max_size
+        self.metrics = metrics if metrics is not None else {}
+        self._compressor = None
+        self._decompressor = None
+
+    def response_header(self):
+        """The value of the ``Sec-WebSocket-Extensions`` response header."""
+        params = [EXTENSION]
+        if self.server_no_context_takeover:
+            params.append('server_no_context_takeover')
+        if self.client_no_context_takeover:
+            params.append('client_no_context_takeover')
+        if self.server_max_window_bits is not None:
+            params.append('server_max_window_bits=%d' %
+                          self.server_max_window_bits)
+        return '; '.join(params)
+
+    def _incr(self, name, value):
+        metrics = self.metrics
+        metrics[name] = metrics.get(name, 0) + value
+
+    def compress(self, data):
+        """Return ``data`` compressed, or None if it is smaller than
+        ``min_size``."""
+        if len(data) < self.min_size:
+            return None
+        start = _cpu_time()
+        compressor = self._compressor
+        if compressor is None:
+            compressor = zlib.compressobj(
+                zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED,
+                -(self.server_max_window_bits or zlib.MAX_WBITS))
+            if not self.server_no_context_takeover:
+                self._compressor = compressor
+        compressed = compressor.compress(data) + \
+            compressor.flush(zlib.Z_SYNC_FLUSH)
+        if compressed.endswith(_TAIL):
+            compressed = compressed[:-4]
+        self._incr('websocket.deflate.seconds', _cpu_time() - start)
+        self._incr('websocket.deflate.bytes_in', len(data))
+        self._incr('websocket.deflate.bytes_out', len(compressed))
+        return compressed
+
+    def decompress(self, data):
+        """Return the message ``data``, received compressed.
+
+        Raises :exc:`~geventwebsocket.exceptions.FrameTooLargeException`,
+        without inflating any further, if the message is larger than
+        ``max_size``.
+        """
+        start = _cpu_time()
+        decompressor = self._decompressor
+        if decompressor is None:
+            decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            if not self.client_no_context_takeover:
+                self._decompressor = decompressor
+        max_size = self.max_size
+        if max_size is None:
+            message = decompressor.decompress(bytes(data) + _TAIL)
+        else:
+            # One byte more than allowed tells it is too big
+            message = decompressor.decompress(bytes(data) + _TAIL,
+                                              max_size + 1)
+            if len(message) > max_size:
+                self._incr('websocket.inflate.rejected', 1)
+                raise FrameTooLargeException(
+                    "Message larger than %d bytes once inflated" % max_size)
+        self._incr('websocket.inflate.seconds', _cpu_time() - start)
+        self._incr('websocket.inflate.bytes_in', len(data))
+        self._incr('websocket.inflate.bytes_out', len(message))
+        return message
+
+
+def _parse_offers(header):
+    """Yield the parameters of each permessage-deflate offer of the
+    ``Sec-WebSocket-Extensions`` header, as a dict."""
+    for extension in header.split(','):
+        parts = [part.strip() for part in extension.split(';')]
+        if parts[0] != EXTENSION:
+            continue
+        params = {}
+        for param in parts[1:]:
+            if not param:
+                continue
+            name, _, value = param.partition('=')
+            params[name.strip()] = value.strip().strip('"') or None
+        yield params
+
+
+def negotiate(header, context_takeover=True, min_size=0, max_size=None,
+              metrics=None):
+    """Return the :class:`PerMessageDeflate` for the first offer of the
+    ``Sec-WebSocket-Extensions`` ``header`` we can accept, or None."""
+    for params in _parse_offers(header or ''):
+        if not set(params) <= set(('server_no_context_takeover',
+                                   'client_no_context_takeover',
+                                   'server_max_window_bits',
+                                   'client_max_window_bits')):
+            continue
+        window_bits = params.get('server_max_window_bits')
+        if window_bits is not None:
+            if not window_bits.isdigit() or \
+                    not 9 <= int(window_bits) <= 15:
+                # zlib can't do a window of 8 bits
+                continue
+            window_bits = int(window_bits)
+        return PerMessageDeflate(
+            server_no_context_takeover=(
+                not context_takeover
+                or 'server_no_context_takeover' in params),
+            client_no_context_takeover=(
+                not context_takeover
+                or 'client_no_context_takeover' in params),
+            server_max_window_bits=window_bits,
+            min_size=min_size,
+            max_size=max_size,
+            metrics=metrics)
+    return None
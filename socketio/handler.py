@@ -1,28 +1,276 @@
 import sys
 import re
+import base64
+import hashlib
+import logging
+import struct
 import gevent
 from six.moves.urllib.parse import parse_qs
 
 from gevent.pywsgi import WSGIHandler
-from socketio import transports
+from socket import error as socket_error
+from geventwebsocket import WebSocketError
+from geventwebsocket.exceptions import FrameTooLargeException, \
+    ProtocolError
+from geventwebsocket.websocket import Header, MSG_ALREADY_CLOSED, Stream, \
+    WebSocket
+from socketio import deflate, transports
+
+log = logging.getLogger(__name__)
+
+
+class SocketIORequest(object):
+    """What the :class:`Router` found in the URL of a Socket.IO request.
+
+    The query string is only parsed if needed, and once.
+    """
+
+    __slots__ = ('kind', 'transport_id', 'sessid', 'protocol_version',
+                 'query_string', '_query')
+
+    HANDSHAKE = 'handshake'
+    DISCONNECT = 'disconnect'
+    REQUEST = 'request'
+
+    def __init__(self, kind=REQUEST, transport_id=None, sessid=None,
+                 protocol_version='1', query_string=''):
+        self.kind = kind
+        self.transport_id = transport_id
+        self.sessid = sessid
+        self.protocol_version = protocol_version
+        self.query_string = query_string
+        self._query = None
+
+    @property
+    def query(self):
+        """The query string, as parsed by ``parse_qs``."""
+        if self._query is None:
+            self._query = parse_qs(self.query_string)
+        return self._query
+
+
+class Router(object):
+    """Parses the URLs of the Socket.IO requests for ``resource``, with a
+    single regular expression.
+
+    The URLs are, after ``/<resource>/``:
+
+    * ``1/`` for the handshake,
+    * ``1/<transport_id>/<sessid>`` for the requests of the transports,
+    * ``<protocol_version>//<sessid>`` for the disconnect requests of the
+      new socket.io versions (> 0.9.8), see line 361 of
+      https://github.com/LearnBoost/socket.io-client/blob/0.9.16/lib/socket.js
+    """
+
+    RE_URL = re.compile(r"""
+        (?:1/(?:(?P<transport_id>[^/]+)
+                /(?P<sessid>[^/]+)/?)?
+          |(?P<protocol_version>[^/]+)
+           //(?P<disconnect_sessid>[^/]+)/?
+        )\Z""", re.X)
+
+    def __init__(self, resource):
+        self.prefix = '/%s/' % resource
+
+    def match(self, path, query_string=''):
+        """Return the :class:`SocketIORequest` for ``path``, or None if it
+        isn't a Socket.IO URL."""
+        if not path.startswith(self.prefix):
+            return None
+        m = self.RE_URL.match(path, len(self.prefix))
+        if m is None:
+            return None
+        transport_id, sessid, protocol_version, disconnect_sessid = \
+            m.groups()
+        if disconnect_sessid is not None:
+            return SocketIORequest(SocketIORequest.DISCONNECT, None,
+                                   disconnect_sessid, protocol_version,
+                                   query_string)
+        if sessid is None:
+            return SocketIORequest(SocketIORequest.HANDSHAKE,
+                                   query_string=query_string)
+        return SocketIORequest(SocketIORequest.REQUEST, transport_id, sessid,
+                               query_string=query_string)
+
+
+class SocketIOWebSocket(WebSocket):
+    """A :class:`~geventwebsocket.websocket.WebSocket` that tells
+    ``on_pong`` about the pongs it receives, and decompresses the messages
+    compressed with permessage-deflate, once negotiated (``deflate`` is
+    then a :class:`~socketio.deflate.PerMessageDeflate`).
+
+    The messages can also be read one frame at a time, with
+    :meth:`read_frame` and :meth:`feed_frame`.
+    """
+
+    __slots__ = ('on_pong', 'deflate', '_opcode', '_compressed', '_message')
+
+    # geventwebsocket calls RSV0 what RFC 6455 calls RSV1
+    COMPRESSED = Header.RSV0_MASK
+
+    def __init__(self, *args, **kwargs):
+        super(SocketIOWebSocket, self).__init__(*args, **kwargs)
+        self.on_pong = None
+        self.deflate = None
+        self._opcode = None  # of the message being received
+        self._compressed = False
+        self._message = bytearray()
+
+    def handle_pong(self, header, payload):
+        if self.on_pong is not None:
+            self.on_pong(payload)
+
+    def close(self, code=1000, message=b''):
+        """Close the websocket, sending the status ``code`` and
+        ``message``, that the base class leaves out of the close frame.
+        The socket itself is left open."""
+        if self.closed:
+            self.current_app.on_close(MSG_ALREADY_CLOSED)
+        if not isinstance(message, bytes):
+            message = message.encode('utf-8')
+        try:
+            self.send_frame(struct.pack('!H', code) + message,
+                            opcode=self.OPCODE_CLOSE)
+        except WebSocketError:
+            self.logger.debug("Failed to write closing frame -> closing "
+                              "socket")
+        finally:
+            self.closed = True
+            self.stream = self.raw_write = self.raw_read = None
+            self.environ = None
+
+    def read_frame(self):
+        """Block until a full frame has been read from the socket, and
+        return its header and payload."""
+        header = Header.decode_header(self.stream)
+
+        if header.flags and (
+                header.flags != self.COMPRESSED or self.deflate is None
+                or header.opcode not in (self.OPCODE_TEXT,
+                                         self.OPCODE_BINARY)):
+            raise ProtocolError
+
+        if not header.length:
+            return header, b''
+
+        try:
+            payload = self.raw_read(header.length)
+        except socket_error:
+            payload = b''
+
+        if len(payload) != header.length:
+            raise WebSocketError('Unexpected EOF reading frame payload')
+
+        if header.mask:
+            payload = header.unmask_payload(payload)
+
+        return header, payload
+
+    def feed_frame(self, header, payload):
+        """Handle a frame read by :meth:`read_frame`.
+
+        Returns the message once its last frame is fed, None before that
+        and for the control frames, and False once the websocket is
+        closed.
+        """
+        f_opcode = header.opcode
+        if f_opcode in (self.OPCODE_TEXT, self.OPCODE_BINARY):
+            if self._opcode:
+                raise ProtocolError("The opcode in non-fin frame is "
+                                    "expected to be zero, got "
+                                    "{0!r}".format(f_opcode))
+            self.utf8validator.reset()
+            self.utf8validate_last = (True, True, 0, 0)
+            self._opcode = f_opcode
+            self._compressed = bool(header.flags)
+        elif f_opcode == self.OPCODE_CONTINUATION:
+            if not self._opcode:
+                raise ProtocolError("Unexpected frame with opcode=0")
+        elif f_opcode == self.OPCODE_PING:
+            self.handle_ping(header, payload)
+            return None
+        elif f_opcode == self.OPCODE_PONG:
+            self.handle_pong(header, payload)
+            return None
+        elif f_opcode == self.OPCODE_CLOSE:
+            self.handle_close(header, payload)
+            return False
+        else:
+            raise ProtocolError("Unexpected opcode={0!r}".format(f_opcode))
+
+        if self._opcode == self.OPCODE_TEXT and not self._compressed:
+            self.validate_utf8(payload)
+        self._message += payload
+        if not header.fin:
+            return None
+
+        opcode, message = self._opcode, self._message
+        self._opcode = None
+        self._message = bytearray()
+        if self._compressed:
+            message = bytearray(self.deflate.decompress(message))
+        if opcode == self.OPCODE_TEXT:
+            self.validate_utf8(message)
+            return self._decode_bytes(message)
+        return message
+
+    def read_message(self):
+        """Return the next text or binary message from the socket, or None
+        once it is closed.  Messages too big close it with status 1009."""
+        while True:
+            try:
+                message = self.feed_frame(*self.read_frame())
+            except FrameTooLargeException:
+                # receive() would close with 1002, as for any ProtocolError
+                self.close(1009)
+                return None
+            if message is False:
+                return None
+            if message is not None:
+                return message
+
+
+class WebSocketConnection(object):
+    """What a websocket transport needs from the connection, once the
+    HTTP handler has upgraded it: the ``environ``, the
+    :class:`SocketIORequest`, and the socket and ``rfile`` the
+    :class:`~geventwebsocket.websocket.WebSocket` reads and writes.
+
+    It stands in for the handler, for the transport and for the
+    ``WebSocket`` object.
+    """
+
+    __slots__ = ('environ', 'socketio_request', 'socket', 'rfile', 'server',
+                 'websocket')
+
+    logger = log
+
+    def __init__(self, environ, socketio_request, socket, rfile, server):
+        self.environ = environ
+        self.socketio_request = socketio_request
+        self.socket = socket
+        self.rfile = rfile
+        self.server = server
+        self.websocket = SocketIOWebSocket(environ, Stream(self), self)
+        environ['wsgi.websocket'] = self.websocket
+
+    def release(self):
+        """Drop the references to the websocket and the environ, once the
+        connection is over."""
+        if self.websocket is not None:
+            self.websocket.environ = None
+            self.websocket = None
+        self.environ = None
 
 
 class SocketIOHandler(WSGIHandler):
-    RE_REQUEST_URL = re.compile(r"""
-        ^/(?P<resource>.+?)
-         /1
-         /(?P<transport_id>[^/]+)
-         /(?P<sessid>[^/]+)/?$
-         """, re.X)
-    RE_HANDSHAKE_URL = re.compile(r"^/(?P<resource>.+?)/1/$", re.X)
-    # new socket.io versions (> 0.9.8) call an obscure url with two slashes
-    # instead of a transport when disconnecting
-    # https://github.com/LearnBoost/socket.io-client/blob/0.9.16/lib/socket.js#L361
-    RE_DISCONNECT_URL = re.compile(r"""
-        ^/(?P<resource>.+?)
-         /(?P<protocol_version>[^/]+)
-         //(?P<sessid>[^/]+)/?$
-         """, re.X)
+    #: The :class:`SocketIORequest` of the request being handled
+    socketio_request = None
+
+    _routers = {}  # resource -> Router
+
+    WEBSOCKET_VERSIONS = ('13', '8', '7')
+    WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
 
     handler_types = {
         'websocket': transports.WebsocketTransport,
@@ -53,22 +301,95 @@ class SocketIOHandler(WSGIHandler):
                 raise ValueError("transports should be elements of: %s" %
                     list(self.handler_types.keys()))
 
-    def _do_handshake(self, tokens):
-        if tokens["resource"] != self.server.resource:
-            self.log_error("socket.io URL mismatch")
-        else:
-            socket = self.server.get_socket()
-            data = "%s:%s:%s:%s" % (socket.sessid,
-                                     self.config['heartbeat_timeout'] or '',
-                                     self.config['close_timeout'] or '',
-                                     ",".join(self.transports))
-            self.write_smart(data.encode('latin-1'))
+    def _do_handshake(self):
+        socket = self.server.get_socket()
+        data = "%s:%s:%s:%s" % (socket.sessid,
+                                 self.config['heartbeat_timeout'] or '',
+                                 self.config['close_timeout'] or '',
+                                 ",".join(self.transports))
+        self.write_smart(data.encode('latin-1'))
+
+    def upgrade_websocket(self):
+        """Switch the connection to the websocket protocol, and return the
+        :class:`WebSocketConnection` the transport uses from then on.
+
+        Returns None after sending an error response, if the request
+        isn't a valid websocket handshake.
+        """
+        environ = self.environ
+        if (environ.get('REQUEST_METHOD') != 'GET'
+                or environ.get('HTTP_UPGRADE', '').lower() != 'websocket'
+                or 'upgrade' not in environ.get('HTTP_CONNECTION',
+                                                '').lower()
+                or self.request_version != 'HTTP/1.1'):
+            return self._websocket_error('400 Bad Request')
+
+        version = environ.get('HTTP_SEC_WEBSOCKET_VERSION')
+        if version not in self.WEBSOCKET_VERSIONS:
+            return self._websocket_error(
+                '426 Upgrade Required' if not version else '400 Bad Request',
+                [('Sec-WebSocket-Version',
+                  ', '.join(self.WEBSOCKET_VERSIONS))])
+
+        key = environ.get('HTTP_SEC_WEBSOCKET_KEY', '').strip()
+        try:
+            valid_key = len(base64.b64decode(key)) == 16
+        except (TypeError, ValueError):
+            valid_key = False
+        if not valid_key:
+            return self._websocket_error('400 Bad Request')
+
+        accept = base64.b64encode(hashlib.sha1(
+            (key + self.WEBSOCKET_GUID).encode('latin-1')).digest())
+        headers = [
+            ('Upgrade', 'websocket'),
+            ('Connection', 'Upgrade'),
+            ('Sec-WebSocket-Accept', accept.decode('latin-1')),
+        ]
+        compression = None
+        if self.config.get('websocket_deflate'):
+            compression = deflate.negotiate(
+                environ.get('HTTP_SEC_WEBSOCKET_EXTENSIONS'),
+                context_takeover=self.config.get(
+                    'websocket_deflate_context_takeover', True),
+                min_size=self.config.get('websocket_deflate_min_size', 256),
+                max_size=self.config.get('websocket_max_message_size',
+                                         1048576),
+                metrics=self.server.metrics)
+            if compression is not None:
+                headers.append(('Sec-WebSocket-Extensions',
+                                compression.response_header()))
+        self.start_response('101 Switching Protocols', headers)
+        self.write(b'')
+        self.close_connection = True
+
+        environ['wsgi.websocket_version'] = version
+        connection = WebSocketConnection(environ, self.socketio_request,
+                                         self.socket, self.rfile,
+                                         self.server)
+        connection.websocket.deflate = compression
+        return connection
+
+    def _websocket_error(self, status, headers=()):
+        self.start_response(status, [('Content-Type', 'text/plain'),
+                                     ('Content-Length', '0')] + list(headers))
+        self.result = []
+        self.process_result()
+
+    def _get_router(self):
+        resource = self.server.resource
+        router = self._routers.get(resource)
+        if router is None:
+            router = self._routers[resource] = Router(resource)
+        return router
 
     def write_jsonp_result(self, data, wrapper="0"):
+        body = ('io.j[%s]("' % wrapper).encode('utf-8') + data + b'");'
         self.start_response("200 OK", [
             ("Content-Type", "application/javascript"),
+            ("Content-Length", str(len(body))),
         ])
-        self.result = ['io.j[%s]("%s");' % (wrapper, data)]
+        self.result = [body]
 
     def write_plain_result(self, data):
         self.start_response("200 OK", [
@@ -77,11 +398,19 @@ class SocketIOHandler(WSGIHandler):
             ("Access-Control-Allow-Methods", "POST, GET, OPTIONS"),
             ("Access-Control-Max-Age", "3600"),
             ("Content-Type", "text/plain"),
+            ("Content-Length", str(len(data))),
         ])
         self.result = [data]
 
     def write_smart(self, data):
-        args = parse_qs(self.environ.get("QUERY_STRING"))
+        """Write ``data`` as the whole body of the response.
+
+        The Content-Length is always set, in bytes, so that the HTTP/1.1
+        connections of the polling transports can be kept alive.
+        """
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        args = self.socketio_request.query
 
         if "jsonp" in args:
             self.write_jsonp_result(data, args["jsonp"][0])
@@ -97,49 +426,44 @@ class SocketIOHandler(WSGIHandler):
         methods, otherwise, will stay alive for websockets.
 
         """
-        path = self.environ.get('PATH_INFO')
+        # This is analyzed for each and every HTTP requests involved
+        # in the Socket.IO protocol, whether long-running or long-polling
+        # (read: websocket or xhr-polling methods)
+        request = self.socketio_request = self._get_router().match(
+            self.environ.get('PATH_INFO', ''),
+            self.environ.get('QUERY_STRING', ''))
 
-        # Kick non-socket.io requests to our superclass
-        if not path.lstrip('/').startswith(self.server.resource + '/'):
+        # Kick non-socket.io requests to our superclass, and the WSGI app
+        if request is None:
             return super(SocketIOHandler, self).handle_one_response()
 
+        try:
+            return self._handle_socketio_request(request)
+        finally:
+            self._discard_input()
+
+    def _handle_socketio_request(self, request):
         self.status = None
         self.headers_sent = False
         self.result = None
         self.response_length = 0
         self.response_use_chunked = False
 
-        # This is analyzed for each and every HTTP requests involved
-        # in the Socket.IO protocol, whether long-running or long-polling
-        # (read: websocket or xhr-polling methods)
         request_method = self.environ.get("REQUEST_METHOD")
-        request_tokens = self.RE_REQUEST_URL.match(path)
-        handshake_tokens = self.RE_HANDSHAKE_URL.match(path)
-        disconnect_tokens = self.RE_DISCONNECT_URL.match(path)
 
-        if handshake_tokens:
+        if request.kind == request.HANDSHAKE:
             # Deal with first handshake here, create the Socket and push
             # the config up.
-            return self._do_handshake(handshake_tokens.groupdict())
-        elif disconnect_tokens:
-            # it's a disconnect request via XHR
-            tokens = disconnect_tokens.groupdict()
-        elif request_tokens:
-            tokens = request_tokens.groupdict()
-            # and continue...
-        else:
-            # This is no socket.io request. Let the WSGI app handle it.
-            return super(SocketIOHandler, self).handle_one_response()
+            return self._do_handshake()
 
         # Setup socket
-        sessid = tokens["sessid"]
-        socket = self.server.get_socket(sessid)
+        socket = self.server.get_socket(request.sessid)
         if not socket:
             self.handle_bad_request()
             return []  # Do not say the session is not found, just bad request
                        # so they don't start brute forcing to find open sessions
 
-        if self.environ['QUERY_STRING'].startswith('disconnect'):
+        if request.query_string.startswith('disconnect'):
             # according to socket.io specs disconnect requests
             # have a `disconnect` query string
             # https://github.com/LearnBoost/socket.io-spec#forced-socket-disconnection
@@ -148,35 +472,36 @@ class SocketIOHandler(WSGIHandler):
             return []
 
         # Setup transport
-        transport = self.handler_types.get(tokens["transport_id"])
-
-        # In case this is WebSocket request, switch to the WebSocketHandler
-        # FIXME: fix this ugly class change
-        old_class = None
-        if issubclass(transport, (transports.WebsocketTransport,
-                                  transports.FlashSocketTransport)):
-            old_class = self.__class__
-            self.__class__ = self.server.ws_handler_class
-            self.prevent_wsgi_call = True  # thank you
-            # TODO: any errors, treat them ??
-            self.handle_one_response()  # does the Websocket dance before we continue
+        transport = self.handler_types.get(request.transport_id)
+        environ = self.environ
 
         # Make the socket object available for WSGI apps
-        self.environ['socketio'] = socket
-
-        # Create a transport and handle the request likewise
-        self.transport = transport(self, self.config)
+        environ['socketio'] = socket
+
+        if issubclass(transport, transports.WebsocketTransport):
+            # The connection is upgraded here, once, and the transport gets
+            # a WebSocketConnection: from now on, this handler only waits
+            # for the socket to be done.
+            connection = self.upgrade_websocket()
+            if connection is None:
+                return []
+            self.socketio_request = None
+            transport(connection, self.config).do_exchange(socket,
+                                                           request_method)
+        else:
+            connection = None
+            # Create a transport and handle the request likewise
+            self.transport = transport(self, self.config)
 
-        # transports register their own spawn'd jobs now
-        self.transport.do_exchange(socket, request_method)
+            # transports register their own spawn'd jobs now
+            self.transport.do_exchange(socket, request_method)
 
         if not socket.connection_established:
             # This is executed only on the *first* packet of the establishment
             # of the virtual Socket connection.
             socket.connection_established = True
             socket.state = socket.STATE_CONNECTED
-            socket._spawn_heartbeat()
-            socket._spawn_watcher()
+            socket._schedule_heartbeat()
 
             try:
                 # We'll run the WSGI app if it wasn't already done.
@@ -185,42 +510,50 @@ class SocketIOHandler(WSGIHandler):
                     #       why call directly the WSGI machinery ?
                     start_response = lambda status, headers, exc=None: None
                     socket.wsgi_app_greenlet = gevent.spawn(self.application,
-                                                            self.environ,
+                                                            environ,
                                                             start_response)
             except:
                 self.handle_error(*sys.exc_info())
 
         # we need to keep the connection open if we are an open socket
-        if tokens['transport_id'] in ['flashsocket', 'websocket']:
+        if connection is not None:
             # wait here for all jobs to finished, when they are done
             gevent.joinall(socket.jobs)
+            # Clean up circular references so they can be garbage collected.
+            connection.release()
 
-        # Switch back to the old class so references to this don't use the
-        # incorrect class. Useful for debugging.
-        if old_class:
-            self.__class__ = old_class
-
-        # Clean up circular references so they can be garbage collected.
-        if hasattr(self, 'websocket') and self.websocket:
-            if hasattr(self.websocket, 'environ'):
-                del self.websocket.environ
-            del self.websocket
         if self.environ:
             del self.environ
 
+    def _discard_input(self):
+        """Read what is left of the request body, so that it isn't taken
+        for the start of the next request on a kept-alive connection."""
+        wsgi_input = getattr(self, 'wsgi_input', None)
+        if wsgi_input is None:
+            return
+        try:
+            while wsgi_input.read(16384):
+                pass
+        except (socket_error, ValueError):
+            # The stream is in an unknown state, don't reuse it
+            self.close_connection = True
+
     def handle_bad_request(self):
         self.close_connection = True
         self.start_response("400 Bad Request", [
             ('Content-Type', 'text/plain'),
-            ('Connection', 'close'),
-            ('Content-Length', 0)
+            ('Content-Length', '0'),
+            ('Connection', 'close')
         ])
-
+        self.result = []
+        self.process_result()
 
     def handle_disconnect_request(self):
         self.close_connection = True
         self.start_response("200 OK", [
             ('Content-Type', 'text/plain'),
-            ('Connection', 'close'),
-            ('Content-Length', 0)
+            ('Content-Length', '0'),
+            ('Connection', 'close')
         ])
+        self.result = []
+        self.process_result()
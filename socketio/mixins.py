@@ -7,6 +7,8 @@ You'll likely want to create your own Mixins.
 
 import six
 
+from socketio.virtsocket import broadcast_packet
+
 
 class RoomsMixin(object):
     def __init__(self, *args, **kwargs):
@@ -16,27 +18,28 @@ class RoomsMixin(object):
 
     def join(self, room):
         """Lets a user join a room on a specific Namespace."""
-        self.session['rooms'].add(self._get_room_name(room))
+        room_name = self._get_room_name(room)
+        self.session['rooms'].add(room_name)
+        self.socket.join_room(room_name)
 
     def leave(self, room):
         """Lets a user leave a room on a specific Namespace."""
-        self.session['rooms'].remove(self._get_room_name(room))
+        room_name = self._get_room_name(room)
+        self.session['rooms'].remove(room_name)
+        self.socket.leave_room(room_name)
 
     def _get_room_name(self, room):
         return self.ns_name + '_' + room
 
     def emit_to_room(self, room, event, *args):
         """This is sent to all in the room (in this particular Namespace)"""
-        pkt = dict(type="event",
-                   name=event,
-                   args=args,
-                   endpoint=self.ns_name)
+        pkt = {"type": "event",
+               "name": event,
+               "args": args,
+               "endpoint": self.ns_name}
         room_name = self._get_room_name(room)
-        for sessid, socket in six.iteritems(self.socket.server.sockets):
-            if 'rooms' not in socket.session:
-                continue
-            if room_name in socket.session['rooms'] and self.socket != socket:
-                socket.send_packet(pkt)
+        sockets = list(self.socket.server.rooms.get(room_name, ()))
+        broadcast_packet(sockets, pkt, exclude=self.socket)
 
 
 class BroadcastMixin(object):
@@ -52,24 +55,34 @@ class BroadcastMixin(object):
         This is sent to all in the sockets in this particular Namespace,
         including itself.
         """
-        pkt = dict(type="event",
-                   name=event,
-                   args=args,
-                   endpoint=self.ns_name)
+        pkt = {"type": "event",
+               "name": event,
+               "args": args,
+               "endpoint": self.ns_name}
 
-        for sessid, socket in six.iteritems(self.socket.server.sockets):
-            socket.send_packet(pkt)
+        broadcast_packet(self._get_broadcast_sockets(), pkt)
 
     def broadcast_event_not_me(self, event, *args):
         """
         This is sent to all in the sockets in this particular Namespace,
         except itself.
         """
-        pkt = dict(type="event",
-                   name=event,
-                   args=args,
-                   endpoint=self.ns_name)
-
-        for sessid, socket in six.iteritems(self.socket.server.sockets):
-            if socket is not self.socket:
-                socket.send_packet(pkt)
+        pkt = {"type": "event",
+               "name": event,
+               "args": args,
+               "endpoint": self.ns_name}
+
+        broadcast_packet(self._get_broadcast_sockets(), pkt,
+                         exclude=self.socket)
+
+    def _get_broadcast_sockets(self):
+        """Only the sockets that have this Namespace active are targeted.
+
+        The global namespace is implicitly open on every socket (the
+        client never sends a 'connect' packet for it), so all the sockets
+        are targeted in that case.
+        """
+        server = self.socket.server
+        if self.ns_name == '':
+            return list(six.itervalues(server.sockets))
+        return list(server.endpoints.get(self.ns_name, ()))
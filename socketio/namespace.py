@@ -1,13 +1,81 @@
 import gevent
 import re
 import logging
-import inspect
+
+from gevent.event import AsyncResult
+
+
+try:
+    from inspect import getfullargspec as getargspec
+except ImportError:  # Python 2
+    from inspect import getargspec
 
 log = logging.getLogger(__name__)
 
 # regex to check the event name contains only alpha numerical characters
 allowed_event_name_regex = re.compile(r'^[A-Za-z][A-Za-z0-9_ ]*$')
 
+# Calling conventions of the dispatched ``on_*()`` and ``recv_*()`` methods
+CALL_ARGS = 'args'  # method(*args)
+CALL_PACKET = 'packet'  # method(packet)
+CALL_INVALID = 'invalid'  # doesn't have 'self' as its first argument
+
+
+def get_call_convention(method):
+    """Inspect the arguments of ``method``, and tell how
+    :meth:`BaseNamespace.call_method` should call it."""
+    func_args = getargspec(method).args
+    if not len(func_args) or func_args[0] != 'self':
+        return CALL_INVALID
+    if len(func_args) == 2 and func_args[1] == 'packet':
+        return CALL_PACKET
+    return CALL_ARGS
+
+
+class DispatchTable(object):
+    """The reflection needed to dispatch packets to a Namespace class,
+    done once per class by :meth:`BaseNamespace.get_dispatch_table`.
+
+    ``methods`` maps the ``on_*()`` and ``recv_*()`` method names to a
+    ``(function, calling_convention)`` tuple, ``events`` caches the
+    method names of the event names seen so far, and ``initializers`` are
+    the ``initialize()`` functions to call, in MRO order, on new
+    instances.
+    """
+
+    #: Maximum number of event names cached in ``events``
+    max_events = 1024
+
+    def __init__(self, ns_class):
+        self.methods = {}
+        for name in dir(ns_class):
+            if not name.startswith(('on_', 'recv_')):
+                continue
+            func = getattr(ns_class, name)
+            if not callable(func):
+                continue
+            try:
+                convention = get_call_convention(func)
+            except TypeError:
+                continue  # not introspectable, call_method() will deal
+            self.methods[name] = (func, convention)
+        self.events = {}
+        self.initializers = [cls.initialize for cls in ns_class.__mro__
+                             if hasattr(cls, 'initialize')]
+
+    def get_event_method(self, name):
+        """Return the method name handling the event ``name``, or None if
+        the name isn't allowed."""
+        method_name = self.events.get(name)
+        if method_name is None:
+            if not allowed_event_name_regex.match(name):
+                return None
+            method_name = 'on_' + name.replace(' ', '_')
+            if (method_name in self.methods
+                    and len(self.events) < self.max_events):
+                self.events[name] = method_name
+        return method_name
+
 
 class BaseNamespace(object):
     """The **Namespace** is the primary interface a developer will use
@@ -210,17 +278,32 @@ class BaseNamespace(object):
               if 'ack' in packet:
                   self.emit('go_back', 'param1', id=packet['id'])
         """
-        args = packet['args']
         name = packet['name']
-        if not allowed_event_name_regex.match(name):
+        table = self.get_dispatch_table()
+        method_name = table.get_event_method(name)
+        if method_name is None:
             self.error("unallowed_event_name",
                        "name must only contains alpha numerical characters")
             return
 
-        method_name = 'on_' + name.replace(' ', '_')
+        if getattr(packet, 'args_pending', False):
+            # The args weren't parsed yet (see the ``lazy_event_args``
+            # option), don't parse them for an event we would reject.
+            if not self.is_method_allowed(method_name):
+                self.error('method_access_denied',
+                           'You do not have access to method "%s"' %
+                           method_name)
+                return
+            if (method_name not in table.methods
+                    and getattr(self, method_name, None) is None):
+                self.error('no_such_method',
+                           'The method "%s" was not found' % method_name)
+                return
+
         # This means the args, passed as a list, will be expanded to
         # the method arg and if you passed a dict, it will be a dict
         # as the first parameter.
+        args = packet['args']
 
         return self.call_method_with_acl(method_name, packet, *args)
 
@@ -257,16 +340,26 @@ class BaseNamespace(object):
         ``exception_handler_decorator``.  See Namespace documentation
         for details and examples.
 
+        The methods of the class are inspected only once, see
+        :meth:`get_dispatch_table`.  Methods set on the instance itself
+        are inspected on each call.
+
         """
-        method = getattr(self, method_name, None)
-        if method is None:
-            self.error('no_such_method',
-                       'The method "%s" was not found' % method_name)
-            return
+        entry = None
+        if method_name not in self.__dict__:
+            entry = self.get_dispatch_table().methods.get(method_name)
+        if entry is not None:
+            func, convention = entry
+            method = None
+        else:
+            method = getattr(self, method_name, None)
+            if method is None:
+                self.error('no_such_method',
+                           'The method "%s" was not found' % method_name)
+                return
+            convention = get_call_convention(method)
 
-        specs = inspect.getargspec(method)
-        func_args = specs.args
-        if not len(func_args) or func_args[0] != 'self':
+        if convention == CALL_INVALID:
             self.error("invalid_method_args",
                 "The server-side method is invalid, as it doesn't "
                 "have 'self' as its first argument")
@@ -274,12 +367,40 @@ class BaseNamespace(object):
 
         # Check if we need to decorate to handle exceptions
         if hasattr(self, 'exception_handler_decorator'):
+            if method is None:
+                method = func.__get__(self, type(self))
             method = self.exception_handler_decorator(method)
 
-        if len(func_args) == 2 and func_args[1] == 'packet':
+        if method is None:
+            if convention == CALL_PACKET:
+                return func(self, packet)
+            return func(self, *args)
+        if convention == CALL_PACKET:
             return method(packet)
-        else:
-            return method(*args)
+        return method(*args)
+
+    @classmethod
+    def get_dispatch_table(cls):
+        """Return the :class:`DispatchTable` of this class, computing it
+        the first time.
+
+        This is called by :func:`~socketio.socketio_manage` when the
+        Namespace classes are registered, so that the reflection on the
+        class is done once, and not for every incoming packet.  If you add
+        or replace ``on_*()`` methods on the class after that, call
+        :meth:`reset_dispatch_table`.
+        """
+        table = cls.__dict__.get('_dispatch_table')
+        if table is None:
+            table = cls._dispatch_table = DispatchTable(cls)
+        return table
+
+    @classmethod
+    def reset_dispatch_table(cls):
+        """Forget the :class:`DispatchTable` of this class, it will be
+        computed again on the next packet."""
+        if '_dispatch_table' in cls.__dict__:
+            del cls._dispatch_table
 
     def initialize(self):
         """This is called right after ``__init__``, on the initial
@@ -377,7 +498,7 @@ class BaseNamespace(object):
         self.socket.error(error_name, error_message, endpoint=self.ns_name,
                           msg_id=msg_id, quiet=quiet)
 
-    def send(self, message, json=False, callback=None):
+    def send(self, message, json=False, callback=None, timeout=None):
         """Use send to send a simple string message.
 
         If ``json`` is True, the message will be encoded as a JSON object
@@ -392,8 +513,11 @@ class BaseNamespace(object):
                          success.  It just tells you that the browser
                          got a hold of the packet.
         :type callback: callable
+        :param timeout: Forget the ``callback`` if the client didn't ack
+                        within that many seconds.  Defaults to the
+                        ``ack_timeout`` option of the server.
         """
-        pkt = dict(type="message", data=message, endpoint=self.ns_name)
+        pkt = {"type": "message", "data": message, "endpoint": self.ns_name}
         if json:
             pkt['type'] = "json"
 
@@ -404,7 +528,7 @@ class BaseNamespace(object):
             # callback is more useful I think :)  So migrate your code.
             pkt['ack'] = True
             pkt['id'] = msgid = self.socket._get_next_msgid()
-            self.socket._save_ack_callback(msgid, callback)
+            self.socket._save_ack_callback(msgid, callback, timeout)
 
         self.socket.send_packet(pkt)
 
@@ -420,8 +544,8 @@ class BaseNamespace(object):
         However, it is possible that the ``'/other_endpoint'`` was not
         initialized yet, and that would yield a ``KeyError``.
 
-        The only supported ``kwargs`` is ``callback``.  All other parameters
-        must be passed positionally.
+        The only supported ``kwargs`` are ``callback``, ``timeout`` and
+        ``conflate_key``.  All other parameters must be passed positionally.
 
         :param event: The name of the event to trigger on the other end.
         :param callback: Pass in the callback keyword argument to define a
@@ -439,25 +563,77 @@ class BaseNamespace(object):
                          will then trigger the callback function with the
                          returned values.
         :type callback: callable
+        :param timeout: Forget the ``callback`` if the client didn't ack
+                        within that many seconds.  Defaults to the
+                        ``ack_timeout`` option of the server.  See also
+                        :meth:`emit_with_ack`.
+        :param conflate_key: If this event is still waiting to be sent
+                             when another one is emitted with the same
+                             ``conflate_key`` on this namespace, the new
+                             one replaces it, at the same position in the
+                             queue.  Use this for feeds where only the
+                             latest value matters, so that a client that
+                             falls behind doesn't get a backlog of stale
+                             values.  The callback of a replaced event is
+                             never called: it is expired, as if it timed
+                             out.
         """
         callback = kwargs.pop('callback', None)
+        timeout = kwargs.pop('timeout', None)
+        conflate_key = kwargs.pop('conflate_key', None)
+        self._check_emit_kwargs(kwargs)
+        self._emit(event, args, callback, timeout, conflate_key)
 
+    @staticmethod
+    def _check_emit_kwargs(kwargs):
         if kwargs:
             raise ValueError(
                 "emit() only supports positional argument, to stay "
                 "compatible with the Socket.IO protocol. You can "
                 "however pass in a dictionary as the first argument")
-        pkt = dict(type="event", name=event, args=args,
-                   endpoint=self.ns_name)
+
+    def _emit(self, event, args, callback=None, timeout=None,
+              conflate_key=None, on_expire=None):
+        """Queue the event, for :meth:`emit` and :meth:`emit_with_ack`.
+        ``on_expire`` is passed to
+        :meth:`~socketio.virtsocket.Socket._save_ack_callback`."""
+        pkt = {"type": "event", "name": event, "args": args,
+               "endpoint": self.ns_name}
 
         if callback:
             # By passing 'data', we indicate that we *want* an explicit ack
             # by the client code, not an automatic as with send().
             pkt['ack'] = 'data'
             pkt['id'] = msgid = self.socket._get_next_msgid()
-            self.socket._save_ack_callback(msgid, callback)
+            self.socket._save_ack_callback(msgid, callback, timeout,
+                                           on_expire)
 
-        self.socket.send_packet(pkt)
+        if conflate_key is not None:
+            conflate_key = (self.ns_name, conflate_key)
+        self.socket.send_packet(pkt, conflate_key)
+
+    def emit_with_ack(self, event, *args, **kwargs):
+        """Like :meth:`emit`, but instead of a ``callback``, returns a
+        :class:`gevent.event.AsyncResult` that will hold the list of
+        arguments the client acked with.
+
+        If the client doesn't ack within ``timeout`` seconds (or the
+        ``ack_timeout`` option of the server), or the socket is killed
+        first, the result is set to an
+        :exc:`~socketio.virtsocket.AckExpired` exception::
+
+          result = self.emit_with_ack('confirm', 'Are you sure?', timeout=10)
+          answer, = result.get()
+
+        The supported ``kwargs`` are ``timeout`` and ``conflate_key``.
+        """
+        timeout = kwargs.pop('timeout', None)
+        conflate_key = kwargs.pop('conflate_key', None)
+        self._check_emit_kwargs(kwargs)
+        result = AsyncResult()
+        self._emit(event, args, lambda *args: result.set(list(args)),
+                   timeout, conflate_key, on_expire=result.set_exception)
+        return result
 
     def spawn(self, fn, *args, **kwargs):
         """Spawn a new process, attached to this Namespace.
@@ -1,4 +1,6 @@
 import six
+from json.decoder import scanstring
+
 from socketio.defaultjson import default_json_dumps, default_json_loads
 
 MSG_TYPES = {
@@ -32,165 +34,430 @@ ADVICES_VALUES = dict((v, k) for k, v in six.iteritems(ERROR_ADVICES))
 socketio_packet_attributes = ['type', 'name', 'data', 'endpoint', 'args',
                               'ackId', 'reason', 'advice', 'qs', 'id']
 
+_FIELDS = tuple(socketio_packet_attributes) + ('ack', )
+_FIELD_SET = frozenset(_FIELDS)
 
-def encode(data, json_dumps=default_json_dumps):
+
+class _Field(object):
+    """Attribute access to one of the keys of a :class:`Packet`."""
+
+    __slots__ = ('key', )
+
+    def __init__(self, key):
+        self.key = key
+
+    def __get__(self, pkt, cls=None):
+        if pkt is None:
+            return self
+        try:
+            return pkt[self.key]
+        except KeyError:
+            raise AttributeError(self.key)
+
+    def __set__(self, pkt, value):
+        dict.__setitem__(pkt, self.key, value)
+
+    def __delete__(self, pkt):
+        try:
+            dict.__delitem__(pkt, self.key)
+        except KeyError:
+            raise AttributeError(self.key)
+
+
+class Packet(dict):
+    """A packet dict whose keys from ``socketio_packet_attributes`` (and
+    ``ack``) can also be read and set as attributes::
+
+      pkt = Packet(type='event', name='hello', args=[], endpoint='/chat')
+      pkt.name == pkt['name']
+
+    Attributes that are not set raise :exc:`AttributeError`.  Instances
+    have no ``__dict__``.
+
+    :func:`decode` and the Namespaces use plain dicts, which are cheaper
+    to build; the packets they give you are only :class:`Packet` objects
+    when decoded lazily (see :class:`EventPacket`).  Wrap one yourself,
+    with ``Packet(pkt)``, if you prefer the attributes.
     """
-    Encode an attribute dict into a byte string.
+
+    __slots__ = ()
+
+    def to_dict(self):
+        """Return the packet as a plain dict."""
+        return dict(self)
+
+    def copy(self):
+        return type(self)(self)
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__, dict.__repr__(self))
+
+
+for _key in _FIELDS:
+    setattr(Packet, _key, _Field(_key))
+del _key
+
+
+# Frames without any variable part, decoded without splitting them, to
+# their type
+CONTROL_FRAMES = {
+    '2::': 'heartbeat',
+    '8::': 'noop',
+    }
+
+# Encoded prefixes, by (type, endpoint).  See _prefix().
+_prefixes = {}
+_MAX_PREFIXES = 1024
+
+
+class Frame(bytes):
+    """An encoded packet, as the UTF-8 bytes the transports write out.
+
+    ``length`` is its length in UTF-16 code units, which is what the
+    '\ufffd<length>\ufffd' framing of the polling transports counts (it
+    is the javascript ``String.length``).  The
+    :class:`~socketio.virtsocket.Socket` queues these, so that a message
+    is encoded only once, however many times it is framed or sent.
     """
-    payload = ''
-    msg = str(MSG_TYPES[data['type']])
-
-    if msg in ['0', '1']:
-        # '1::' [path] [query]
-        msg += '::' + data['endpoint']
-        if 'qs' in data and data['qs'] != '':
-            msg += ':' + data['qs']
-
-    elif msg == '2':
-        # heartbeat
-        msg += '::'
-
-    elif msg in ['3', '4', '5']:
-        # '3:' [id ('+')] ':' [endpoint] ':' [data]
-        # '4:' [id ('+')] ':' [endpoint] ':' [json]
-        # '5:' [id ('+')] ':' [endpoint] ':' [json encoded event]
-        # The message id is an incremental integer, required for ACKs.
-        # If the message id is followed by a +, the ACK is not handled by
-        # socket.io, but by the user instead.
-        if msg == '3':
-            payload = data['data']
-        if msg == '4':
-            payload = json_dumps(data['data'])
-        if msg == '5':
-            d = {}
-            d['name'] = data['name']
-            if 'args' in data and data['args'] != []:
-                d['args'] = data['args']
-            payload = json_dumps(d)
-        if 'id' in data:
-            msg += ':' + str(data['id'])
-            if data['ack'] == 'data':
-                msg += '+'
-            msg += ':'
-        else:
-            msg += '::'
-        if 'endpoint' not in data:
-            data['endpoint'] = ''
-        if payload != '':
-            msg += data['endpoint'] + ':' + payload
-        else:
-            msg += data['endpoint']
 
-    elif msg == '6':
-        # '6:::' [id] '+' [data]
-        msg += '::' + data.get('endpoint', '') + ':' + str(data['ackId'])
-        if 'args' in data and data['args'] != []:
-            msg += '+' + json_dumps(data['args'])
+    def __new__(cls, text):
+        self = bytes.__new__(cls, text.encode('utf-8'))
+        self.length = frame_length(text, len(self))
+        return self
+
+
+def frame_length(text, size=None):
+    """Return the length of ``text`` in UTF-16 code units.  ``size`` is
+    the length of its UTF-8 encoding, if known: when it matches, the text
+    is ASCII and nothing needs to be encoded."""
+    if size == len(text):
+        return size
+    return len(text.encode('utf-16-le')) // 2
+
+
+class PingFrame(bytes):
+    """A websocket ping, queued by the :class:`~socketio.virtsocket.Socket`
+    instead of a heartbeat packet when the transport asked for it (see the
+    ``websocket_ping`` server option).  It holds the time it was queued,
+    which the client sends back in its pong."""
+
+    __slots__ = ()
+
+
+def _prefix(msg_type, endpoint):
+    """Return the '5::/endpoint' part of a frame that has no message id,
+    building it only once for each type and endpoint."""
+    key = (msg_type, endpoint)
+    try:
+        return _prefixes[key]
+    except KeyError:
+        pass
+    if len(_prefixes) >= _MAX_PREFIXES:
+        # Endpoints are usually a handful of constants, but nothing
+        # prevents an app from generating them.  Don't grow forever.
+        _prefixes.clear()
+    prefix = _prefixes[key] = str(MSG_TYPES[msg_type]) + '::' + endpoint
+    return prefix
+
+
+def _encode_connect(data, json_dumps):
+    # '1::' [path] [query]
+    msg = _prefix(data['type'], data['endpoint'])
+    qs = data.get('qs')
+    if qs:
+        msg += ':' + qs
+    return msg
+
 
-    elif msg == '7':
-        # '7::' [endpoint] ':' [reason] '+' [advice]
-        msg += ':::'
-        if 'reason' in data and data['reason'] != '':
-            msg += str(ERROR_REASONS[data['reason']])
-        if 'advice' in data and data['advice'] != '':
-            msg += '+' + str(ERROR_ADVICES[data['advice']])
-        msg += data['endpoint']
+def _encode_heartbeat(data, json_dumps):
+    return '2::'
 
+
+def _encode_noop(data, json_dumps):
     # NoOp, used to close a poll after the polling duration time
-    elif msg == '8':
-        msg += '::'
+    return '8::'
+
+
+def _encode_message(data, json_dumps):
+    # '3:' [id ('+')] ':' [endpoint] ':' [data]
+    # '4:' [id ('+')] ':' [endpoint] ':' [json]
+    # '5:' [id ('+')] ':' [endpoint] ':' [json encoded event]
+    # The message id is an incremental integer, required for ACKs.
+    # If the message id is followed by a +, the ACK is not handled by
+    # socket.io, but by the user instead.
+    msg_type = data['type']
+    if msg_type == 'event':
+        d = {'name': data['name']}
+        if 'args' in data and data['args'] != []:
+            d['args'] = data['args']
+        payload = json_dumps(d)
+    elif msg_type == 'json':
+        payload = json_dumps(data['data'])
+    else:
+        payload = data['data']
+    endpoint = data.get('endpoint', '')
+    if 'id' in data:
+        msg = '%d:%s%s:%s' % (MSG_TYPES[msg_type], data['id'],
+                              '+' if data['ack'] == 'data' else '',
+                              endpoint)
+    else:
+        msg = _prefix(msg_type, endpoint)
+    if payload != '':
+        return msg + ':' + payload
+    return msg
+
 
+def _encode_ack(data, json_dumps):
+    # '6:::' [id] '+' [data]
+    msg = _prefix('ack', data.get('endpoint', '')) + ':' + str(data['ackId'])
+    if 'args' in data and data['args'] != []:
+        msg += '+' + json_dumps(data['args'])
     return msg
 
 
-def decode(rawstr, json_loads=default_json_loads):
+def _encode_error(data, json_dumps):
+    # '7::' [endpoint] ':' [reason] '+' [advice]
+    msg = '7:::'
+    if 'reason' in data and data['reason'] != '':
+        msg += str(ERROR_REASONS[data['reason']])
+    if 'advice' in data and data['advice'] != '':
+        msg += '+' + str(ERROR_ADVICES[data['advice']])
+    return msg + data['endpoint']
+
+
+_ENCODERS = {
+    'disconnect': _encode_connect,
+    'connect': _encode_connect,
+    'heartbeat': _encode_heartbeat,
+    'message': _encode_message,
+    'json': _encode_message,
+    'event': _encode_message,
+    'ack': _encode_ack,
+    'error': _encode_error,
+    'noop': _encode_noop,
+    }
+
+
+def encode(data, json_dumps=default_json_dumps):
     """
-    Decode a rawstr packet arriving from the socket into a dict.
+    Encode an attribute dict into a byte string.
     """
-    decoded_msg = {}
     try:
-        # Handle decoding in Python<3.
-        rawstr = rawstr.decode('utf-8')
-    except AttributeError:
-        pass
-    split_data = rawstr.split(":", 3)
-    msg_type = split_data[0]
-    msg_id = split_data[1]
-    endpoint = split_data[2]
+        encoder = _ENCODERS[data['type']]
+    except KeyError:
+        # Unknown types raise a KeyError, like they always did
+        return str(MSG_TYPES[data['type']])
+    return encoder(data, json_dumps)
 
-    data = ''
 
-    if msg_id != '':
-        if "+" in msg_id:
-            msg_id = msg_id.split('+')[0]
-            decoded_msg['id'] = int(msg_id)
-            decoded_msg['ack'] = 'data'
-        else:
-            decoded_msg['id'] = int(msg_id)
-            decoded_msg['ack'] = True
+def _decode_connect(decoded_msg, data, json_loads):
+    decoded_msg['qs'] = data
 
-    # common to every message
-    msg_type_id = int(msg_type)
-    if msg_type_id in MSG_VALUES:
-        decoded_msg['type'] = MSG_VALUES[int(msg_type)]
-    else:
-        raise Exception("Unknown message type: %s" % msg_type)
 
-    decoded_msg['endpoint'] = endpoint
+def _decode_message(decoded_msg, data, json_loads):
+    decoded_msg['data'] = data
 
-    if len(split_data) > 3:
-        data = split_data[3]
 
-    if msg_type == "0":  # disconnect
-        pass
+def _decode_json(decoded_msg, data, json_loads):
+    decoded_msg['data'] = json_loads(data)
 
-    elif msg_type == "1":  # connect
-        decoded_msg['qs'] = data
 
-    elif msg_type == "2":  # heartbeat
-        pass
+def _decode_event(decoded_msg, data, json_loads):
+    try:
+        data = json_loads(data)
+    except ValueError:
+        print("Invalid JSON event message", data)
+        decoded_msg['args'] = []
+    else:
+        decoded_msg['name'] = data.pop('name')
+        decoded_msg['args'] = data.get('args', [])
+
+
+def _loading_args(method):
+    """Wrap a dict ``method`` of :class:`EventPacket` so that it sees the
+    ``args``, parsing them first if needed."""
+    def wrapper(self, *args):
+        if self._data is not None:
+            self._load_args()
+        return method(self, *args)
+    wrapper.__name__ = method.__name__
+    return wrapper
+
+
+class EventPacket(Packet):
+    """A decoded 'event' packet whose ``args`` are parsed on first
+    access.
+
+    This is what :func:`decode` returns for events with ``lazy_args``, so
+    that events rejected by name, by the ACLs or for lack of a handler
+    never pay for parsing their arguments.  ``args_pending`` tells if
+    they were parsed yet.  Anything that looks at the whole dict, like
+    ``json.dumps()``, iterating or comparing, parses them too.  Encoders
+    that read the dict directly, like ``orjson``, don't: give them
+    :meth:`to_dict` instead.
+    """
+
+    __slots__ = ('_raw_args', '_data', '_json_loads')
+
+    def __init__(self, *args, **kwargs):
+        self._raw_args = None  # the JSON text of the args list
+        self._data = None  # the whole JSON event, as a fallback
+        self._json_loads = None
+        Packet.__init__(self, *args, **kwargs)
+
+    @property
+    def args_pending(self):
+        return self._data is not None
+
+    def __missing__(self, key):
+        # Only called when the key isn't set
+        if key == 'args' and self._data is not None:
+            self._load_args()
+            return self['args']
+        raise KeyError(key)
+
+    __contains__ = _loading_args(dict.__contains__)
+    __iter__ = _loading_args(dict.__iter__)
+    __len__ = _loading_args(dict.__len__)
+    __eq__ = _loading_args(dict.__eq__)
+    __ne__ = _loading_args(dict.__ne__)
+    __repr__ = _loading_args(Packet.__repr__)
+    get = _loading_args(dict.get)
+    keys = _loading_args(dict.keys)
+    values = _loading_args(dict.values)
+    items = _loading_args(dict.items)
+    pop = _loading_args(dict.pop)
+    copy = _loading_args(Packet.copy)
+    to_dict = _loading_args(Packet.to_dict)
+
+    def _load_args(self):
+        data, self._data = self._data, None
+        try:
+            args = self._json_loads(self._raw_args)
+        except ValueError:
+            # Some other key comes after "args", parse the whole event
+            try:
+                args = self._json_loads(data).get('args', [])
+            except ValueError:
+                print("Invalid JSON event message", data)
+                args = []
+        self['args'] = args
+        self._raw_args = self._json_loads = None
 
-    elif msg_type == "3":  # message
-        decoded_msg['data'] = data
 
-    elif msg_type == "4":  # json msg
-        decoded_msg['data'] = json_loads(data)
+_EVENT_NAME_PREFIX = '{"name":'
+_EVENT_ARGS_PREFIX = ',"args":'
 
-    elif msg_type == "5":  # event
+
+def _decode_event_lazily(decoded_msg, data, json_loads):
+    """Extract only the event name, when the client put it first, as the
+    Socket.IO client does: '{"name":"my_event","args":[...]}'."""
+    if data.startswith(_EVENT_NAME_PREFIX + '"'):
         try:
-            data = json_loads(data)
+            name, end = scanstring(data, len(_EVENT_NAME_PREFIX) + 1)
         except ValueError:
-            print("Invalid JSON event message", data)
-            decoded_msg['args'] = []
-        else:
-            decoded_msg['name'] = data.pop('name')
-            if 'args' in data:
-                decoded_msg['args'] = data['args']
-            else:
+            name = None
+        if name is not None:
+            if data[end:] == '}':
+                decoded_msg['name'] = name
                 decoded_msg['args'] = []
+                return
+            if data.startswith(_EVENT_ARGS_PREFIX, end) \
+                    and data[-1] == '}':
+                decoded_msg['name'] = name
+                decoded_msg._raw_args = data[end + len(_EVENT_ARGS_PREFIX):-1]
+                decoded_msg._json_loads = json_loads
+                decoded_msg._data = data
+                return
+    _decode_event(decoded_msg, data, json_loads)
+
+
+def _decode_ack(decoded_msg, data, json_loads):
+    if '+' in data:
+        ackId, data = data.split('+', 1)
+        decoded_msg['ackId'] = int(ackId)
+        decoded_msg['args'] = json_loads(data)
+    else:
+        decoded_msg['ackId'] = int(data)
+        decoded_msg['args'] = []
 
-    elif msg_type == "6":  # ack
-        if '+' in data:
-            ackId, data = data.split('+')
-            decoded_msg['ackId'] = int(ackId)
-            decoded_msg['args'] = json_loads(data)
-        else:
-            decoded_msg['ackId'] = int(data)
-            decoded_msg['args'] = []
-
-    elif msg_type == "7":  # error
-        if '+' in data:
-            reason, advice = data.split('+')
-            decoded_msg['reason'] = REASONS_VALUES[int(reason)]
-            decoded_msg['advice'] = ADVICES_VALUES[int(advice)]
+
+def _decode_error(decoded_msg, data, json_loads):
+    if '+' in data:
+        reason, advice = data.split('+')
+        decoded_msg['reason'] = REASONS_VALUES[int(reason)]
+        decoded_msg['advice'] = ADVICES_VALUES[int(advice)]
+    else:
+        decoded_msg['advice'] = ''
+        if data != '':
+            decoded_msg['reason'] = REASONS_VALUES[int(data)]
         else:
-            decoded_msg['advice'] = ''
-            if data != '':
-                decoded_msg['reason'] = REASONS_VALUES[int(data)]
-            else:
-                decoded_msg['reason'] = ''
+            decoded_msg['reason'] = ''
 
-    elif msg_type == "8":  # noop
-        pass
 
+def _decode_id(decoded_msg, msg_id):
+    if '+' in msg_id:
+        decoded_msg['id'] = int(msg_id.split('+')[0])
+        decoded_msg['ack'] = 'data'
+    else:
+        decoded_msg['id'] = int(msg_id)
+        decoded_msg['ack'] = True
+
+
+def _decode_nothing(decoded_msg, data, json_loads):
+    pass
+
+
+# By raw message type: (type name, decoder of the data part)
+_DECODERS = {
+    '0': ('disconnect', _decode_nothing),
+    '1': ('connect', _decode_connect),
+    '2': ('heartbeat', _decode_nothing),
+    '3': ('message', _decode_message),
+    '4': ('json', _decode_json),
+    '5': ('event', _decode_event),
+    '6': ('ack', _decode_ack),
+    '7': ('error', _decode_error),
+    '8': ('noop', _decode_nothing),
+    }
+
+
+def decode(rawstr, json_loads=default_json_loads, lazy_args=False):
+    """
+    Decode a rawstr packet arriving from the socket into a dict.
+
+    With ``lazy_args``, 'event' packets are decoded as an
+    :class:`EventPacket`, that parses its ``args`` on first access.
+    """
+    if isinstance(rawstr, bytes):
+        rawstr = rawstr.decode('utf-8')
+
+    control = CONTROL_FRAMES.get(rawstr)
+    if control is not None:
+        return {'type': control, 'endpoint': ''}
+
+    split_data = rawstr.split(":", 3)
+    msg_type = split_data[0]
+    msg_id = split_data[1]
+    endpoint = split_data[2]
+
+    try:
+        type_name, decoder = _DECODERS[msg_type]
+    except KeyError:
+        # Not a canonical type, like '05'
+        msg_type_id = int(msg_type)
+        if msg_type_id not in MSG_VALUES:
+            raise Exception("Unknown message type: %s" % msg_type)
+        type_name, decoder = MSG_VALUES[msg_type_id], _decode_nothing
+
+    if lazy_args and decoder is _decode_event:
+        decoded_msg = EventPacket(type=type_name, endpoint=endpoint)
+        decoder = _decode_event_lazily
+    else:
+        decoded_msg = {'type': type_name, 'endpoint': endpoint}
+    if msg_id != '':
+        _decode_id(decoded_msg, msg_id)
+
+    decoder(decoded_msg, split_data[3] if len(split_data) > 3 else '',
+            json_loads)
     return decoded_msg
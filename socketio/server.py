@@ -1,14 +1,18 @@
 import sys
 import traceback
+import warnings
 
 from socket import error
 
 from gevent.pywsgi import WSGIServer
 
+from socketio import binary
+from socketio.defaultjson import get_backend
 from socketio.handler import SocketIOHandler
 from socketio.policyserver import FlashPolicyServer
 from socketio.virtsocket import Socket
-from geventwebsocket.handler import WebSocketHandler
+from socketio.timerwheel import TimerWheel
+from socketio.clientqueue import POLICIES
 
 __all__ = ['SocketIOServer']
 
@@ -43,6 +47,11 @@ class SocketIOServer(WSGIServer):
             it should send a new heartbeat to the server. This value
             is sent to the client after a successful handshake.
 
+        :param heartbeat_jitter: float Fraction of the
+            ``heartbeat_interval`` by which each heartbeat may randomly be
+            sent early, so that sockets connected at the same time do not
+            all beat together.  Defaults to 0.1.
+
         :param close_timeout: int The timeout for the client, when it
             closes the connection it still X amounts of seconds to do
             re open of the connection. This value is sent to the
@@ -52,8 +61,136 @@ class SocketIOServer(WSGIServer):
             server to write its access log.  If not specified, it
             is sent to `stderr` (with gevent 0.13).
 
+        :param client_queue_max_messages: int Maximum number of messages
+            waiting to be sent to each client.  Unbounded by default.
+
+        :param client_queue_max_bytes: int Maximum size of the messages
+            waiting to be sent to each client.  Unbounded by default.
+
+        :param client_queue_policy: str What to do when a message doesn't
+            fit in a client's queue: ``drop-oldest`` (the default),
+            ``drop-newest`` or ``disconnect``.  See
+            :mod:`socketio.clientqueue`.
+
+        :param handler_pool_size: int When set, the packets received on a
+            socket are processed by up to that many greenlets at a time,
+            so that a slow ``on_*`` handler doesn't hold back the other
+            namespaces.  By default, they are processed one at a time.
+
+        :param handler_ordering: str With a ``handler_pool_size``, packets
+            are processed in order per namespace (``namespace``, the
+            default), or per namespace and event name (``event``).
+
+        :param ack_timeout: float Number of seconds after which the
+            callbacks passed to ``emit()`` and ``send()`` are forgotten if
+            the client didn't ack.  By default, they are kept until the
+            socket is closed.
+
+        :param max_pending_acks: int Maximum number of callbacks waiting
+            for an ack on each socket.  The oldest ones are forgotten
+            first.  Unbounded by default.
+
+        :param lazy_event_args: bool Parse the arguments of the incoming
+            events only when the handler is called, so that events
+            rejected by name, by the ACLs or for lack of a handler don't
+            cost any JSON parsing.  The packets handed to the Namespaces
+            are then :class:`~socketio.packet.EventPacket` objects.
+            Defaults to False.
+
+        :param binary_codecs: list Names of the binary codecs the clients
+            may ask for when connecting with the websocket transport, like
+            ``['msgpack']``.  See :mod:`socketio.binary`.  None are allowed
+            by default.
+
+        :param json_backend: str Name of the JSON backend of the sockets,
+            like ``'fast'``, which doesn't sort the keys and uses the
+            fastest encoder installed.  See :mod:`socketio.defaultjson`.
+            The ``json_loads`` and ``json_dumps`` arguments of
+            :func:`~socketio.socketio_manage` override it.
+
+        :param websocket_batch_max_messages: int Maximum number of queued
+            messages sent to a websocket client with a single write.
+            Defaults to 64.
+
+        :param websocket_batch_max_bytes: int Maximum size of the messages
+            sent to a websocket client with a single write, in bytes.  A
+            larger message is still sent, alone.  Defaults to 65536.
+
+        :param websocket_linger: float Number of seconds to wait for more
+            messages once the client queue of a websocket is empty, before
+            writing them.  Trades a little latency for fewer writes during
+            bursts.  Defaults to 0 (write right away).
+
+        :param polling_linger: float Number of seconds a polling request
+            waits for more messages once one is available, so that a
+            trickle of messages doesn't cost a round trip each.  Defaults
+            to 0 (respond right away).
+
+        :param polling_batch_max_messages: int Maximum number of messages
+            in the response to a polling request.  The others wait for the
+            next request.  Unlimited by default.
+
+        :param polling_batch_max_bytes: int Maximum size of the messages in
+            the response to a polling request, in bytes, not counting the
+            payload framing.  A larger message is still sent, alone.
+            Unlimited by default.
+
+        :param websocket_pump: bool Use a single greenlet per websocket,
+            that both sends and receives, and hands the received packets
+            to the Namespaces directly, instead of three greenlets and a
+            queue.  The handlers then hold up the messages sent to their
+            client, so they shouldn't block (see ``handler_pool_size``).
+            Defaults to False.
+
+        :param websocket_ping: bool Check that the websocket clients are
+            alive with websocket pings, rather than with heartbeat
+            packets.  The pongs reset the heartbeat timeout, and give the
+            round-trip time (``Socket.rtt``).  The polling transports still
+            use heartbeat packets.  Browsers answer the pings themselves,
+            without telling the socket.io client, so a heartbeat packet is
+            still sent when the client would otherwise reach its
+            ``heartbeat_timeout``.  Defaults to False.
+
+        :param websocket_deflate: bool Compress the websocket messages
+            with permessage-deflate, for the clients that offer it.  See
+            :mod:`socketio.deflate`.  Defaults to False.
+
+        :param websocket_deflate_context_takeover: bool Compress each
+            message with the previous ones as the dictionary, which
+            compresses better, but keeps a compressor and a decompressor
+            per websocket.  Defaults to True.
+
+        :param websocket_deflate_min_size: int Size, in bytes, under which
+            the messages are sent uncompressed.  Defaults to 256.
+
+        :param websocket_max_message_size: int Size, in bytes, beyond which
+            the compressed messages received are rejected once inflated,
+            closing the websocket.  Defaults to 1048576 (1MB).
+
+        :param timer_resolution: float The tick duration, in seconds, of
+            the timer wheel that drives the heartbeats and heartbeat
+            timeouts of all the sockets.  Defaults to 1 second.
+
+        :param ws_handler_class: Deprecated, and ignored: the
+            :class:`~socketio.handler.SocketIOHandler` upgrades the
+            websockets itself.  Passing it raises a
+            :exc:`DeprecationWarning`.
+
         """
         self.sockets = {}
+        #: Room index, mapping the room names to the set of
+        #: :class:`~socketio.virtsocket.Socket` objects in there.  It is
+        #: maintained by :meth:`~socketio.virtsocket.Socket.join_room` and
+        #: :meth:`~socketio.virtsocket.Socket.leave_room`.
+        self.rooms = {}
+        #: Endpoint index, mapping the namespace names ('/chat') to the set
+        #: of sockets on which that Namespace is active.  This is what
+        #: :class:`~socketio.mixins.BroadcastMixin` uses.
+        self.endpoints = {}
+        #: Counters, like the number of messages dropped from the
+        #: clients' queues for each policy, or the number of acks that
+        #: expired.
+        self.metrics = {}
         if 'namespace' in kwargs:
             print("DEPRECATION WARNING: use resource instead of namespace")
             self.resource = kwargs.pop('namespace', 'socket.io')
@@ -80,19 +217,88 @@ class SocketIOServer(WSGIServer):
             'heartbeat_timeout': 60,
             'close_timeout': 60,
             'heartbeat_interval': 25,
+            'heartbeat_jitter': 0.1,
         }
         for f in ('heartbeat_timeout', 'heartbeat_interval', 'close_timeout'):
             if f in kwargs:
                 self.config[f] = int(kwargs.pop(f))
+        if 'heartbeat_jitter' in kwargs:
+            self.config['heartbeat_jitter'] = float(
+                kwargs.pop('heartbeat_jitter'))
+        for f in ('client_queue_max_messages', 'client_queue_max_bytes'):
+            value = kwargs.pop(f, None)
+            if value is not None:
+                self.config[f] = int(value)
+        policy = kwargs.pop('client_queue_policy', 'drop-oldest')
+        if policy not in POLICIES:
+            raise ValueError("client_queue_policy should be one of: %s" %
+                             (POLICIES, ))
+        self.config['client_queue_policy'] = policy
+        self.config['handler_pool_size'] = int(
+            kwargs.pop('handler_pool_size', 0) or 0)
+        ordering = kwargs.pop('handler_ordering', 'namespace')
+        if ordering not in ('namespace', 'event'):
+            raise ValueError("handler_ordering should be 'namespace' or "
+                             "'event'")
+        self.config['handler_ordering'] = ordering
+        ack_timeout = kwargs.pop('ack_timeout', None)
+        if ack_timeout is not None:
+            self.config['ack_timeout'] = float(ack_timeout)
+        max_pending_acks = kwargs.pop('max_pending_acks', None)
+        if max_pending_acks is not None:
+            self.config['max_pending_acks'] = int(max_pending_acks)
+        self.config['lazy_event_args'] = bool(
+            kwargs.pop('lazy_event_args', False))
+        self.config['binary_codecs'] = tuple(kwargs.pop('binary_codecs', ()))
+        json_backend = kwargs.pop('json_backend', None)
+        if json_backend is not None:
+            get_backend(json_backend)  # raises ValueError if unknown
+            self.config['json_backend'] = json_backend
+        self.config['websocket_batch_max_messages'] = int(
+            kwargs.pop('websocket_batch_max_messages', 64))
+        self.config['websocket_batch_max_bytes'] = int(
+            kwargs.pop('websocket_batch_max_bytes', 65536))
+        self.config['websocket_linger'] = float(
+            kwargs.pop('websocket_linger', 0))
+        self.config['websocket_pump'] = bool(
+            kwargs.pop('websocket_pump', False))
+        self.config['websocket_ping'] = bool(
+            kwargs.pop('websocket_ping', False))
+        self.config['websocket_deflate'] = bool(
+            kwargs.pop('websocket_deflate', False))
+        self.config['websocket_deflate_context_takeover'] = bool(
+            kwargs.pop('websocket_deflate_context_takeover', True))
+        self.config['websocket_deflate_min_size'] = int(
+            kwargs.pop('websocket_deflate_min_size', 256))
+        self.config['websocket_max_message_size'] = int(
+            kwargs.pop('websocket_max_message_size', 1048576))
+        self.config['polling_linger'] = float(
+            kwargs.pop('polling_linger', 0))
+        for f in ('polling_batch_max_messages', 'polling_batch_max_bytes'):
+            value = kwargs.pop(f, None)
+            if value is not None:
+                self.config[f] = int(value)
+        for name in self.config['binary_codecs']:
+            if binary.get_codec(name) is None:
+                raise ValueError("Unknown binary codec: %s" % name)
 
         if not 'handler_class' in kwargs:
             kwargs['handler_class'] = SocketIOHandler
 
 
-        if not 'ws_handler_class' in kwargs:
-            self.ws_handler_class = WebSocketHandler
-        else:
-            self.ws_handler_class = kwargs.pop('ws_handler_class')
+        # Not used anymore: the SocketIOHandler upgrades the websockets
+        # itself (see SocketIOHandler.upgrade_websocket)
+        self.ws_handler_class = kwargs.pop('ws_handler_class', None)
+        if self.ws_handler_class is not None:
+            warnings.warn("The ws_handler_class option is ignored: "
+                          "SocketIOHandler upgrades the websockets itself, "
+                          "see SocketIOHandler.upgrade_websocket",
+                          DeprecationWarning, stacklevel=2)
+
+        #: Drives the heartbeats and timeouts of all the sockets, from a
+        #: single greenlet.
+        self.timer_wheel = TimerWheel(
+            resolution=float(kwargs.pop('timer_resolution', 1.0)))
 
         log_file = kwargs.pop('log_file', None)
         if log_file:
@@ -116,6 +322,7 @@ class SocketIOServer(WSGIServer):
     def stop(self, timeout=None):
         if self.policy_server is not None:
             self.policy_server.stop()
+        self.timer_wheel.stop()
         super(SocketIOServer, self).stop(timeout=timeout)
 
     def handle(self, socket, address):
@@ -138,6 +345,25 @@ class SocketIOServer(WSGIServer):
 
         return socket
 
+    def room_count(self, room_name):
+        """Return the number of sockets in the room ``room_name``."""
+        return len(self.rooms.get(room_name, ()))
+
+    def room_sockets(self, room_name):
+        """Iterate over the sockets in the room ``room_name``."""
+        return iter(list(self.rooms.get(room_name, ())))
+
+    def endpoint_count(self, ns_name):
+        """Return the number of sockets with the ``ns_name`` Namespace
+        active."""
+        return len(self.endpoints.get(ns_name, ()))
+
+    def iter_rooms(self):
+        """Iterate over ``(room_name, member_count)`` for every room that
+        currently has members."""
+        for room_name, members in list(self.rooms.items()):
+            yield room_name, len(members)
+
 
 def serve(app, **kw):
     _quiet = kw.pop('_quiet', False)
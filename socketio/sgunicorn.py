@@ -7,31 +7,24 @@ from gevent.server import StreamServer
 
 from gunicorn.workers.ggevent import GeventPyWSGIWorker
 from gunicorn.workers.ggevent import PyWSGIHandler
-from gunicorn.workers.ggevent import GeventResponse
 from gunicorn import version_info as gunicorn_version
 from socketio.server import SocketIOServer
 from socketio.handler import SocketIOHandler
 
-from geventwebsocket.handler import WebSocketHandler
-
-from datetime import datetime
 from functools import partial
 
 
 class GunicornWSGIHandler(PyWSGIHandler, SocketIOHandler):
-    pass
-
 
-class GunicornWebSocketWSGIHandler(WebSocketHandler):
-    def log_request(self):
-            start = datetime.fromtimestamp(self.time_start)
-            finish = datetime.fromtimestamp(self.time_finish)
-            response_time = finish - start
-            resp = GeventResponse(self.status, [],
-                                  self.response_length)
-            req_headers = [h.split(":", 1) for h in self.headers.headers]
-            self.server.log.access(
-                resp, req_headers, self.environ, response_time)
+    def upgrade_websocket(self):
+        # The websocket outlives the request, log the handshake to the
+        # gunicorn access log once it is done.
+        self.time_start = time.time()
+        connection = super(GunicornWSGIHandler, self).upgrade_websocket()
+        if connection is not None:
+            self.time_finish = time.time()
+            self.log_request()
+        return connection
 
 
 class GeventSocketIOBaseWorker(GeventPyWSGIWorker):
@@ -76,7 +69,6 @@ class GeventSocketIOBaseWorker(GeventPyWSGIWorker):
                         log=self.log,
                         policy_server=self.policy_server,
                         handler_class=self.wsgi_handler,
-                        ws_handler_class=self.ws_wsgi_handler,
                         **ssl_args
                     )
                 else:
@@ -139,7 +131,6 @@ class GeventSocketIOBaseWorker(GeventPyWSGIWorker):
                 log=self.log,
                 policy_server=self.policy_server,
                 handler_class=self.wsgi_handler,
-                ws_handler_class=self.ws_wsgi_handler,
             )
 
             server.start()
@@ -188,7 +179,6 @@ class GeventSocketIOWorker(GeventSocketIOBaseWorker):
     """
     server_class = SocketIOServer
     wsgi_handler = GunicornWSGIHandler
-    ws_wsgi_handler = GunicornWebSocketWSGIHandler
     # We need to define a namespace for the server, it would be nice if this
     # was a configuration option, will probably end up how this implemented,
     # for now this is just a proof of concept to make sure this will work
@@ -0,0 +1,178 @@
+"""Hierarchical timer wheel, used by the server to drive the heartbeats,
+heartbeat timeouts and clean-ups of all the sockets from a single
+greenlet.
+
+Spawning a couple of sleeping greenlets per socket does not scale well
+when you have tens of thousands of sessions: every one of them wakes up
+the hub on its own schedule.  The :class:`TimerWheel` keeps all the
+timers in buckets, and one greenlet advances the wheel at a fixed
+``resolution``, firing whatever timers are due.
+
+Callbacks are run *inside* the wheel's greenlet, so they must be quick
+and must not block.  Spawn a greenlet from your callback if you need to
+do some real work.
+"""
+import time
+import logging
+
+import gevent
+
+
+log = logging.getLogger(__name__)
+
+
+class Timer(object):
+    """A scheduled call, as returned by :meth:`TimerWheel.schedule`."""
+
+    __slots__ = ('wheel', 'deadline', 'callback', 'args')
+
+    def __init__(self, wheel, deadline, callback, args):
+        self.wheel = wheel
+        self.deadline = deadline  # in ticks
+        self.callback = callback
+        self.args = args
+
+    @property
+    def active(self):
+        """Whether the timer is still waiting to be fired."""
+        return self.callback is not None
+
+    def cancel(self):
+        """Prevent this timer from firing.  Cancelling a timer that already
+        fired (or was already cancelled) does nothing."""
+        if self.callback is not None:
+            self.callback = self.args = None
+            self.wheel._count -= 1
+
+
+class TimerWheel(object):
+    """Hierarchical timer wheel.
+
+    Level 0 has ``slots`` buckets of one tick each, level 1 has ``slots``
+    buckets of ``slots`` ticks each, and so on.  Timers are put in the
+    coarsest level that fits their deadline, and are cascaded down to the
+    finer levels as the wheel turns, so scheduling and firing a timer
+    costs O(1), whatever the number of timers.
+
+    :param resolution: duration of a tick, in seconds.  Timers never fire
+                       early, but may fire up to one tick late.
+    :param slots: number of buckets per level.
+    :param levels: number of levels.  With the defaults (1 second, 64
+                   slots, 4 levels), the wheel spans about 194 days.
+                   Timers further away than that are parked in the last
+                   level and re-cascaded until they are due.
+    """
+
+    def __init__(self, resolution=1.0, slots=64, levels=4):
+        self.resolution = float(resolution)
+        self.slots = slots
+        self.wheels = [[[] for i in range(slots)] for j in range(levels)]
+        self.current_tick = 0
+        self._epoch = time.time()
+        self._count = 0
+        self._greenlet = None
+
+    def __len__(self):
+        """Number of active timers."""
+        return self._count
+
+    def schedule(self, delay, callback, *args):
+        """Call ``callback(*args)`` in ``delay`` seconds.
+
+        Returns a :class:`Timer` object, that you can ``cancel()``.
+        """
+        now = self._now()
+        if self._greenlet is None:
+            if not self._count:
+                # Nothing is pending, skip the ticks we missed while idle
+                self.current_tick = int(now / self.resolution)
+            self._greenlet = gevent.spawn(self._run)
+        # Count from the current time, not from current_tick: we may be up
+        # to a tick past it, and the timer would then fire that much early.
+        deadline = int(-(-(now + delay) // self.resolution))
+        timer = Timer(self, max(deadline, self.current_tick + 1), callback,
+                      args)
+        self._count += 1
+        self._insert(timer)
+        return timer
+
+    def stop(self):
+        """Stop turning the wheel.  Pending timers will not fire unless
+        something else gets scheduled."""
+        if self._greenlet is not None:
+            self._greenlet.kill(block=False)
+            self._greenlet = None
+
+    def _now(self):
+        """Seconds elapsed since the wheel was created."""
+        return time.time() - self._epoch
+
+    def _now_tick(self):
+        return int(self._now() / self.resolution)
+
+    def _insert(self, timer):
+        delta = timer.deadline - self.current_tick
+        span = self.slots
+        level = 0
+        last_level = len(self.wheels) - 1
+        while delta >= span and level < last_level:
+            level += 1
+            span *= self.slots
+        index = (timer.deadline // (span // self.slots)) % self.slots
+        self.wheels[level][index].append(timer)
+
+    def _tick(self):
+        """Advance the wheel by one tick, cascading the coarser levels down
+        when the finer ones wrap around, then fire the due timers."""
+        self.current_tick += 1
+        tick = self.current_tick
+
+        # Find which levels wrapped around, coarsest first, so that timers
+        # cascaded from a level can be cascaded again from the next one.
+        span = 1
+        to_cascade = []
+        for level in range(1, len(self.wheels)):
+            span *= self.slots
+            if tick % span:
+                break
+            to_cascade.append((level, (tick // span) % self.slots))
+        for level, index in reversed(to_cascade):
+            bucket = self.wheels[level][index]
+            self.wheels[level][index] = []
+            for timer in bucket:
+                if timer.callback is not None:
+                    self._insert(timer)
+
+        index = tick % self.slots
+        bucket = self.wheels[0][index]
+        if not bucket:
+            return
+        self.wheels[0][index] = []
+        for timer in bucket:
+            callback = timer.callback
+            if callback is None:
+                continue
+            if timer.deadline > tick:
+                # Parked beyond the span of the wheel, not due yet
+                self._insert(timer)
+                continue
+            args = timer.args
+            timer.cancel()
+            try:
+                callback(*args)
+            except Exception:
+                log.exception("Error in timer callback %r" % callback)
+
+    def _advance(self, tick):
+        while self.current_tick < tick:
+            self._tick()
+
+    def _run(self):
+        try:
+            while self._count:
+                self._advance(self._now_tick())
+                elapsed = self._now()
+                gevent.sleep(self.resolution - elapsed % self.resolution)
+        finally:
+            if self._greenlet is gevent.getcurrent():
+                self._greenlet = None
@@ -1,9 +1,23 @@
+import struct
+
 import gevent
 import six
-from six.moves.urllib.parse import parse_qs, unquote_plus
+from six.moves.urllib.parse import unquote_plus
+from socket import error as socket_error
 from geventwebsocket import WebSocketError
+from geventwebsocket.exceptions import FrameTooLargeException, \
+    ProtocolError
+from geventwebsocket.websocket import Header, MSG_ALREADY_CLOSED, \
+    MSG_SOCKET_DEAD
+from gevent.event import Event
 from gevent.queue import Empty
 
+from socketio import binary
+from socketio.packet import PingFrame, frame_length
+
+# U+FFFD, around the lengths of the frames of a polling payload
+_PAYLOAD_SEP = u'\ufffd'.encode('utf-8')
+
 
 class BaseTransport(object):
     """Base class for all transports. Mostly wraps handler class functions."""
@@ -26,18 +40,12 @@ class BaseTransport(object):
         self.handler = handler
         self.config = config
 
-    def write(self, data=""):
-        # Gevent v 0.13
-        if hasattr(self.handler, 'response_headers_list'):
-            if 'Content-Length' not in self.handler.response_headers_list:
-                self.handler.response_headers.append(('Content-Length', len(data)))
-                self.handler.response_headers_list.append('Content-Length')
-        elif not hasattr(self.handler, 'provided_content_length') or self.handler.provided_content_length is None:
-            # Gevent 1.0bX
-            l = len(data)
-            self.handler.provided_content_length = l
-            self.handler.response_headers.append(('Content-Length', l))
-
+    def write(self, data=b""):
+        """Write the body of the response.  Text is encoded to UTF-8, and
+        the handler sets the Content-Length to the length in bytes, so that
+        the HTTP connection can be kept alive for the next request."""
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
         self.handler.write_smart(data)
 
     def start_response(self, status, headers, **kwargs):
@@ -53,7 +61,7 @@ class XHRPollingTransport(BaseTransport):
         super(XHRPollingTransport, self).__init__(*args, **kwargs)
 
     def options(self):
-        self.start_response("200 OK", ())
+        self.start_response("200 OK", [])
         self.write()
         return []
 
@@ -69,14 +77,18 @@ class XHRPollingTransport(BaseTransport):
         self.write(payload)
 
     def _request_body(self):
-        return self.handler.wsgi_input.readline()
+        # Read the whole body, and nothing past it: the connection may be
+        # kept alive for the next request.
+        length = self.handler.environ.get('CONTENT_LENGTH')
+        if length:
+            return self.handler.wsgi_input.read(int(length))
+        return self.handler.wsgi_input.read()
 
     def post(self, socket):
         for message in self.decode_payload(self._request_body()):
             socket.put_server_msg(message)
 
         self.start_response("200 OK", [
-            ("Connection", "close"),
             ("Content-Type", "text/plain")
         ])
         self.write("1")
@@ -84,32 +96,51 @@ class XHRPollingTransport(BaseTransport):
     def get_messages_payload(self, socket, timeout=None):
         """This will fetch the messages from the Socket's queue, and if
         there are many messes, pack multiple messages in one payload and return
+
+        Once a message is available, waits ``polling_linger`` seconds for
+        more, and takes up to ``polling_batch_max_messages`` messages and
+        ``polling_batch_max_bytes`` bytes, as configured on the server.
         """
+        config = self.config
         try:
-            msgs = socket.get_multiple_client_msgs(timeout=timeout)
+            msgs = socket.get_multiple_client_msgs(
+                max_messages=config.get('polling_batch_max_messages'),
+                max_bytes=config.get('polling_batch_max_bytes'),
+                linger=config.get('polling_linger'),
+                timeout=timeout)
             data = self.encode_payload(msgs)
         except Empty:
             data = ""
         return data
 
     def encode_payload(self, messages):
-        """Encode list of messages. Expects messages to be unicode.
+        """Encode list of messages.  Expects messages to be UTF-8 encoded
+        :class:`~socketio.packet.Frame` objects, as queued by the Socket.
 
         ``messages`` - List of raw messages to encode, if necessary
 
         """
         if not messages or messages[0] is None:
-            return ''
+            return b''
 
         if len(messages) == 1:
-            return messages[0].encode('utf-8')
-
-        payload = u''.join([(u'\ufffd%d\ufffd%s' % (len(p), p))
-                            for p in messages if p is not None])
-        # FIXME: why is it so that we must filter None from here ?  How
-        #        is it even possible that a None gets in there ?
-
-        return payload.encode('utf-8')
+            return messages[0]
+
+        parts = []
+        for frame in messages:
+            if frame is None:
+                # FIXME: why is it so that we must filter None from here ?
+                #        How is it even possible that a None gets in there ?
+                continue
+            length = getattr(frame, 'length', None)
+            if length is None:
+                length = frame_length(frame.decode('utf-8'), len(frame))
+            # No bytes.__mod__ before Python 3.5
+            parts.append(_PAYLOAD_SEP)
+            parts.append(str(length).encode('ascii'))
+            parts.append(_PAYLOAD_SEP)
+            parts.append(frame)
+        return b''.join(parts)
 
     def decode_payload(self, payload):
         """This function can extract multiple messages from one HTTP payload.
@@ -125,27 +156,52 @@ class XHRPollingTransport(BaseTransport):
         one.
 
         Inspired by socket.io/lib/transports/http.js
+
+        Payloads are split on the separators when no message contains
+        one, which is the usual case.  Otherwise they are walked once, by
+        index, and a :exc:`ValueError` is raised as soon as a frame is
+        malformed.
         """
-        payload = payload.decode('utf-8')
-        if payload[0] == u"\ufffd":
-            ret = []
-            while len(payload) != 0:
-                len_end = payload.find(u"\ufffd", 1)
-                length = int(payload[1:len_end])
-                msg_start = len_end + 1
-                msg_end = length + msg_start
-                message = payload[msg_start:msg_end]
-                ret.append(message)
-                payload = payload[msg_end:]
-            return ret
-        return [payload]
+        if isinstance(payload, bytes):
+            payload = payload.decode('utf-8')
+        if not payload:
+            return []
+        if payload[0] != u"\ufffd":
+            return [payload]
+
+        parts = payload.split(u"\ufffd")
+        if len(parts) % 2:
+            messages = parts[2::2]
+            if parts[1::2] == [str(len(message)) for message in messages]:
+                return messages
+
+        ret = []
+        find = payload.find
+        pos = 0
+        end = len(payload)
+        while pos < end:
+            if payload[pos] != u"\ufffd":
+                raise ValueError("Invalid payload: no frame at %d" % pos)
+            # Lengths have at most 10 digits, don't look any further
+            len_end = find(u"\ufffd", pos + 1, pos + 12)
+            if len_end == -1:
+                raise ValueError("Invalid payload: bad length at %d" % pos)
+            length = payload[pos + 1:len_end]
+            if not length.isdigit():
+                raise ValueError("Invalid payload: bad length at %d" % pos)
+            msg_start = len_end + 1
+            msg_end = msg_start + int(length)
+            if msg_end > end:
+                raise ValueError("Invalid payload: truncated frame at %d" %
+                                 pos)
+            ret.append(payload[msg_start:msg_end])
+            pos = msg_end
+        return ret
 
     def do_exchange(self, socket, request_method):
         if not socket.connection_established:
             # Runs only the first time we get a Socket opening
-            self.start_response("200 OK", [
-                ("Connection", "close"),
-            ])
+            self.start_response("200 OK", [])
             self.write("1::")  # 'connect' packet
             return
         elif request_method in ("GET", "POST", "OPTIONS"):
@@ -175,11 +231,13 @@ class JSONPolling(XHRPollingTransport):
 
     def write(self, data):
         """Just quote out stuff before sending it out"""
-        args = parse_qs(self.handler.environ.get("QUERY_STRING"))
+        args = self.handler.socketio_request.query
         if "i" in args:
             i = args["i"]
         else:
             i = "0"
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
         # TODO: don't we need to quote this data in here ?
         super(JSONPolling, self).write("io.j[%s]('%s');" % (i, data))
 
@@ -236,25 +294,294 @@ class XHRMultipartTransport(XHRPollingTransport):
         socket.spawn(chunk)
 
 
+def send_text_frame(websocket, frame):
+    """Send ``frame``, already encoded to UTF-8, in a text frame.
+    ``WebSocket.send()`` would encode it again."""
+    send_frames(websocket, [frame])
+
+
+def send_frames(websocket, frames):
+    """Send the encoded ``frames`` with a single write to the socket, each
+    in its own websocket frame.
+
+    :class:`~socketio.binary.BinaryFrame` objects are sent in binary
+    frames, :class:`~socketio.packet.PingFrame` objects as pings, and
+    everything else in text frames.
+    """
+    if websocket.closed:
+        raise WebSocketError(MSG_ALREADY_CLOSED)
+    encode_header = Header.encode_header
+    # See socketio.deflate
+    compression = getattr(websocket, 'deflate', None)
+    chunks = []
+    for frame in frames:
+        flags = 0
+        if isinstance(frame, PingFrame):
+            opcode = websocket.OPCODE_PING
+        else:
+            if isinstance(frame, binary.BinaryFrame):
+                opcode = websocket.OPCODE_BINARY
+            else:
+                opcode = websocket.OPCODE_TEXT
+            if compression is not None:
+                compressed = compression.compress(frame)
+                if compressed is not None:
+                    frame = compressed
+                    flags = websocket.COMPRESSED
+        chunks.append(encode_header(True, opcode, b'', len(frame), flags))
+        chunks.append(frame)
+    try:
+        websocket.raw_write(b''.join(chunks))
+    except socket_error:
+        raise WebSocketError(MSG_SOCKET_DEAD)
+
+
+class SocketStream(object):
+    """Reads a websocket from the socket through its own buffer, so that
+    the :class:`WebsocketPump` can tell, without blocking, whether a whole
+    frame was received.
+
+    The buffer starts with whatever ``rfile``, the file the handler read
+    the request from, holds already: the frames the client sent right
+    behind its request.
+    """
+
+    __slots__ = ('socket', 'buffer', 'write')
+
+    def __init__(self, socket, rfile=None):
+        self.socket = socket
+        self.buffer = bytearray()
+        self.write = socket.sendall
+        if rfile is not None:
+            self.buffer += self._take_buffered(rfile)
+
+    def _take_buffered(self, rfile):
+        """Return the bytes buffered by ``rfile``, without reading more
+        from the socket."""
+        peek = getattr(rfile, 'peek', None)
+        if peek is None:
+            # A socket._fileobject (Python 2) can't tell what it holds
+            return b''
+        timeout = self.socket.gettimeout()
+        self.socket.settimeout(0)
+        try:
+            # Only reads the socket if nothing is buffered, and then
+            # doesn't wait
+            data = peek()
+        except socket_error:
+            data = b''
+        finally:
+            self.socket.settimeout(timeout)
+        if not data:
+            return b''
+        return rfile.read(len(data))
+
+    def fill(self):
+        """Read what the socket has received.  Only call this once the
+        socket is readable.  Returns False at the end of the stream."""
+        data = self.socket.recv(65536)
+        if not data:
+            return False
+        self.buffer += data
+        pending = getattr(self.socket, 'pending', None)
+        while pending is not None and pending():
+            # Decrypted by SSL already, the socket won't be readable again
+            self.buffer += self.socket.recv(65536)
+        return True
+
+    def read(self, n):
+        buf = self.buffer
+        while len(buf) < n:
+            data = self.socket.recv(65536)
+            if not data:
+                break
+            buf += data
+        data = bytes(buf[:n])
+        del buf[:n]
+        return data
+
+    def has_frame(self):
+        """Whether a whole frame is buffered."""
+        buf = self.buffer
+        size = len(buf)
+        if size < 2:
+            return False
+        length = buf[1] & 0x7f
+        pos = 2
+        if length == 126:
+            if size < 4:
+                return False
+            length = struct.unpack_from('!H', buf, 2)[0]
+            pos = 4
+        elif length == 127:
+            if size < 10:
+                return False
+            length = struct.unpack_from('!Q', buf, 2)[0]
+            pos = 10
+        if buf[1] & 0x80:
+            pos += 4
+        return size >= pos + length
+
+
+class WebsocketPump(object):
+    """Sends the messages queued for the client, and dispatches the
+    messages received from it, from a single greenlet.
+
+    Needs a :class:`~socketio.handler.SocketIOWebSocket`.
+
+    The messages received are handed to the Namespaces right away, without
+    going through the ``server_queue`` and the receiver loop of the
+    :class:`~socketio.virtsocket.Socket`.  Only those received before
+    :func:`~socketio.socketio_manage` set the Namespaces up, and the ones
+    behind them, are queued for the receiver loop.  While a handler runs,
+    nothing is sent to this client: the handlers shouldn't block (see the
+    ``handler_pool_size`` server option).
+
+    Enabled by the ``websocket_pump`` server option.
+    """
+
+    def __init__(self, socket, websocket, stream, max_messages=None,
+                 max_bytes=None):
+        self.socket = socket
+        self.websocket = websocket
+        self.stream = stream
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.wakeup = Event()
+        self.readable = False
+
+    def _on_readable(self):
+        self.readable = True
+        self.wakeup.set()
+
+    def run(self):
+        client_queue = self.socket.client_queue
+        watcher = gevent.get_hub().loop.io(self.stream.socket.fileno(), 1)
+        watcher.start(self._on_readable)
+        client_queue.on_put = self.wakeup.set
+        try:
+            while self.step():
+                pass
+        finally:
+            client_queue.on_put = None
+            watcher.stop()
+
+    def step(self):
+        """Send and receive what can be, or wait.  Returns False once done.
+        """
+        self.wakeup.clear()
+        busy = False
+        socket = self.socket
+        if socket.client_queue.qsize():
+            messages = socket.get_multiple_client_msgs(
+                max_messages=self.max_messages, max_bytes=self.max_bytes)
+            killed = messages[-1] is None
+            if killed:
+                messages.pop()
+            if messages:
+                send_frames(self.websocket, messages)
+            if killed:
+                return False
+            busy = True
+        if self.readable:
+            self.readable = False
+            if not self.stream.fill():
+                return False
+        while self.stream.has_frame():
+            busy = True
+            websocket = self.websocket
+            try:
+                message = websocket.feed_frame(*websocket.read_frame())
+            except UnicodeError:
+                self.websocket.close(1007)
+                return False
+            except FrameTooLargeException:
+                self.websocket.close(1009)
+                return False
+            except ProtocolError:
+                self.websocket.close(1002)
+                return False
+            except socket_error:
+                self.websocket.close()
+                return False
+            if message is False:
+                return False
+            if message is None:
+                continue
+            if isinstance(message, bytearray):
+                # A binary frame, see socketio.binary
+                message = binary.BinaryFrame(message)
+            if (not socket.receiving or socket.dispatching
+                    or socket.server_queue.qsize()):
+                # Keep them in order, behind the packets the receiver loop
+                # still has to handle
+                socket.put_server_msg(message)
+                continue
+            socket.heartbeat()
+            if socket._handle_server_msg(message) and not socket.connected:
+                socket.kill(detach=True)
+                return False
+        if not busy:
+            self.wakeup.wait()
+        return True
+
+
 class WebsocketTransport(BaseTransport):
+    def negotiate_binary_codec(self, socket):
+        """Switch the socket to the binary codec asked for in the
+        ``binary`` query string parameter, if the server allows it.  See
+        :mod:`socketio.binary`."""
+        args = self.handler.socketio_request.query
+        for name in args.get("binary", ()):
+            if name in self.config.get('binary_codecs', ()):
+                codec = binary.get_codec(name)
+                if codec is not None:
+                    socket._set_binary_codec(codec)
+                    return codec
+
     def do_exchange(self, socket, request_method):
         websocket = self.handler.environ['wsgi.websocket']
+        self.negotiate_binary_codec(socket)
+        if self.config.get('websocket_ping') \
+                and hasattr(websocket, 'on_pong'):
+            websocket.on_pong = socket._handle_pong
+            socket.ping_frames = True
         websocket.send("1::")  # 'connect' packet
+        batch = {
+            'max_messages': self.config.get('websocket_batch_max_messages',
+                                            64),
+            'max_bytes': self.config.get('websocket_batch_max_bytes', 65536),
+            'linger': self.config.get('websocket_linger', 0),
+        }
+
+        if self.config.get('websocket_pump'):
+            stream = SocketStream(self.handler.socket, self.handler.rfile)
+            websocket.stream = stream
+            websocket.raw_read = stream.read
+            pump = WebsocketPump(socket, websocket, stream,
+                                 batch['max_messages'], batch['max_bytes'])
+            socket.spawn(pump.run)
+            return
 
         def send_into_ws():
+            # Everything already queued goes out in one write, so that
+            # bursts (like broadcasts) don't cost a syscall per message
             while True:
-                message = socket.get_client_msg()
-
-                if message is None:
-                    break
+                messages = socket.get_multiple_client_msgs(**batch)
+                killed = messages[-1] is None
+                if killed:
+                    messages.pop()
                 try:
-                    websocket.send(message)
+                    if messages:
+                        send_frames(websocket, messages)
                 except (WebSocketError, TypeError) as e:
                     print(e)
                     raise
                     # We can't send a message on the socket
                     # it is dead, let the other sockets know
                     socket.disconnect()
+                if killed:
+                    break
 
         def read_from_ws():
             while True:
@@ -263,8 +590,10 @@ class WebsocketTransport(BaseTransport):
                 if message is None:
                     break
                 else:
-                    if message is not None:
-                        socket.put_server_msg(message)
+                    if isinstance(message, bytearray):
+                        # A binary frame, see socketio.binary
+                        message = binary.BinaryFrame(message)
+                    socket.put_server_msg(message)
 
         socket.spawn(send_into_ws)
         socket.spawn(read_from_ws)
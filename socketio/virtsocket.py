@@ -9,22 +9,34 @@ in a different way
 :moduleauthor: Alexandre Bourget <alexandre.bourget@savoirfairelinux.com>
 
 """
+import time
 import random
 import six
 import weakref
 import logging
 
+from collections import deque, OrderedDict
+
 import gevent
+from gevent.pool import Pool
 from gevent.queue import Queue
-from gevent.event import Event
 
-from socketio import packet
-from socketio.defaultjson import default_json_loads, default_json_dumps
+from socketio import binary, packet
+from socketio.clientqueue import ClientQueue, SlowConsumer
+from socketio.defaultjson import default_json_loads, default_json_dumps, \
+    get_backend
 
 
 log = logging.getLogger(__name__)
 
 
+class AckExpired(Exception):
+    """Set on the :class:`~gevent.event.AsyncResult` returned by
+    :meth:`~socketio.namespace.BaseNamespace.emit_with_ack` when the client
+    didn't ack in time, when there were too many pending acks on the
+    socket, or when the socket was killed."""
+
+
 def default_error_handler(socket, error_name, error_message, endpoint,
                           msg_id, quiet):
     """This is the default error handler, you can override this when
@@ -37,9 +49,9 @@ def default_error_handler(socket, error_name, error_message, endpoint,
     :param quiet: if quiet, this handler will not send a packet to the
                   user, but only log for the server developer.
     """
-    pkt = dict(type='event', name='error',
-               args=[error_name, error_message],
-               endpoint=endpoint)
+    pkt = {'type': 'event', 'name': 'error',
+           'args': [error_name, error_message],
+           'endpoint': endpoint}
     if msg_id:
         pkt['id'] = msg_id
 
@@ -53,6 +65,46 @@ def default_error_handler(socket, error_name, error_message, endpoint,
     ))
 
 
+def broadcast_packet(sockets, pkt, exclude=None, conflate_key=None):
+    """Queue the same ``pkt`` on every socket in ``sockets``.
+
+    The packet is encoded only once per JSON (or binary) codec in use by
+    the target sockets (most of the time, a single one), and the very same
+    immutable
+    encoded frame is put on each ``client_queue``.  This is what the
+    :mod:`~socketio.mixins` use to broadcast events, and you should use it
+    too if you fan out packets to many sockets.
+
+    :param sockets: an iterable of :class:`Socket` objects.
+    :param pkt: the packet dict, as you would pass to
+                :meth:`Socket.send_packet`.
+    :param exclude: a :class:`Socket` that should not receive the packet,
+                    usually the sender itself.
+    :param conflate_key: see :meth:`Socket.put_client_msg`.
+    """
+    frames = {}
+    for socket in sockets:
+        if socket is exclude:
+            continue
+        key = (socket.json_dumps, socket.binary_codec)
+        frame = frames.get(key)
+        if frame is None:
+            frame = frames[key] = socket._encode_packet(pkt)
+        socket.put_client_msg(frame, conflate_key)
+
+
+def _ack_id(frame):
+    """Return the message id of an encoded packet, like the 12 of
+    '5:12+:/chat:{...}', or None."""
+    parts = frame[:32].split(b':', 2)
+    if len(parts) < 3:
+        return None
+    msgid = parts[1].rstrip(b'+')
+    if not msgid.isdigit():
+        return None
+    return int(msgid)
+
+
 class Socket(object):
     """
     Virtual Socket implementation, checks heartbeats, writes to local queues
@@ -74,28 +126,56 @@ class Socket(object):
 
     json_loads = staticmethod(default_json_loads)
     json_dumps = staticmethod(default_json_dumps)
+    binary_codec = None
 
     def __init__(self, server, config, error_handler=None):
         self.server = weakref.proxy(server)
         self.sessid = str(random.random())[2:]
         self.session = {}  # the session dict, for general developer usage
-        self.client_queue = Queue()  # queue for messages to client
+        # queue for messages to client
+        self.client_queue = ClientQueue(
+            max_messages=config.get('client_queue_max_messages'),
+            max_bytes=config.get('client_queue_max_bytes'),
+            policy=config.get('client_queue_policy', 'drop-oldest'))
         self.server_queue = Queue()  # queue for messages to server
         self.hits = 0
         self.heartbeats = 0
-        self.timeout = Event()
+        self.last_heartbeat = time.time()
+        self.last_sent = 0  # when we last queued something for the client
+        #: Send websocket pings instead of heartbeat packets, set by the
+        #: websocket transport with the ``websocket_ping`` option
+        self.ping_frames = False
+        #: Round-trip time of the last websocket ping, in seconds
+        self.rtt = None
+        self._heartbeat_timer = None
+        self._timeout_timer = None
         self.wsgi_app_greenlet = None
         self.state = "NEW"
         self.connection_established = False
-        self.ack_callbacks = {}
+        self.ack_callbacks = OrderedDict()  # msgid -> callback, oldest first
+        self._ack_expiry = {}  # msgid -> (Timer or None, on_expire or None)
         self.ack_counter = 0
         self.request = None
         self.environ = None
         self.namespaces = {}
         self.active_ns = {}  # Namespace sessions that were instantiated
+        self.rooms = set()  # Names of the rooms joined, see join_room()
         self.jobs = []
+        self.receiving = False  # whether socketio_manage() took over
+        self.dispatching = False  # whether the receiver loop has a packet
         self.error_handler = default_error_handler
         self.config = config
+        #: When the ``handler_pool_size`` option is set, the incoming
+        #: packets are processed concurrently in this pool, instead of
+        #: one after the other in the receiver loop.
+        self.handler_pool = None
+        if config.get('handler_pool_size'):
+            self.handler_pool = Pool(config['handler_pool_size'])
+        self._lanes = {}
+        if config.get('json_backend'):
+            backend = get_backend(config['json_backend'])
+            self.json_dumps = backend.dumps
+            self.json_loads = backend.loads
         if error_handler is not None:
             self.error_handler = error_handler
 
@@ -103,8 +183,11 @@ class Socket(object):
         """This is a mapping (dict) of the different '/namespaces' to their
         BaseNamespace object derivative.
 
-        This is called by socketio_manage()."""
+        This is called by socketio_manage(), which is also when the
+        dispatch tables of the classes are computed."""
         self.namespaces = namespaces
+        for ns_class in namespaces.values():
+            ns_class.get_dispatch_table()
 
     def _set_request(self, request):
         """Saves the request object for future use by the different Namespaces.
@@ -131,16 +214,30 @@ class Socket(object):
         """Change the default JSON decoder.
 
         This should be a callable that accepts a single string, and returns
-        a well-formed object.
+        a well-formed object, or the name of a backend from
+        :mod:`socketio.defaultjson`.
         """
+        if isinstance(json_loads, six.string_types):
+            json_loads = get_backend(json_loads).loads
         self.json_loads = json_loads
 
+    def _set_binary_codec(self, codec):
+        """Encode the payloads with this :class:`~socketio.binary.Codec`,
+        in binary frames, instead of JSON.
+
+        This is called by the websocket transport, when the client asks for
+        one of the ``binary_codecs`` allowed by the server.
+        """
+        self.binary_codec = codec
+
     def _set_json_dumps(self, json_dumps):
-        """Change the default JSON decoder.
+        """Change the default JSON encoder.
 
-        This should be a callable that accepts a single string, and returns
-        a well-formed object.
+        This should be a callable that accepts a single object, and returns
+        a string, or the name of a backend from :mod:`socketio.defaultjson`.
         """
+        if isinstance(json_dumps, six.string_types):
+            json_dumps = get_backend(json_dumps).dumps
         self.json_dumps = json_dumps
 
     def _get_next_msgid(self):
@@ -151,19 +248,117 @@ class Socket(object):
         self.ack_counter += 1
         return self.ack_counter
 
-    def _save_ack_callback(self, msgid, callback):
-        """Keep a reference of the callback on this socket."""
+    def _save_ack_callback(self, msgid, callback, timeout=None,
+                           on_expire=None):
+        """Keep a reference of the callback on this socket.
+
+        The callback is forgotten after ``timeout`` seconds (or the
+        ``ack_timeout`` option) if the client didn't ack, and the oldest
+        callbacks are forgotten when there are more than
+        ``max_pending_acks`` of them.  ``on_expire``, if given, is then
+        called with an :exc:`AckExpired` exception.
+
+        Timeouts and evictions are counted in the ``acks.expired`` and
+        ``acks.evicted`` metrics of the server.
+
+        Returns False, keeping the callback already saved, if there is one
+        for ``msgid``.
+        """
         if msgid in self.ack_callbacks:
             return False
+        max_pending = self.config.get('max_pending_acks')
+        if max_pending:
+            while len(self.ack_callbacks) >= max_pending:
+                oldest = next(iter(self.ack_callbacks))
+                self._expire_ack(oldest, "Too many pending acks",
+                                 'acks.evicted')
+        if timeout is None:
+            timeout = self.config.get('ack_timeout')
+        timer = None
+        if timeout:
+            timer = self.server.timer_wheel.schedule(
+                timeout, self._expire_ack, msgid, "Ack timed out",
+                'acks.expired')
         self.ack_callbacks[msgid] = callback
+        if timer is not None or on_expire is not None:
+            self._ack_expiry[msgid] = (timer, on_expire)
 
     def _pop_ack_callback(self, msgid):
         """Fetch the callback for a given msgid, if it exists, otherwise,
         return None"""
         if msgid not in self.ack_callbacks:
             return None
+        timer, on_expire = self._ack_expiry.pop(msgid, (None, None))
+        if timer is not None:
+            timer.cancel()
         return self.ack_callbacks.pop(msgid)
 
+    def _expire_ack(self, msgid, reason, metric=None):
+        """Forget the callback for ``msgid``, and notify its ``on_expire``
+        with an :exc:`AckExpired` exception."""
+        if msgid not in self.ack_callbacks:
+            return
+        del self.ack_callbacks[msgid]
+        timer, on_expire = self._ack_expiry.pop(msgid, (None, None))
+        if timer is not None:
+            timer.cancel()
+        if metric is not None:
+            self._incr_metric(metric)
+        log.debug("%s (msgid=%s) on %s" % (reason, msgid, self))
+        if on_expire is not None:
+            on_expire(AckExpired("%s (msgid=%s)" % (reason, msgid)))
+
+    def _expire_all_acks(self):
+        for msgid in list(self.ack_callbacks):
+            self._expire_ack(msgid, "Socket was killed")
+
+    def join_room(self, room_name):
+        """Add this socket to the server's room index, under ``room_name``.
+
+        This is what :meth:`~socketio.mixins.RoomsMixin.join` uses.  Sockets
+        are removed from all of their rooms when they are killed or
+        detached, so you do not need to :meth:`leave_room` explicitly.
+        """
+        self.rooms.add(room_name)
+        self.server.rooms.setdefault(room_name, set()).add(self)
+
+    def leave_room(self, room_name):
+        """Remove this socket from the server's room index.
+
+        Empty rooms are removed from the index altogether.
+        """
+        self.rooms.discard(room_name)
+        members = self.server.rooms.get(room_name)
+        if members is None:
+            return
+        members.discard(self)
+        if not members:
+            del self.server.rooms[room_name]
+
+    def _leave_all_rooms(self):
+        """Called on kill() and detach(), so that no room ever holds a
+        reference to a dead socket."""
+        for room_name in list(self.rooms):
+            self.leave_room(room_name)
+
+    def _index_namespace(self, endpoint):
+        """Register this socket in the server's endpoint index, once the
+        Namespace for ``endpoint`` has been instantiated."""
+        self.server.endpoints.setdefault(endpoint, set()).add(self)
+
+    def _unindex_namespace(self, endpoint):
+        """Remove this socket from the server's endpoint index."""
+        members = self.server.endpoints.get(endpoint)
+        if members is None:
+            return
+        members.discard(self)
+        if not members:
+            del self.server.endpoints[endpoint]
+
+    def _unindex_all_namespaces(self):
+        for endpoint in list(self.active_ns):
+            self._unindex_namespace(endpoint)
+
     def __str__(self):
         result = ['sessid=%r' % self.sessid]
         if self.state == self.STATE_CONNECTED:
@@ -208,7 +403,18 @@ class Socket(object):
 
         This clear the heartbeat disconnect timeout (resets for X seconds).
         """
-        self.timeout.set()
+        self.last_heartbeat = time.time()
+
+    def _handle_pong(self, payload):
+        """Called by the websocket transport when a pong comes in.  Like a
+        heartbeat packet, it resets the heartbeat timeout.  If it answers
+        one of our pings, the round-trip time is kept in ``rtt``."""
+        self.heartbeat()
+        try:
+            sent = float(bytes(payload).decode('ascii'))
+        except (UnicodeDecodeError, ValueError):
+            return  # unsolicited, or not ours
+        self.rtt = self.last_heartbeat - sent
 
     def kill(self, detach=False):
         """This function must/will be called when a socket is to be completely
@@ -221,7 +427,10 @@ class Socket(object):
 
         """
         # Clear out the callbacks
-        self.ack_callbacks = {}
+        self._expire_all_acks()
+        self._cancel_heartbeat()
+        self._leave_all_rooms()
+        self._unindex_all_namespaces()
         if self.connected:
             self.state = self.STATE_DISCONNECTING
             self.server_queue.put_nowait(None)
@@ -233,7 +442,10 @@ class Socket(object):
         if detach:
             self.detach()
 
-        gevent.killall(self.jobs)
+        jobs = self.jobs
+        if self.handler_pool is not None:
+            jobs = jobs + list(self.handler_pool)
+        gevent.killall(jobs)
 
     def detach(self):
         """Detach this socket from the server. This should be done in
@@ -241,6 +453,8 @@ class Socket(object):
         socket for garbage collection."""
 
         log.debug("Removing %s from server sockets" % self)
+        self._leave_all_rooms()
+        self._unindex_all_namespaces()
         if self.sessid in self.server.sockets:
             self.server.sockets.pop(self.sessid)
 
@@ -249,9 +463,49 @@ class Socket(object):
         self.heartbeat()
         self.server_queue.put_nowait(msg)
 
-    def put_client_msg(self, msg):
-        """Writes to the client's pipe, to end up in the browser"""
-        self.client_queue.put_nowait(msg)
+    def put_client_msg(self, msg, conflate_key=None):
+        """Writes to the client's pipe, to end up in the browser.
+
+        Text messages are encoded to UTF-8 once, here, and queued as
+        :class:`~socketio.packet.Frame` objects.
+
+        If the ``client_queue`` is bounded and full, its policy is applied
+        (see :mod:`socketio.clientqueue`), and the drops are counted in the
+        server's ``metrics``.
+
+        :param conflate_key: if specified, ``msg`` replaces the message
+            queued with the same key, if it wasn't sent yet.  See
+            :meth:`~socketio.clientqueue.ClientQueue.conflate`.  The ack
+            callback of the message replaced, if any, is expired.
+        """
+        self.last_sent = time.time()
+        if not isinstance(msg, bytes) and msg is not None:
+            msg = packet.Frame(msg)
+        client_queue = self.client_queue
+        try:
+            if conflate_key is None:
+                dropped = client_queue.put_nowait(msg)
+            else:
+                replaced = client_queue.conflated_item(conflate_key)
+                dropped = client_queue.conflate(conflate_key, msg)
+                if replaced is not None and self.ack_callbacks:
+                    msgid = _ack_id(replaced)
+                    if msgid is not None:
+                        self._expire_ack(msgid, "Replaced before being sent",
+                                         'acks.conflated')
+        except SlowConsumer as e:
+            self._incr_metric('client_queue.dropped.' + client_queue.policy)
+            log.warning("Disconnecting slow consumer %s: %s" % (self, e))
+            gevent.spawn(self.kill, detach=True)
+            return
+        if dropped:
+            self._incr_metric('client_queue.dropped.' + client_queue.policy,
+                              dropped)
+
+    def _incr_metric(self, name, value=1):
+        """Increment the counter ``name`` of the server's ``metrics``."""
+        metrics = self.server.metrics
+        metrics[name] = metrics.get(name, 0) + value
 
     def get_client_msg(self, **kwargs):
         """Grab a message to send it to the browser"""
@@ -262,15 +516,45 @@ class Socket(object):
         """
         return self.server_queue.get(**kwargs)
 
-    def get_multiple_client_msgs(self, **kwargs):
+    def get_multiple_client_msgs(self, max_messages=None, max_bytes=None,
+                                 linger=None, **kwargs):
         """Get multiple messages, in case we're going through the various
         XHR-polling methods, on which we can pack more than one message if the
-        rate is high, and encode the payload for the HTTP channel."""
+        rate is high, and encode the payload for the HTTP channel.
+
+        Blocks for the first message, like :meth:`get_client_msg` (with the
+        same ``kwargs``), then takes the messages already queued, up to
+        ``max_messages`` messages and ``max_bytes`` bytes.  The first
+        message is always returned, even if it is larger than ``max_bytes``.
+
+        :param linger: if specified, wait that many seconds once the queue
+                       is empty, and take the messages queued meanwhile,
+                       if the batch isn't full yet.
+
+        The list ends with ``None`` when the socket was killed.
+        """
         client_queue = self.client_queue
-        msgs = [client_queue.get(**kwargs)]
-        while client_queue.qsize():
-            msgs.append(client_queue.get())
-        return msgs
+        msg = client_queue.get(**kwargs)
+        msgs = [msg]
+        if msg is None:
+            return msgs
+        size = len(msg)
+        while True:
+            while client_queue.qsize():
+                if max_messages is not None and len(msgs) >= max_messages:
+                    return msgs
+                msg = client_queue.peek_nowait()
+                if msg is None:
+                    msgs.append(client_queue.get_nowait())
+                    return msgs
+                if max_bytes is not None and size + len(msg) > max_bytes:
+                    return msgs
+                msgs.append(client_queue.get_nowait())
+                size += len(msg)
+            if not linger:
+                return msgs
+            gevent.sleep(linger)
+            linger = None
 
     def error(self, error_name, error_message, endpoint=None, msg_id=None,
               quiet=False):
@@ -324,14 +608,24 @@ class Socket(object):
         """
         if namespace in self.active_ns:
             del self.active_ns[namespace]
+            self._unindex_namespace(namespace)
 
         if len(self.active_ns) == 0 and self.connected:
             self.kill(detach=True)
 
-    def send_packet(self, pkt):
+    def send_packet(self, pkt, conflate_key=None):
         """Low-level interface to queue a packet on the wire (encoded as wire
-        protocol"""
-        self.put_client_msg(packet.encode(pkt, self.json_dumps))
+        protocol
+
+        See :meth:`put_client_msg` for the ``conflate_key`` parameter."""
+        self.put_client_msg(self._encode_packet(pkt), conflate_key)
+
+    def _encode_packet(self, pkt):
+        if self.binary_codec is not None:
+            frame = binary.encode(pkt, self.binary_codec)
+            if frame is not None:
+                return frame
+        return packet.Frame(packet.encode(pkt, self.json_dumps))
 
     def spawn(self, fn, *args, **kwargs):
         """Spawn a new Greenlet, attached to this Socket instance.
@@ -361,59 +655,14 @@ class Socket(object):
 
             if not rawdata:
                 continue  # or close the connection ?
+            self.dispatching = True
             try:
-                pkt = packet.decode(rawdata, self.json_loads)
-            except (ValueError, KeyError, Exception) as e:
-                self.error('invalid_packet',
-                    "There was a decoding error when dealing with packet "
-                    "with event: %s... (%s)" % (rawdata[:20], e))
+                dispatched = self._handle_server_msg(rawdata)
+            finally:
+                self.dispatching = False
+            if not dispatched:
                 continue
 
-            if pkt['type'] == 'heartbeat':
-                # This is already dealth with in put_server_msg() when
-                # any incoming raw data arrives.
-                continue
-
-            if pkt['type'] == 'disconnect' and pkt['endpoint'] == '':
-                # On global namespace, we kill everything.
-                self.kill(detach=True)
-                continue
-
-            endpoint = pkt['endpoint']
-
-            if endpoint not in self.namespaces:
-                self.error("no_such_namespace",
-                    "The endpoint you tried to connect to "
-                    "doesn't exist: %s" % endpoint, endpoint=endpoint)
-                continue
-            elif endpoint in self.active_ns:
-                pkt_ns = self.active_ns[endpoint]
-            else:
-                new_ns_class = self.namespaces[endpoint]
-                pkt_ns = new_ns_class(self.environ, endpoint,
-                                        request=self.request)
-                # This calls initialize() on all the classes and mixins, etc..
-                # in the order of the MRO
-                for cls in type(pkt_ns).__mro__:
-                    if hasattr(cls, 'initialize'):
-                        cls.initialize(pkt_ns)  # use this instead of __init__,
-                                                # for less confusion
-
-                self.active_ns[endpoint] = pkt_ns
-
-            retval = pkt_ns.process_packet(pkt)
-
-            # Has the client requested an 'ack' with the reply parameters ?
-            if pkt.get('ack') == "data" and pkt.get('id'):
-                if type(retval) is tuple:
-                    args = list(retval)
-                else:
-                    args = [retval]
-                returning_ack = dict(type='ack', ackId=pkt['id'],
-                                     args=args,
-                                     endpoint=pkt.get('endpoint', ''))
-                self.send_packet(returning_ack)
-
             # Now, are we still connected ?
             if not self.connected:
                 self.kill(detach=True)  # ?? what,s the best clean-up
@@ -421,60 +670,236 @@ class Socket(object):
                                         # user-initiated disconnect
                 return
 
+    def _handle_server_msg(self, rawdata):
+        """Decode a raw message coming from the client, and dispatch it to
+        its Namespace, creating the Namespace if needed.
+
+        Returns whether the packet was dispatched to a Namespace.
+        """
+        try:
+            if isinstance(rawdata, binary.BinaryFrame):
+                if self.binary_codec is None:
+                    raise ValueError("no binary codec was negotiated")
+                pkt = binary.decode(rawdata, self.binary_codec)
+            else:
+                pkt = packet.decode(rawdata, self.json_loads,
+                                    self.config.get('lazy_event_args', False))
+        except (ValueError, KeyError, Exception) as e:
+            self.error('invalid_packet',
+                "There was a decoding error when dealing with packet "
+                "with event: %s... (%s)" % (rawdata[:20], e))
+            return False
+
+        if pkt['type'] == 'heartbeat':
+            # This is already dealth with in put_server_msg() when
+            # any incoming raw data arrives.
+            return False
+
+        if pkt['type'] == 'disconnect' and pkt['endpoint'] == '':
+            # On global namespace, we kill everything.
+            self.kill(detach=True)
+            return False
+
+        endpoint = pkt['endpoint']
+
+        if endpoint not in self.namespaces:
+            self.error("no_such_namespace",
+                "The endpoint you tried to connect to "
+                "doesn't exist: %s" % endpoint, endpoint=endpoint)
+            return False
+        elif endpoint in self.active_ns:
+            pkt_ns = self.active_ns[endpoint]
+        else:
+            new_ns_class = self.namespaces[endpoint]
+            pkt_ns = new_ns_class(self.environ, endpoint,
+                                    request=self.request)
+            # This calls initialize() on all the classes and mixins, etc..
+            # in the order of the MRO
+            table = new_ns_class.get_dispatch_table()
+            for initialize in table.initializers:
+                initialize(pkt_ns)  # use this instead of __init__,
+                                    # for less confusion
+
+            self.active_ns[endpoint] = pkt_ns
+            self._index_namespace(endpoint)
+
+        if self.handler_pool is None:
+            self._process_packet(pkt_ns, pkt)
+        else:
+            self._schedule_packet(pkt_ns, pkt)
+        return True
+
+    def _process_packet(self, pkt_ns, pkt):
+        """Have the Namespace process the packet, and send back the 'ack'
+        if the client requested one.
+
+        If the handler returns something with a ``rawlink()`` method, like
+        a :class:`gevent.event.AsyncResult` or a
+        :class:`~gevent.Greenlet`, the 'ack' is sent once it is ready,
+        with its value.
+        """
+        retval = pkt_ns.process_packet(pkt)
+
+        # Has the client requested an 'ack' with the reply parameters ?
+        if pkt.get('ack') == "data" and pkt.get('id'):
+            if hasattr(retval, 'rawlink'):
+                retval.rawlink(lambda result: self._send_deferred_ack(
+                    pkt, result))
+            else:
+                self._send_ack(pkt, retval)
+
+    def _send_ack(self, pkt, retval):
+        if type(retval) is tuple:
+            args = list(retval)
+        else:
+            args = [retval]
+        returning_ack = {'type': 'ack', 'ackId': pkt['id'],
+                         'args': args,
+                         'endpoint': pkt.get('endpoint', '')}
+        self.send_packet(returning_ack)
+
+    def _send_deferred_ack(self, pkt, result):
+        if not self.connected:
+            return
+        if not result.successful():
+            log.error("Deferred ack for packet id=%s failed: %r" %
+                      (pkt['id'], result.exception))
+            return
+        self._send_ack(pkt, result.value)
+
+    def _schedule_packet(self, pkt_ns, pkt):
+        """Queue the packet on its lane, and start processing the lane in
+        the ``handler_pool`` if it isn't already.
+
+        Packets are processed in order within a lane.  There is one lane
+        per Namespace or, with the ``handler_ordering`` option set to
+        ``'event'``, one per Namespace and event name.
+        """
+        key = pkt['endpoint']
+        if self.config.get('handler_ordering') == 'event' \
+                and pkt['type'] == 'event':
+            key = (key, pkt['name'])
+        lane = self._lanes.get(key)
+        if lane is not None:
+            lane.append((pkt_ns, pkt))
+            return
+        lane = self._lanes[key] = deque([(pkt_ns, pkt)])
+        # This blocks when the pool is full, which in turns stops reading
+        # from the server_queue.
+        self.handler_pool.spawn(self._run_lane, key, lane)
+
+    def _run_lane(self, key, lane):
+        try:
+            while lane:
+                pkt_ns, pkt = lane.popleft()
+                try:
+                    self._process_packet(pkt_ns, pkt)
+                except Exception:
+                    log.exception("Error while processing packet %r" % pkt)
+                if not self.connected:
+                    break
+        finally:
+            del self._lanes[key]
+
     def _spawn_receiver_loop(self):
         """Spawns the reader loop.  This is called internall by
         socketio_manage().
         """
+        self.receiving = True
         job = gevent.spawn(self._receiver_loop)
         self.jobs.append(job)
         return job
 
-    def _watcher(self):
-        """Watch out if we've been disconnected, in that case, kill
-        all the jobs.
-
+    def _schedule_heartbeat(self):
+        """Schedule the heartbeat and the heartbeat timeout for this socket
+        on the server's :class:`~socketio.timerwheel.TimerWheel`.  This is
+        called by the handler once the connection is established.
         """
-        while True:
-            gevent.sleep(1.0)
-            if not self.connected:
-                for ns_name, ns in list(six.iteritems(self.active_ns)):
-                    ns.recv_disconnect()
-                # Killing Socket-level jobs
-                gevent.killall(self.jobs)
-                break
-
-    def _spawn_watcher(self):
-        """This one is not waited for with joinall(socket.jobs), as it
-        is an external watcher, to clean up when everything is done."""
-        job = gevent.spawn(self._watcher)
-        return job
+        self.last_heartbeat = time.time()
+        wheel = self.server.timer_wheel
+        self._heartbeat_timer = wheel.schedule(
+            self._get_heartbeat_delay(), self._heartbeat)
+        self._timeout_timer = wheel.schedule(
+            float(self.config['heartbeat_timeout']), self._heartbeat_timeout)
+
+    def _cancel_heartbeat(self):
+        for timer in (self._heartbeat_timer, self._timeout_timer):
+            if timer is not None:
+                timer.cancel()
+        self._heartbeat_timer = self._timeout_timer = None
+
+    def _get_heartbeat_delay(self):
+        """The heartbeat interval, shortened by a random fraction of up to
+        ``heartbeat_jitter`` so that sockets that connected together (after
+        a server restart for example) do not all beat on the same tick."""
+        interval = self.config['heartbeat_interval']
+        jitter = self.config.get('heartbeat_jitter', 0)
+        return interval * (1 - random.random() * jitter)
 
     def _heartbeat(self):
-        """Start the heartbeat Greenlet to check connection health."""
+        """Send a heartbeat to check connection health, and schedule the
+        next one.  This runs in the timer wheel's greenlet.
+
+        The heartbeat is skipped if we queued something for the client
+        during the last interval, as that traffic already keeps the
+        client's timeout at bay, *and* the client talked to us during that
+        interval.  Otherwise, the heartbeat is sent so that the client
+        replies to it, and resets our own timeout.
+
+        With ``ping_frames``, a websocket ping is sent instead.  The
+        socket.io client doesn't see those, so a heartbeat packet is still
+        sent when the client would otherwise time out before the next
+        heartbeat.
+
+        If we were disconnected without going through kill(), clean up
+        whatever is left instead.
+        """
+        if not self.connected:
+            gevent.spawn(self._cleanup)
+            return
         interval = self.config['heartbeat_interval']
-        while self.connected:
-            gevent.sleep(interval)
-            # TODO: this process could use a timeout object like the disconnect
-            #       timeout thing, and ONLY send packets when none are sent!
-            #       We would do that by calling timeout.set() for a "sending"
-            #       timeout.  If we're sending 100 messages a second, there is
-            #       no need to push some heartbeats in there also.
-            self.put_client_msg("2::")
+        now = time.time()
+        since_sent = now - self.last_sent
+        since_received = now - self.last_heartbeat
+        if since_sent >= interval or since_received >= interval:
+            self.heartbeats += 1
+            if self.ping_frames:
+                # The pings don't reset the client's timeout
+                last_sent = self.last_sent
+                self.put_client_msg(packet.PingFrame(
+                    ('%.6f' % now).encode('ascii')))
+                self.last_sent = last_sent
+                timeout = self.config.get('heartbeat_timeout')
+                if timeout and since_sent + interval >= float(timeout):
+                    self.put_client_msg("2::")
+            else:
+                self.put_client_msg("2::")
+            delay = self._get_heartbeat_delay()
+        else:
+            delay = interval - max(since_sent, since_received)
+        self._heartbeat_timer = self.server.timer_wheel.schedule(
+            delay, self._heartbeat)
 
     def _heartbeat_timeout(self):
+        """Kill the socket if nothing came in for ``heartbeat_timeout``
+        seconds, otherwise check again when that delay will be over.  This
+        runs in the timer wheel's greenlet.
+        """
+        if not self.connected:
+            return
         timeout = float(self.config['heartbeat_timeout'])
-        while True:
-            self.timeout.clear()
-            gevent.sleep(0)
-            wait_res = self.timeout.wait(timeout=timeout)
-            if not wait_res:
-                if self.connected:
-                    log.debug("heartbeat timed out, killing socket")
-                    self.kill(detach=True)
-                return
-
-
-    def _spawn_heartbeat(self):
-        """This functions returns a list of jobs"""
-        self.spawn(self._heartbeat)
-        self.spawn(self._heartbeat_timeout)
+        remaining = self.last_heartbeat + timeout - time.time()
+        if remaining <= 0:
+            log.debug("heartbeat timed out, killing socket")
+            gevent.spawn(self.kill, detach=True)
+            return
+        self._timeout_timer = self.server.timer_wheel.schedule(
+            remaining, self._heartbeat_timeout)
+
+    def _cleanup(self):
+        """Disconnect the remaining Namespaces and kill all the jobs of a
+        socket that isn't connected anymore."""
+        for ns_name, ns in list(six.iteritems(self.active_ns)):
+            ns.recv_disconnect()
+        # Killing Socket-level jobs
+        gevent.killall(self.jobs)
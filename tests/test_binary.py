@@ -0,0 +1,108 @@
+import json
+from unittest import TestCase, main, skipIf
+
+from socketio import binary
+from socketio.binary import BinaryFrame, Codec, decode, encode
+from socketio.handler import SocketIORequest
+from socketio.packet import Packet
+from socketio.transports import WebsocketTransport
+from socketio.virtsocket import Socket
+
+# A codec that doesn't need any optional dependency
+JSON_BYTES = Codec('json-bytes',
+                   lambda data: json.dumps(data).encode('utf-8'),
+                   lambda data: json.loads(data.decode('utf-8')))
+
+
+class MockSocketIOServer(object):
+    """Mock a SocketIO server"""
+    def __init__(self, *args, **kwargs):
+        self.sockets = {}
+        self.rooms = {}
+        self.endpoints = {}
+        self.metrics = {}
+
+
+class MockHandler(object):
+    """Mock a SocketIO handler"""
+    def __init__(self, query_string):
+        self.environ = {'QUERY_STRING': query_string}
+        self.socketio_request = SocketIORequest(query_string=query_string)
+
+
+class TestBinaryCodec(TestCase):
+
+    def test_encode_event(self):
+        frame = encode(Packet(type='event', name='sample', args=(1, 2.5),
+                              endpoint='/cpu', id=3, ack='data'),
+                       JSON_BYTES)
+        self.assertTrue(isinstance(frame, BinaryFrame))
+        self.assertEqual(frame,
+                         b'5:3+:/cpu:{"name": "sample", "args": [1, 2.5]}')
+
+    def test_text_only_packets(self):
+        self.assertEqual(encode(Packet(type='heartbeat'), JSON_BYTES), None)
+        self.assertEqual(encode(Packet(type='message', data='hi',
+                                       endpoint=''), JSON_BYTES), None)
+        self.assertEqual(decode(BinaryFrame(b'2::'), JSON_BYTES),
+                         {'type': 'heartbeat', 'endpoint': ''})
+
+    def test_round_trip(self):
+        for pkt in (Packet(type='event', name='sample', args=[[1, 2]],
+                           endpoint='/cpu'),
+                    Packet(type='json', data={'x': 1}, endpoint='',
+                           id=1, ack=True),
+                    Packet(type='ack', ackId=12, args=['ok'],
+                           endpoint='/cpu')):
+            self.assertEqual(decode(encode(pkt, JSON_BYTES), JSON_BYTES),
+                             pkt)
+
+    @skipIf(binary.get_codec('msgpack') is None, "msgpack is not installed")
+    def test_msgpack(self):
+        codec = binary.get_codec('msgpack')
+        pkt = Packet(type='event', name='sample',
+                     args=[[0.5, 1.5, 2.5] * 10], endpoint='/cpu')
+        frame = encode(pkt, codec)
+        self.assertEqual(decode(frame, codec), pkt)
+
+
+class TestBinarySocket(TestCase):
+
+    def setUp(self):
+        self.server = MockSocketIOServer()
+        self.socket = Socket(self.server, {})
+
+    def test_send_packet(self):
+        pkt = Packet(type='event', name='sample', args=[1], endpoint='')
+        self.socket.send_packet(pkt)
+        self.socket._set_binary_codec(JSON_BYTES)
+        self.socket.send_packet(pkt)
+        self.socket.send_packet(Packet(type='heartbeat'))
+        self.assertEqual(self.socket.get_client_msg(),
+                         b'5:::{"args":[1],"name":"sample"}')
+        frame = self.socket.get_client_msg()
+        self.assertTrue(isinstance(frame, BinaryFrame))
+        self.assertEqual(self.socket.get_client_msg(), b'2::')
+
+    def test_binary_frame_without_codec(self):
+        self.socket.error = lambda *args, **kwargs: None
+        self.assertFalse(self.socket._handle_server_msg(
+            BinaryFrame(b'5:::{"name": "sample"}')))
+
+    def test_negotiation(self):
+        binary.register_codec(JSON_BYTES.name, JSON_BYTES.dumps,
+                              JSON_BYTES.loads)
+        transport = WebsocketTransport(MockHandler('binary=json-bytes'),
+                                       {'binary_codecs': ('json-bytes', )})
+        self.assertEqual(transport.negotiate_binary_codec(self.socket).name,
+                         'json-bytes')
+        self.assertEqual(self.socket.binary_codec.name, 'json-bytes')
+
+    def test_negotiation_not_allowed(self):
+        transport = WebsocketTransport(MockHandler('binary=json-bytes'), {})
+        transport.negotiate_binary_codec(self.socket)
+        self.assertEqual(self.socket.binary_codec, None)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+import decimal
+import json
+from unittest import TestCase, main
+
+from socketio import defaultjson
+from socketio.defaultjson import default_json_dumps, get_backend
+from socketio.virtsocket import Socket
+
+
+class MockSocketIOServer(object):
+    """Mock a SocketIO server"""
+    def __init__(self, *args, **kwargs):
+        self.sockets = {}
+        self.rooms = {}
+        self.endpoints = {}
+        self.metrics = {}
+
+
+class TestBackends(TestCase):
+
+    data = {'b': 1, 'a': [decimal.Decimal('1.5'), u'\xe9', None]}
+
+    def test_default_output_unchanged(self):
+        self.assertEqual(default_json_dumps(self.data),
+                         '{"a":[1.5,"\\u00e9",null],"b":1}')
+        self.assertIs(get_backend('default').dumps, default_json_dumps)
+
+    def test_backends_roundtrip(self):
+        for name in defaultjson.available_backends():
+            backend = get_backend(name)
+            encoded = backend.dumps(self.data)
+            self.assertTrue(isinstance(encoded, str), name)
+            self.assertEqual(json.loads(encoded),
+                             {'a': [1.5, u'\xe9', None], 'b': 1}, name)
+            self.assertEqual(backend.loads(encoded)['b'], 1, name)
+
+    def test_fast_doesnt_sort_or_escape(self):
+        encoded = get_backend('fast').dumps(self.data)
+        self.assertEqual(encoded, u'{"b":1,"a":[1.5,"\xe9",null]}')
+
+    def test_unknown_backend(self):
+        self.assertRaises(ValueError, get_backend, 'nope')
+
+    def test_register_backend(self):
+        backend = defaultjson.register_backend('test', repr, eval)
+        self.assertIs(get_backend('test'), backend)
+        del defaultjson._backends['test']
+
+
+class TestSocketBackend(TestCase):
+
+    def test_config(self):
+        socket = Socket(MockSocketIOServer(), {'json_backend': 'fast'})
+        self.assertIs(socket.json_dumps, get_backend('fast').dumps)
+        self.assertIs(socket.json_loads, get_backend('fast').loads)
+
+    def test_default(self):
+        socket = Socket(MockSocketIOServer(), {})
+        self.assertIs(socket.json_dumps, default_json_dumps)
+
+    def test_set_by_name(self):
+        socket = Socket(MockSocketIOServer(), {})
+        socket._set_json_dumps('json')
+        socket._set_json_loads('json')
+        self.assertIs(socket.json_dumps, get_backend('json').dumps)
+        self.assertIs(socket.json_loads, get_backend('json').loads)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+import zlib
+from unittest import TestCase, main
+
+from geventwebsocket.exceptions import FrameTooLargeException
+
+from socketio.deflate import PerMessageDeflate, negotiate
+
+MESSAGE = b'5:::{"args":[{"cpu":12.5,"host":"web-1"}],"name":"cpu_data"}'
+
+
+class TestNegotiate(TestCase):
+
+    def test_no_offer(self):
+        self.assertTrue(negotiate(None) is None)
+        self.assertTrue(negotiate('x-webkit-deflate-frame') is None)
+
+    def test_default(self):
+        deflate = negotiate('permessage-deflate; client_max_window_bits')
+        self.assertEqual(deflate.response_header(), 'permessage-deflate')
+
+    def test_no_context_takeover(self):
+        deflate = negotiate('permessage-deflate', context_takeover=False)
+        self.assertEqual(deflate.response_header(),
+                         'permessage-deflate; server_no_context_takeover; '
+                         'client_no_context_takeover')
+        deflate = negotiate('permessage-deflate; server_no_context_takeover')
+        self.assertEqual(deflate.response_header(),
+                         'permessage-deflate; server_no_context_takeover')
+
+    def test_window_bits(self):
+        deflate = negotiate('permessage-deflate; server_max_window_bits=8, '
+                            'permessage-deflate; server_max_window_bits=10')
+        self.assertEqual(deflate.response_header(),
+                         'permessage-deflate; server_max_window_bits=10')
+
+    def test_unknown_parameter(self):
+        self.assertTrue(negotiate('permessage-deflate; foo=1') is None)
+
+
+class TestPerMessageDeflate(TestCase):
+
+    def inflate(self, data, decompressor=None):
+        decompressor = decompressor or zlib.decompressobj(-zlib.MAX_WBITS)
+        return decompressor.decompress(data + b'\x00\x00\xff\xff')
+
+    def test_min_size(self):
+        deflate = PerMessageDeflate(min_size=100)
+        self.assertTrue(deflate.compress(MESSAGE) is None)
+        self.assertEqual(deflate.metrics, {})
+
+    def test_context_takeover(self):
+        deflate = PerMessageDeflate()
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        first = deflate.compress(MESSAGE)
+        second = deflate.compress(MESSAGE)
+        self.assertTrue(len(second) < len(first))
+        self.assertEqual(self.inflate(first, decompressor), MESSAGE)
+        self.assertEqual(self.inflate(second, decompressor), MESSAGE)
+        self.assertEqual(deflate.metrics['websocket.deflate.bytes_in'],
+                         2 * len(MESSAGE))
+        self.assertEqual(deflate.metrics['websocket.deflate.bytes_out'],
+                         len(first) + len(second))
+        self.assertTrue(deflate.metrics['websocket.deflate.seconds'] >= 0)
+
+    def test_no_context_takeover(self):
+        deflate = PerMessageDeflate(server_no_context_takeover=True)
+        first = deflate.compress(MESSAGE)
+        self.assertEqual(deflate.compress(MESSAGE), first)
+        self.assertEqual(self.inflate(first), MESSAGE)
+
+    def test_decompress(self):
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        deflate = PerMessageDeflate()
+        for i in range(2):
+            data = compressor.compress(MESSAGE) + \
+                compressor.flush(zlib.Z_SYNC_FLUSH)
+            self.assertEqual(deflate.decompress(data[:-4]), MESSAGE)
+        self.assertEqual(deflate.metrics['websocket.inflate.bytes_out'],
+                         2 * len(MESSAGE))
+
+    def test_max_size(self):
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        bomb = compressor.compress(b'0' * 10 ** 6) + \
+            compressor.flush(zlib.Z_SYNC_FLUSH)
+        deflate = PerMessageDeflate(max_size=10 ** 6)
+        self.assertEqual(len(deflate.decompress(bomb[:-4])), 10 ** 6)
+
+        deflate = PerMessageDeflate(max_size=1000)
+        self.assertRaises(FrameTooLargeException, deflate.decompress,
+                          bomb[:-4])
+        self.assertEqual(deflate.metrics, {'websocket.inflate.rejected': 1})
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,326 @@
+import struct
+import warnings
+import zlib
+from unittest import TestCase, main
+
+import gevent
+from gevent import socket
+
+from socketio import socketio_manage
+from socketio.namespace import BaseNamespace
+from socketio.server import SocketIOServer
+
+
+class EchoNamespace(BaseNamespace):
+    def on_echo(self, *args):
+        self.emit('echo', *args)
+
+    def on_slow(self, *args):
+        gevent.sleep(0.05)
+        self.emit('echo', *args)
+
+
+def application(environ, start_response):
+    if 'socketio' in environ:
+        socketio_manage(environ, {'/echo': EchoNamespace})
+        return []
+    start_response('404 Not Found', [])
+    return [b'']
+
+
+def client_frame(payload, opcode=0x1, flags=0):
+    """A masked frame, with a null mask"""
+    if len(payload) < 126:
+        header = struct.pack('!BB', 0x80 | flags | opcode,
+                             0x80 | len(payload))
+    else:
+        header = struct.pack('!BBH', 0x80 | flags | opcode, 0x80 | 126,
+                             len(payload))
+    return header + b'\0\0\0\0' + payload
+
+
+class TestKeepAlive(TestCase):
+    """The polling requests share one HTTP/1.1 connection"""
+
+    def setUp(self):
+        self.server = SocketIOServer(('127.0.0.1', 0), application,
+                                     resource='socket.io',
+                                     policy_server=False, log_file=None)
+        self.server.start()
+        self.conn = socket.create_connection(('127.0.0.1',
+                                              self.server.server_port))
+        self.conn.settimeout(5)
+        self.rfile = self.conn.makefile('rb')
+
+    def tearDown(self):
+        self.rfile.close()
+        self.conn.close()
+        self.server.stop()
+
+    def request(self, method, path, body=b'', keep_alive=True):
+        self.conn.sendall(('%s %s HTTP/1.1\r\nHost: localhost\r\n'
+                           'Content-Length: %d\r\n\r\n' %
+                           (method, path, len(body))).encode('ascii') + body)
+        status = self.rfile.readline().split(None, 2)[1]
+        headers = {}
+        for line in iter(self.rfile.readline, b'\r\n'):
+            name, value = line.decode('latin-1').split(':', 1)
+            headers[name.lower()] = value.strip()
+        self.assertEqual(headers.get('connection') != 'close', keep_alive)
+        return status, self.rfile.read(int(headers['content-length']))
+
+    def test_polling_cycle(self):
+        status, body = self.request('GET', '/socket.io/1/')
+        sessid = body.split(b':')[0].decode('ascii')
+        path = '/socket.io/1/xhr-polling/' + sessid
+        self.assertEqual(self.request('GET', path), (b'200', b'1::'))
+
+        socket = self.server.sockets[sessid]
+        socket.put_client_msg(u'3:::\xe9t\xe9')
+        self.assertEqual(self.request('GET', path),
+                         (b'200', u'3:::\xe9t\xe9'.encode('utf-8')))
+        self.assertEqual(self.request('POST', path, b'2::'), (b'200', b'1'))
+
+    def test_multiline_body(self):
+        status, body = self.request('GET', '/socket.io/1/')
+        sessid = body.split(b':')[0].decode('ascii')
+        path = '/socket.io/1/xhr-polling/' + sessid
+        self.assertEqual(self.request('GET', path), (b'200', b'1::'))
+        self.assertEqual(self.request('POST', path,
+                                      b'5::/echo:{"name": "echo",\n'
+                                      b'"args": ["hi"]}'),
+                         (b'200', b'1'))
+        status, body = self.request('GET', path)
+        self.assertEqual(status, b'200')
+        self.assertTrue(b'"hi"' in body, body)
+
+    def test_unread_body(self):
+        smuggled = b'GET /nope HTTP/1.1\r\nHost: localhost\r\n\r\n'
+        status, body = self.request('GET', '/socket.io/1/', smuggled)
+        self.assertEqual(status, b'200')
+        status, body = self.request('GET', '/socket.io/1/')
+        self.assertEqual(status, b'200')
+
+    def test_bad_request(self):
+        self.assertEqual(
+            self.request('POST', '/socket.io/1/xhr-polling/nope', b'2::',
+                         keep_alive=False),
+            (b'400', b''))
+
+
+class TestServerOptions(TestCase):
+
+    def test_ws_handler_class_is_deprecated(self):
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            SocketIOServer(('127.0.0.1', 0), application,
+                           resource='socket.io', policy_server=False,
+                           log_file=None, ws_handler_class=object)
+        self.assertEqual([w.category for w in caught], [DeprecationWarning])
+        self.assertTrue(caught[0].filename.endswith('test_handler.py'))
+
+
+class TestWebSocket(TestCase):
+    """The websocket transport gets the upgraded connection"""
+
+    server_options = {}
+
+    def setUp(self):
+        self.server = SocketIOServer(('127.0.0.1', 0), application,
+                                     resource='socket.io',
+                                     policy_server=False, log_file=None,
+                                     **self.server_options)
+        self.server.start()
+        self.sessid = self.server.get_socket().sessid
+        self.conn = socket.create_connection(('127.0.0.1',
+                                              self.server.server_port))
+        self.conn.settimeout(5)
+        self.rfile = self.conn.makefile('rb')
+
+    def tearDown(self):
+        self.rfile.close()
+        self.conn.close()
+        self.server.stop()
+
+    def upgrade(self, version='13', key='dGhlIHNhbXBsZSBub25jZQ==',
+                extra_headers='', pipelined=b''):
+        self.conn.sendall(('GET /socket.io/1/websocket/%s HTTP/1.1\r\n'
+                           'Host: localhost\r\n'
+                           'Upgrade: websocket\r\n'
+                           'Connection: Upgrade\r\n'
+                           'Sec-WebSocket-Key: %s\r\n'
+                           'Sec-WebSocket-Version: %s\r\n%s\r\n' %
+                           (self.sessid, key, version,
+                            extra_headers)).encode('ascii') + pipelined)
+        status = self.rfile.readline().split(None, 2)[1]
+        headers = {}
+        for line in iter(self.rfile.readline, b'\r\n'):
+            name, value = line.decode('latin-1').split(':', 1)
+            headers[name.lower()] = value.strip()
+        return status, headers
+
+    def test_upgrade(self):
+        status, headers = self.upgrade()
+        self.assertEqual(status, b'101')
+        self.assertEqual(headers['sec-websocket-accept'],
+                         's3pPLMBiTxaQ9kYGzzhZRbK+xOo=')
+        self.assertEqual(self.rfile.read(5), b'\x81\x031::')
+
+        socketio_socket = self.server.sockets[self.sessid]
+        socketio_socket.put_client_msg(u'3:::\xe9')
+        self.assertEqual(self.rfile.read(8), b'\x81\x063:::\xc3\xa9')
+
+        socketio_socket.kill()
+        self.assertEqual(self.rfile.read(), b'')
+
+    def test_bad_handshake(self):
+        status, headers = self.upgrade(version='99')
+        self.assertEqual(status, b'400')
+        self.assertEqual(headers['sec-websocket-version'], '13, 8, 7')
+        status, headers = self.upgrade(key='short')
+        self.assertEqual(status, b'400')
+
+    def read_frame(self):
+        opcode, length = struct.unpack('!BB', self.rfile.read(2))
+        if length == 126:
+            length = struct.unpack('!H', self.rfile.read(2))[0]
+        return opcode, self.rfile.read(length)
+
+    def test_dispatch(self):
+        self.upgrade()
+        self.assertEqual(self.read_frame(), (0x81, b'1::'))
+        self.conn.sendall(client_frame(b'1::/echo'))
+        self.assertEqual(self.read_frame(), (0x81, b'1::/echo'))
+
+        # A ping, then an event split over two writes
+        event = client_frame(b'5::/echo:{"name":"echo","args":[1]}')
+        self.conn.sendall(client_frame(b'hi', opcode=0x9) + event[:10])
+        self.assertEqual(self.read_frame(), (0x8a, b'hi'))
+        gevent.sleep(0.01)
+        self.conn.sendall(event[10:])
+        self.assertEqual(self.read_frame(),
+                         (0x81, b'5::/echo:{"args":[1],"name":"echo"}'))
+
+    def test_pipelined_frame(self):
+        # Sent along with the request, before the upgrade response
+        self.upgrade(pipelined=client_frame(b'1::/echo'))
+        self.assertEqual(self.read_frame(), (0x81, b'1::'))
+        self.assertEqual(self.read_frame(), (0x81, b'1::/echo'))
+
+    def test_order_behind_pipelined_frames(self):
+        # The receiver loop is still handling 'slow' when 'echo' comes
+        self.upgrade(pipelined=client_frame(b'1::/echo') + client_frame(
+            b'5::/echo:{"name":"slow","args":[1]}'))
+        gevent.sleep(0.01)
+        self.conn.sendall(client_frame(b'5::/echo:{"name":"echo","args":[2]}'))
+        self.assertEqual(self.read_frame(), (0x81, b'1::'))
+        self.assertEqual(self.read_frame(), (0x81, b'1::/echo'))
+        self.assertEqual(self.read_frame(),
+                         (0x81, b'5::/echo:{"args":[1],"name":"echo"}'))
+        self.assertEqual(self.read_frame(),
+                         (0x81, b'5::/echo:{"args":[2],"name":"echo"}'))
+
+
+class TestWebSocketPump(TestWebSocket):
+    """The same, with a single greenlet per websocket"""
+
+    server_options = {'websocket_pump': True}
+
+    def test_single_greenlet(self):
+        self.upgrade()
+        self.assertEqual(self.read_frame(), (0x81, b'1::'))
+        socketio_socket = self.server.sockets[self.sessid]
+        # The pump, and the idle receiver loop of socketio_manage
+        self.assertEqual(len(socketio_socket.jobs), 2)
+
+
+class TestWebSocketPing(TestWebSocket):
+    """The same, with websocket pings instead of heartbeat packets"""
+
+    server_options = {'websocket_ping': True}
+
+    def test_ping(self):
+        self.upgrade()
+        self.assertEqual(self.read_frame(), (0x81, b'1::'))
+        socketio_socket = self.server.sockets[self.sessid]
+        socketio_socket.state = socketio_socket.STATE_CONNECTED
+        socketio_socket.last_heartbeat -= 60
+        socketio_socket._heartbeat()
+        opcode, payload = self.read_frame()
+        self.assertEqual(opcode, 0x89)
+
+        self.conn.sendall(client_frame(payload, opcode=0xa))
+        gevent.sleep(0.01)
+        self.assertTrue(0 <= socketio_socket.rtt < 1)
+
+
+class TestWebSocketPumpPing(TestWebSocketPing):
+    """And with the pump"""
+
+    server_options = {'websocket_ping': True, 'websocket_pump': True}
+
+
+class TestWebSocketDeflate(TestWebSocket):
+    """The same, with permessage-deflate"""
+
+    server_options = {'websocket_deflate': True,
+                      'websocket_deflate_min_size': 0,
+                      'websocket_max_message_size': 1000}
+
+    def test_compressed(self):
+        status, headers = self.upgrade(
+            extra_headers='Sec-WebSocket-Extensions: permessage-deflate; '
+                          'client_max_window_bits\r\n')
+        self.assertEqual(headers['sec-websocket-extensions'],
+                         'permessage-deflate')
+        self.assertEqual(self.read_frame(), (0x81, b'1::'))
+
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        data = compressor.compress(b'1::/echo') + \
+            compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.conn.sendall(client_frame(data[:-4], flags=0x40))
+
+        opcode, payload = self.read_frame()
+        self.assertEqual(opcode, 0xc1)
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        self.assertEqual(
+            decompressor.decompress(payload + b'\x00\x00\xff\xff'),
+            b'1::/echo')
+        self.assertEqual(self.server.metrics['websocket.inflate.bytes_out'],
+                         8)
+        self.assertEqual(self.server.metrics['websocket.deflate.bytes_in'],
+                         8)
+
+    def test_bomb(self):
+        self.upgrade(extra_headers='Sec-WebSocket-Extensions: '
+                                   'permessage-deflate\r\n')
+        self.read_frame()
+        compressor = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+        bomb = compressor.compress(b'0' * 10 ** 6) + \
+            compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.assertTrue(len(bomb) < 1200)
+        self.conn.sendall(client_frame(bomb[:-4], flags=0x40))
+        opcode, payload = self.read_frame()
+        self.assertEqual((opcode, payload[:2]), (0x88, b'\x03\xf1'))
+        self.assertEqual(self.server.metrics['websocket.inflate.rejected'], 1)
+
+    def test_not_offered(self):
+        status, headers = self.upgrade()
+        self.assertTrue('sec-websocket-extensions' not in headers)
+        # Compressed frames are then a protocol error
+        self.read_frame()
+        self.conn.sendall(client_frame(b'1::/echo', flags=0x40))
+        self.assertEqual(self.read_frame()[0], 0x88)
+
+
+class TestWebSocketPumpDeflate(TestWebSocketDeflate):
+    """And with the pump"""
+
+    server_options = {'websocket_deflate': True,
+                      'websocket_deflate_min_size': 0,
+                      'websocket_max_message_size': 1000,
+                      'websocket_pump': True}
+
+
+if __name__ == '__main__':
+    main()
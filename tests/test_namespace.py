@@ -1,6 +1,8 @@
 from unittest import TestCase, main
 
-from socketio.namespace import BaseNamespace
+from socketio.namespace import BaseNamespace, CALL_ARGS, CALL_PACKET, \
+    CALL_INVALID
+from socketio.packet import decode
 from socketio.virtsocket import Socket
 from mock import MagicMock
 
@@ -8,6 +10,8 @@ class MockSocketIOServer(object):
     """Mock a SocketIO server"""
     def __init__(self, *args, **kwargs):
         self.sockets = {}
+        self.rooms = {}
+        self.endpoints = {}
 
     def get_socket(self, socket_id=''):
         return self.sockets.get(socket_id)
@@ -381,5 +385,106 @@ class TestChatNamespace(TestCase):
             "have 'self' as its first argument"
         , **kwargs)
 
+class TestDispatchTable(TestCase):
+    def setUp(self):
+        server = MockSocketIOServer()
+        self.environ = {}
+        socket = MockSocket(server, {})
+        socket.error = MagicMock()
+        self.environ['socketio'] = socket
+
+    def test_table_is_per_class(self):
+        class PacketNamespace(GlobalNamespace):
+            def on_raw(self, packet):
+                return packet
+
+        table = PacketNamespace.get_dispatch_table()
+        self.assertTrue(table is PacketNamespace.get_dispatch_table())
+        self.assertFalse(table is GlobalNamespace.get_dispatch_table())
+        self.assertEqual(table.methods['on_raw'][1], CALL_PACKET)
+        self.assertEqual(table.methods['on_woot'][1], CALL_ARGS)
+        self.assertEqual(table.methods['recv_connect'][1], CALL_ARGS)
+        self.assertFalse(
+            'on_raw' in GlobalNamespace.get_dispatch_table().methods)
+        chat_methods = ChatNamespace.get_dispatch_table().methods
+        self.assertEqual(chat_methods['on_baz'][1], CALL_INVALID)
+
+        ns = PacketNamespace(self.environ, '/woot')
+        pkt = {'type': 'event', 'name': 'raw', 'endpoint': '/woot',
+               'args': []}
+        self.assertTrue(ns.process_packet(pkt) is pkt)
+        self.assertEqual(table.events, {'raw': 'on_raw'})
+
+    def test_unknown_event_names_are_not_cached(self):
+        ns = GlobalNamespace(self.environ, '/woot')
+        for name in ('nope', '$nope'):
+            ns.process_packet({'type': 'event', 'name': name,
+                               'endpoint': '/woot', 'args': []})
+        self.assertFalse('nope' in GlobalNamespace.get_dispatch_table().events)
+
+    def test_instance_method_overrides_table(self):
+        ns = GlobalNamespace(self.environ, '/woot')
+        ns.on_woot = lambda: 'instance'
+        ns.call_method('on_woot', {})
+        self.environ['socketio'].error.assert_called_with(
+            "invalid_method_args",
+            "The server-side method is invalid, as it doesn't "
+            "have 'self' as its first argument",
+            msg_id=None, endpoint='/woot', quiet=False)
+
+    def test_exception_handler_decorator(self):
+        calls = []
+
+        class DecoratedNamespace(GlobalNamespace):
+            def exception_handler_decorator(self, fn):
+                def wrap(*args):
+                    calls.append(fn.__name__)
+                    return fn(*args)
+                return wrap
+
+        ns = DecoratedNamespace(self.environ, '/woot')
+        ns.process_packet({'type': 'event', 'name': 'tobi',
+                           'endpoint': '/woot', 'args': []})
+        self.assertEqual(calls, ['on_tobi'])
+
+
+class TestLazyEventArgs(TestCase):
+    """Events decoded with lazy_args only parse their args when called"""
+
+    def setUp(self):
+        server = MockSocketIOServer()
+        self.environ = {}
+        socket = MockSocket(server, {})
+        socket.error = MagicMock()
+        self.environ['socketio'] = socket
+        self.ns = ChatNamespace(False, self.environ, '/chat')
+        self.loads = MagicMock(side_effect=lambda data: [])
+
+    def decode(self, name):
+        return decode('5::/chat:{"name":"%s","args":[]}' % name,
+                      self.loads, lazy_args=True)
+
+    def test_allowed_event(self):
+        pkt = self.decode('foo')
+        self.assertEqual(self.ns.process_packet(pkt), 'a')
+        self.loads.assert_called_once_with('[]')
+
+    def test_blocked_event(self):
+        self.ns.process_packet(self.decode('bar'))
+        self.environ['socketio'].error.assert_called_with(
+            'method_access_denied',
+            'You do not have access to method "on_bar"',
+            msg_id=None, endpoint='/chat', quiet=False)
+        self.assertFalse(self.loads.called)
+
+    def test_method_not_found(self):
+        self.ns.lift_acl_restrictions()
+        self.ns.process_packet(self.decode('nope'))
+        self.environ['socketio'].error.assert_called_with(
+            'no_such_method', 'The method "on_nope" was not found',
+            msg_id=None, endpoint='/chat', quiet=False)
+        self.assertFalse(self.loads.called)
+
+
 if __name__ == '__main__':
     main()
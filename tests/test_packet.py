@@ -4,8 +4,10 @@ Tests based on the Socket.IO spec: https://github.com/LearnBoost/socket.io-spec
 
 from unittest import TestCase, main
 
+from socketio import packet
 from socketio.packet import encode, decode
 import decimal
+import json
 
 class TestEncodeMessage(TestCase):
 
@@ -353,5 +355,113 @@ class TestDecodeMessage(TestCase):
         else:
             self.assertEqual(decoded_message, None,
                     "We should not get a valid message")
+
+    def test_decode_control_frames_are_fresh(self):
+        """control frames decode to a new dict every time """
+        first = decode('2::')
+        first['id'] = 1
+        self.assertEqual(decode('2::'), {'type': 'heartbeat',
+                                         'endpoint': ''})
+        self.assertEqual(decode(b'2::'), {'type': 'heartbeat',
+                                          'endpoint': ''})
+
+    def test_decode_ack_with_plus_in_args(self):
+        """decoding an ack packet whose data contains a + """
+        decoded_message = decode('6:::12+["a+b"]')
+        self.assertEqual(decoded_message, {'type': 'ack',
+                                           'ackId': 12,
+                                           'args': ['a+b'],
+                                           'endpoint': ''})
+
+
+class TestPrefixCache(TestCase):
+
+    def test_prefix_cache_is_bounded(self):
+        """the encoded prefixes are cached, up to a limit """
+        packet._prefixes.clear()
+        for i in range(packet._MAX_PREFIXES + 10):
+            encode({'type': 'message', 'data': 'x',
+                    'endpoint': '/ns%d' % i})
+        self.assertTrue(len(packet._prefixes) <= packet._MAX_PREFIXES)
+        self.assertEqual(encode({'type': 'message', 'data': 'x',
+                                 'endpoint': '/ns1'}), '3::/ns1:x')
+
+
+class TestLazyEventArgs(TestCase):
+
+    def test_args_parsed_on_access(self):
+        """decoding an event lazily """
+        decoded_message = decode('5:1+:/tobi:{"name":"edwald",'
+                                 '"args":[{"a":"b"},2,"3"]}', lazy_args=True)
+        self.assertEqual(decoded_message['name'], 'edwald')
+        self.assertTrue(decoded_message.args_pending)
+        self.assertEqual(decoded_message['args'], [{'a': 'b'}, 2, '3'])
+        self.assertFalse(decoded_message.args_pending)
+        self.assertEqual(decoded_message, {'type': 'event',
+                                           'name': 'edwald',
+                                           'id': 1,
+                                           'ack': 'data',
+                                           'endpoint': '/tobi',
+                                           'args': [{'a': 'b'}, 2, '3']})
+
+    def test_same_result_as_eager(self):
+        """lazy decoding falls back on the whole event when needed """
+        for rawstr in ('5:::{"name":"woot"}',
+                       '5:::{"args":[1],"name":"woot"}',
+                       '5:::{"name":"woot","args":[1],"other":2}',
+                       '5:::{"name":"w\\"oot","args":["}"]}'):
+            self.assertEqual(decode(rawstr, lazy_args=True), decode(rawstr))
+
+
+class TestPacket(TestCase):
+
+    def test_dict_access(self):
+        """a Packet behaves like the dicts used before """
+        pkt = packet.Packet(type='event', name='woot', endpoint='')
+        self.assertEqual(pkt['name'], 'woot')
+        self.assertEqual(pkt.name, 'woot')
+        self.assertFalse('id' in pkt)
+        self.assertEqual(pkt.get('id'), None)
+        self.assertRaises(KeyError, lambda: pkt['id'])
+        pkt['id'] = 3
+        self.assertEqual(pkt.pop('id'), 3)
+        self.assertEqual(pkt.setdefault('args', []), [])
+        self.assertEqual(sorted(pkt), ['args', 'endpoint', 'name', 'type'])
+        self.assertEqual(pkt, {'type': 'event', 'name': 'woot',
+                               'endpoint': '', 'args': []})
+        self.assertEqual({'type': 'event', 'name': 'woot',
+                          'endpoint': '', 'args': []}, pkt)
+        self.assertNotEqual(pkt, {'type': 'event'})
+
+    def test_extra_keys(self):
+        """keys that are not packet attributes are kept too """
+        pkt = packet.Packet({'type': 'message', 'data': 'hi'}, custom=1)
+        self.assertEqual(pkt['custom'], 1)
+        self.assertTrue('custom' in pkt)
+        self.assertEqual(pkt.to_dict(), {'type': 'message', 'data': 'hi',
+                                         'custom': 1})
+        del pkt['custom']
+        self.assertEqual(len(pkt), 2)
+
+    def test_encode_packet(self):
+        """a Packet encodes like the equivalent dict """
+        pkt = packet.Packet(type='event', name='woot', args=[1],
+                            endpoint='/tobi', id=1, ack='data')
+        self.assertEqual(encode(pkt), encode(pkt.to_dict()))
+        self.assertEqual(decode(encode(pkt)), pkt)
+
+    def test_is_a_dict(self):
+        """a Packet is still a dict, for the code that handles them """
+        pkt = packet.Packet(type='event', name='woot', args=[1],
+                            endpoint='')
+        self.assertTrue(isinstance(pkt, dict))
+        self.assertEqual(json.loads(json.dumps(pkt)), pkt)
+        self.assertRaises(AttributeError, lambda: pkt.id)
+
+        lazy = decode('5:::{"name":"woot","args":[1]}', lazy_args=True)
+        self.assertTrue(isinstance(lazy, dict))
+        self.assertEqual(json.loads(json.dumps(lazy)), pkt)
+
+
 if __name__ == '__main__':
     main()
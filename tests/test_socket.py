@@ -1,13 +1,22 @@
+import time
 from unittest import TestCase, main
 
+import gevent
+from gevent.event import AsyncResult, Event
+
 from socketio.namespace import BaseNamespace
-from socketio.virtsocket import Socket
+from socketio.packet import PingFrame
+from socketio.timerwheel import TimerWheel
+from socketio.virtsocket import AckExpired, Socket, broadcast_packet
 
 
 class MockSocketIOServer(object):
     """Mock a SocketIO server"""
     def __init__(self, *args, **kwargs):
         self.sockets = {}
+        self.rooms = {}
+        self.endpoints = {}
+        self.metrics = {}
 
     def get_socket(self, socket_id=''):
         return self.sockets.get(socket_id)
@@ -77,6 +86,36 @@ class TestSocketAPI(TestCase):
         self.virtsocket.kill()
         self.assertEqual(self.virtsocket.state, "DISCONNECTING")
 
+    def test_join_leave_room(self):
+        self.virtsocket.join_room('/chat_lobby')
+        self.assertEqual(self.server.rooms,
+                         {'/chat_lobby': set([self.virtsocket])})
+        self.virtsocket.leave_room('/chat_lobby')
+        self.assertEqual(self.server.rooms, {})
+        self.assertEqual(self.virtsocket.rooms, set())
+
+    def test_kill_leaves_rooms(self):
+        other = Socket(self.server, {})
+        other.join_room('/chat_lobby')
+        self.virtsocket.join_room('/chat_lobby')
+        self.virtsocket.join_room('/chat_other')
+        self.virtsocket.kill()
+        self.assertEqual(self.server.rooms, {'/chat_lobby': set([other])})
+
+    def test_endpoint_index(self):
+        self.virtsocket._set_environ({'socketio': self.virtsocket})
+        self.virtsocket._set_namespaces({'/chat': MockNamespace})
+        self.virtsocket.state = "CONNECTED"
+        self.virtsocket.put_server_msg('1::/chat')
+        loop = gevent.spawn(self.virtsocket._receiver_loop)
+        gevent.sleep(0)
+        loop.kill()
+        self.assertEqual(self.server.endpoints,
+                         {'/chat': set([self.virtsocket])})
+
+        self.virtsocket.remove_namespace('/chat')
+        self.assertEqual(self.server.endpoints, {})
+
     def test__receiver_loop(self):
         """Test the loop  """
         # most of the method is tested by test_packet.TestDecode and
@@ -86,5 +125,407 @@ class TestSocketAPI(TestCase):
         # self.virtsocket.server_queue.put_nowait_msg('2::')
 
 
+class TestHeartbeat(TestCase):
+    """Test the heartbeats scheduled on the timer wheel"""
+
+    def setUp(self):
+        self.server = MockSocketIOServer()
+        self.server.timer_wheel = TimerWheel()
+        self.virtsocket = Socket(self.server, {'heartbeat_interval': 25,
+                                               'heartbeat_timeout': 60,
+                                               'heartbeat_jitter': 0.1})
+        self.virtsocket.state = "CONNECTED"
+
+    def tearDown(self):
+        self.server.timer_wheel.stop()
+
+    def test_jitter(self):
+        for i in range(20):
+            delay = self.virtsocket._get_heartbeat_delay()
+            self.assertTrue(22.5 <= delay <= 25)
+
+    def test_heartbeat_when_idle(self):
+        self.virtsocket.last_heartbeat -= 30
+        self.virtsocket._heartbeat()
+        self.assertEqual(self.virtsocket.client_queue.get_nowait(), b'2::')
+        self.assertEqual(self.virtsocket.heartbeats, 1)
+
+    def test_no_heartbeat_when_busy(self):
+        self.virtsocket.put_client_msg('3:::busy')
+        self.virtsocket.heartbeat()
+        self.virtsocket._heartbeat()
+        self.assertEqual(self.virtsocket.client_queue.qsize(), 1)
+        self.assertEqual(self.virtsocket.heartbeats, 0)
+        self.assertTrue(self.virtsocket._heartbeat_timer.active)
+
+    def test_heartbeat_when_client_is_silent(self):
+        self.virtsocket.put_client_msg('3:::busy')
+        self.virtsocket.last_heartbeat -= 30
+        self.virtsocket._heartbeat()
+        self.assertEqual(self.virtsocket.client_queue.qsize(), 2)
+
+    def test_ping_frames(self):
+        self.virtsocket.ping_frames = True
+        self.virtsocket.last_heartbeat -= 30
+        self.virtsocket._heartbeat()
+        ping = self.virtsocket.client_queue.get_nowait()
+        self.assertTrue(isinstance(ping, PingFrame))
+
+        self.virtsocket._handle_pong(bytearray(ping))
+        self.assertTrue(0 <= self.virtsocket.rtt < 1)
+        self.assertTrue(time.time() - self.virtsocket.last_heartbeat < 1)
+
+        # Pongs that don't answer our pings still count as heartbeats
+        self.virtsocket.last_heartbeat -= 30
+        self.virtsocket._handle_pong(b'\xff')
+        self.assertTrue(time.time() - self.virtsocket.last_heartbeat < 1)
+
+    def test_ping_frames_keep_client_alive(self):
+        # The client doesn't see the pings, it still needs a heartbeat
+        # packet before its own timeout
+        queue = self.virtsocket.client_queue
+        self.virtsocket.ping_frames = True
+        self.virtsocket.put_client_msg('3:::busy')
+        queue.get_nowait()
+        self.virtsocket.last_heartbeat -= 30
+        self.virtsocket._heartbeat()
+        self.assertTrue(isinstance(queue.get_nowait(), PingFrame))
+        self.assertEqual(queue.qsize(), 0)
+
+        self.virtsocket.last_sent -= 40
+        self.virtsocket._heartbeat()
+        self.assertTrue(isinstance(queue.get_nowait(), PingFrame))
+        self.assertEqual(queue.get_nowait(), b'2::')
+
+    def test_kill_cancels_timers(self):
+        self.virtsocket._schedule_heartbeat()
+        self.assertEqual(len(self.server.timer_wheel), 2)
+        self.virtsocket.kill()
+        self.assertEqual(len(self.server.timer_wheel), 0)
+
+
+class TestAcks(TestCase):
+    """Test the expiry of the pending ack callbacks"""
+
+    def setUp(self):
+        self.server = MockSocketIOServer()
+        self.server.timer_wheel = TimerWheel()
+        self.virtsocket = Socket(self.server, {'max_pending_acks': 2})
+        self.virtsocket._set_environ({'socketio': self.virtsocket})
+        self.virtsocket.state = "CONNECTED"
+        self.ns = MockNamespace(self.virtsocket.environ, '/chat')
+        self.acked = []
+
+    def tearDown(self):
+        self.server.timer_wheel.stop()
+
+    def test_duplicate_msgid(self):
+        self.virtsocket._save_ack_callback(1, self.acked.append)
+        self.assertEqual(
+            self.virtsocket._save_ack_callback(1, self.ns.emit), False)
+        self.assertEqual(self.virtsocket.ack_callbacks,
+                         {1: self.acked.append})
+
+    def test_timeout(self):
+        wheel = self.server.timer_wheel
+        self.ns.emit('question', callback=self.acked.append, timeout=2)
+        self.assertEqual(len(self.virtsocket.ack_callbacks), 1)
+        # Plus the part of the current tick that is already gone
+        wheel._advance(wheel.current_tick + 3)
+        self.assertEqual(self.virtsocket.ack_callbacks, {})
+        self.assertEqual(self.server.metrics, {'acks.expired': 1})
+
+    def test_ack_cancels_timeout(self):
+        self.ns.emit('question', callback=self.acked.append, timeout=2)
+        callback = self.virtsocket._pop_ack_callback(1)
+        self.assertEqual(callback, self.acked.append)
+        self.assertEqual(len(self.server.timer_wheel), 0)
+
+    def test_max_pending_acks(self):
+        results = [self.ns.emit_with_ack('question') for i in range(3)]
+        self.assertEqual(list(self.virtsocket.ack_callbacks), [2, 3])
+        self.assertTrue(isinstance(results[0].exception, AckExpired))
+        self.assertFalse(results[1].ready())
+        self.assertEqual(self.server.metrics, {'acks.evicted': 1})
+
+    def test_emit_with_ack(self):
+        result = self.ns.emit_with_ack('question', 'sure?')
+        self.assertEqual(self.virtsocket.client_queue.get_nowait(),
+                         b'5:1+:/chat:{"args":["sure?"],"name":"question"}')
+        self.ns.process_packet(dict(type='ack', ackId=1, args=['yes', 1],
+                                    endpoint='/chat'))
+        self.assertEqual(result.get(block=False), ['yes', 1])
+
+    def test_no_private_kwargs(self):
+        self.assertRaises(ValueError, self.ns.emit, 'question',
+                          _on_expire=self.acked.append)
+        self.assertRaises(ValueError, self.ns.emit_with_ack, 'question',
+                          callback=self.acked.append)
+
+    def test_kill_expires_acks(self):
+        result = self.ns.emit_with_ack('question', timeout=10)
+        self.virtsocket.kill()
+        self.assertTrue(isinstance(result.exception, AckExpired))
+        self.assertEqual(len(self.server.timer_wheel), 0)
+        self.assertEqual(self.server.metrics, {})
+
+
+class TestBoundedClientQueue(TestCase):
+    """Test the slow-consumer policies of the client queue"""
+
+    def setUp(self):
+        self.server = MockSocketIOServer()
+
+    def make_socket(self, **config):
+        socket = Socket(self.server, config)
+        socket.state = "CONNECTED"
+        return socket
+
+    def test_unbounded_by_default(self):
+        socket = self.make_socket()
+        for i in range(100):
+            socket.put_client_msg('3:::%d' % i)
+        self.assertEqual(socket.client_queue.qsize(), 100)
+        self.assertEqual(self.server.metrics, {})
+
+    def test_drop_oldest(self):
+        socket = self.make_socket(client_queue_max_messages=2)
+        for i in range(4):
+            socket.put_client_msg('3:::%d' % i)
+        self.assertEqual(socket.get_multiple_client_msgs(),
+                         [b'3:::2', b'3:::3'])
+        self.assertEqual(self.server.metrics,
+                         {'client_queue.dropped.drop-oldest': 2})
+
+    def test_drop_newest_by_size(self):
+        socket = self.make_socket(client_queue_max_bytes=12,
+                                  client_queue_policy='drop-newest')
+        for i in range(4):
+            socket.put_client_msg('3:::%d' % i)
+        self.assertEqual(socket.client_queue.size_bytes, 10)
+        self.assertEqual(socket.get_multiple_client_msgs(),
+                         [b'3:::0', b'3:::1'])
+        self.assertEqual(socket.client_queue.size_bytes, 0)
+        self.assertEqual(self.server.metrics,
+                         {'client_queue.dropped.drop-newest': 2})
+
+    def test_disconnect(self):
+        socket = self.make_socket(client_queue_max_messages=1,
+                                  client_queue_policy='disconnect')
+        socket.put_client_msg('3:::0')
+        socket.put_client_msg('3:::1')
+        socket.put_client_msg('3:::2')
+        gevent.sleep(0)
+        self.assertFalse(socket.connected)
+        self.assertEqual(self.server.metrics,
+                         {'client_queue.dropped.disconnect': 2})
+
+
+class TestBatches(TestCase):
+    """Test the budgets of get_multiple_client_msgs"""
+
+    def setUp(self):
+        self.virtsocket = Socket(MockSocketIOServer(), {})
+        for i in range(5):
+            self.virtsocket.put_client_msg('3:::%d' % i)
+
+    def test_max_messages(self):
+        self.assertEqual(
+            self.virtsocket.get_multiple_client_msgs(max_messages=2),
+            [b'3:::0', b'3:::1'])
+        self.assertEqual(self.virtsocket.client_queue.qsize(), 3)
+
+    def test_max_bytes(self):
+        self.assertEqual(
+            self.virtsocket.get_multiple_client_msgs(max_bytes=11),
+            [b'3:::0', b'3:::1'])
+        # The first message is always taken
+        self.assertEqual(
+            self.virtsocket.get_multiple_client_msgs(max_bytes=1),
+            [b'3:::2'])
+
+    def test_stops_at_kill(self):
+        self.virtsocket.client_queue.put_nowait(None)
+        self.virtsocket.put_client_msg('3:::late')
+        # No bytes.__mod__ before Python 3.5
+        self.assertEqual(self.virtsocket.get_multiple_client_msgs(),
+                         [('3:::%d' % i).encode('ascii') for i in range(5)] +
+                         [None])
+
+    def test_linger(self):
+        self.virtsocket.get_multiple_client_msgs()
+        self.virtsocket.put_client_msg('3:::a')
+        gevent.spawn_later(0.001, self.virtsocket.put_client_msg, '3:::b')
+        self.assertEqual(
+            self.virtsocket.get_multiple_client_msgs(linger=0.05),
+            [b'3:::a', b'3:::b'])
+
+
+class TestConflation(TestCase):
+    """Test the keyed message conflation in the client queue"""
+
+    def setUp(self):
+        self.server = MockSocketIOServer()
+        self.virtsocket = Socket(self.server, {})
+
+    def test_replace_in_place(self):
+        self.virtsocket.put_client_msg('3:::a', conflate_key='cpu')
+        self.virtsocket.put_client_msg('3:::other')
+        self.virtsocket.put_client_msg('3:::b', conflate_key='cpu')
+        self.virtsocket.put_client_msg('3:::c', conflate_key='cpu')
+        self.assertEqual(self.virtsocket.client_queue.size_bytes, 14)
+        self.assertEqual(self.virtsocket.get_multiple_client_msgs(),
+                         [b'3:::c', b'3:::other'])
+
+        # Once sent, the key starts over
+        self.virtsocket.put_client_msg('3:::d', conflate_key='cpu')
+        self.assertEqual(self.virtsocket.get_client_msg(), b'3:::d')
+
+    def test_emit_conflate_key(self):
+        ns = MockNamespace({'socketio': self.virtsocket}, '/cpu')
+        for point in range(10):
+            ns.emit('cpu_data', point, conflate_key='cpu_data')
+        other = MockNamespace({'socketio': self.virtsocket}, '/other')
+        other.emit('cpu_data', 0, conflate_key='cpu_data')
+        self.assertEqual(self.virtsocket.get_multiple_client_msgs(),
+                         [b'5::/cpu:{"args":[9],"name":"cpu_data"}',
+                          b'5::/other:{"args":[0],"name":"cpu_data"}'])
+
+    def test_replaced_ack_callbacks(self):
+        self.virtsocket._set_environ({'socketio': self.virtsocket})
+        ns = MockNamespace(self.virtsocket.environ, '/cpu')
+        acked = []
+        results = [ns.emit_with_ack('cpu_data', 1, conflate_key='cpu'),
+                   ns.emit_with_ack('cpu_data', 2, conflate_key='cpu')]
+        ns.emit('cpu_data', 3, conflate_key='cpu', callback=acked.append)
+        self.assertEqual(list(self.virtsocket.ack_callbacks), [3])
+        self.assertTrue(isinstance(results[0].exception, AckExpired))
+        self.assertTrue(isinstance(results[1].exception, AckExpired))
+        self.assertEqual(self.server.metrics, {'acks.conflated': 2})
+
+
+class TestBroadcastPacket(TestCase):
+    """Test the encode-once broadcast helper"""
+
+    def setUp(self):
+        self.server = MockSocketIOServer()
+        self.sockets = [Socket(self.server, {}) for i in range(3)]
+
+    def test_same_frame_on_every_queue(self):
+        pkt = dict(type='event', name='woot', args=[1], endpoint='/chat')
+        broadcast_packet(self.sockets, pkt)
+        frames = [socket.client_queue.get_nowait()
+                  for socket in self.sockets]
+        self.assertEqual(frames[0], b'5::/chat:{"args":[1],"name":"woot"}')
+        self.assertTrue(all(frame is frames[0] for frame in frames))
+
+    def test_exclude(self):
+        pkt = dict(type='event', name='woot', args=[], endpoint='')
+        broadcast_packet(self.sockets, pkt, exclude=self.sockets[0])
+        self.assertEqual(self.sockets[0].client_queue.qsize(), 0)
+        self.assertEqual(self.sockets[1].client_queue.qsize(), 1)
+
+    def test_one_frame_per_json_codec(self):
+        self.sockets[2]._set_json_dumps(lambda data: '"custom"')
+        pkt = dict(type='json', data={'a': 1}, endpoint='')
+        broadcast_packet(self.sockets, pkt)
+        self.assertEqual(self.sockets[0].client_queue.get_nowait(),
+                         b'4:::{"a":1}')
+        self.assertEqual(self.sockets[2].client_queue.get_nowait(),
+                         b'4:::"custom"')
+
+
+class SlowNamespace(BaseNamespace):
+    """Handlers that block until told otherwise"""
+
+    def initialize(self):
+        self.calls = self.socket.calls
+
+    def on_wait(self, name):
+        self.calls.append(('start', self.ns_name, name))
+        self.socket.release.wait()
+        self.calls.append(('end', self.ns_name, name))
+
+    def on_quick(self, name):
+        self.calls.append(('quick', self.ns_name, name))
+
+    def on_deferred(self):
+        return self.socket.result
+
+
+class TestHandlerPool(TestCase):
+    """Test the concurrent processing of incoming packets"""
+
+    def setUp(self):
+        self.server = MockSocketIOServer()
+
+    def make_socket(self, **config):
+        socket = Socket(self.server, config)
+        socket._set_environ({'socketio': socket})
+        socket._set_namespaces({'/a': SlowNamespace, '/b': SlowNamespace})
+        socket.state = socket.STATE_CONNECTED
+        socket.calls = []
+        socket.release = Event()
+        socket.result = AsyncResult()
+        return socket
+
+    def test_inline_by_default(self):
+        socket = self.make_socket()
+        self.assertTrue(socket.handler_pool is None)
+        socket._handle_server_msg('5::/a:{"name":"quick","args":[1]}')
+        self.assertEqual(socket.calls, [('quick', '/a', 1)])
+
+    def test_namespaces_run_concurrently(self):
+        socket = self.make_socket(handler_pool_size=4)
+        socket._handle_server_msg('5::/a:{"name":"wait","args":[1]}')
+        socket._handle_server_msg('5::/b:{"name":"quick","args":[2]}')
+        gevent.sleep(0)
+        self.assertEqual(socket.calls, [('start', '/a', 1),
+                                        ('quick', '/b', 2)])
+        socket.release.set()
+        socket.handler_pool.join()
+        self.assertEqual(socket.calls[-1], ('end', '/a', 1))
+        self.assertEqual(socket._lanes, {})
+
+    def test_ordered_within_namespace(self):
+        socket = self.make_socket(handler_pool_size=4)
+        socket._handle_server_msg('5::/a:{"name":"wait","args":[1]}')
+        socket._handle_server_msg('5::/a:{"name":"quick","args":[2]}')
+        gevent.sleep(0)
+        self.assertEqual(socket.calls, [('start', '/a', 1)])
+        socket.release.set()
+        socket.handler_pool.join()
+        self.assertEqual(socket.calls, [('start', '/a', 1), ('end', '/a', 1),
+                                        ('quick', '/a', 2)])
+
+    def test_ordered_per_event(self):
+        socket = self.make_socket(handler_pool_size=4,
+                                  handler_ordering='event')
+        socket._handle_server_msg('5::/a:{"name":"wait","args":[1]}')
+        socket._handle_server_msg('5::/a:{"name":"quick","args":[2]}')
+        gevent.sleep(0)
+        self.assertEqual(socket.calls, [('start', '/a', 1),
+                                        ('quick', '/a', 2)])
+        socket.release.set()
+        socket.handler_pool.join()
+
+    def test_deferred_ack(self):
+        socket = self.make_socket(handler_pool_size=4)
+        socket._handle_server_msg('5:7+:/a:{"name":"deferred","args":[]}')
+        socket.handler_pool.join()
+        self.assertEqual(socket.client_queue.qsize(), 0)
+        socket.result.set(('ok', 42))
+        gevent.sleep(0)
+        self.assertEqual(socket.client_queue.get_nowait(),
+                         b'6::/a:7+["ok",42]')
+
+    def test_failed_deferred_ack_is_not_sent(self):
+        socket = self.make_socket()
+        socket._handle_server_msg('5:7+:/a:{"name":"deferred","args":[]}')
+        socket.result.set_exception(ValueError('nope'))
+        gevent.sleep(0)
+        self.assertEqual(socket.client_queue.qsize(), 0)
+
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,108 @@
+import time
+from unittest import TestCase, main
+
+import gevent
+
+from socketio.timerwheel import TimerWheel
+
+
+class TestTimerWheel(TestCase):
+    """Drive the wheel by hand, tick by tick"""
+
+    def setUp(self):
+        self.wheel = TimerWheel(resolution=1.0, slots=4, levels=3)
+        self.fired = []
+        # The clock follows the ticks we drive, plus ``into_tick`` seconds
+        self.into_tick = 0
+        self.wheel._now = lambda: self.wheel.current_tick + self.into_tick
+
+    def tearDown(self):
+        self.wheel.stop()
+
+    def schedule(self, delay):
+        return self.wheel.schedule(delay, self.fired.append, delay)
+
+    def test_fires_on_time(self):
+        self.schedule(1)
+        self.schedule(3)
+        self.wheel._advance(2)
+        self.assertEqual(self.fired, [1])
+        self.wheel._advance(3)
+        self.assertEqual(self.fired, [1, 3])
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_cascades_through_levels(self):
+        for delay in (5, 17, 40, 63):
+            self.schedule(delay)
+        fired_at = {}
+        for tick in range(1, 70):
+            self.wheel._advance(tick)
+            for delay in self.fired:
+                fired_at.setdefault(delay, tick)
+        self.assertEqual(fired_at, {5: 5, 17: 17, 40: 40, 63: 63})
+
+    def test_beyond_wheel_span(self):
+        # 4 slots * 3 levels only span 64 ticks
+        self.schedule(100)
+        self.wheel._advance(99)
+        self.assertEqual(self.fired, [])
+        self.wheel._advance(100)
+        self.assertEqual(self.fired, [100])
+
+    def test_rounds_up_to_next_tick(self):
+        self.schedule(0.2)
+        self.schedule(1.5)
+        self.wheel._advance(1)
+        self.assertEqual(self.fired, [0.2])
+        self.wheel._advance(2)
+        self.assertEqual(self.fired, [0.2, 1.5])
+
+    def test_never_early_within_a_tick(self):
+        # Half of the current tick is gone already
+        self.into_tick = 0.5
+        self.schedule(1)
+        self.wheel._advance(1)
+        self.assertEqual(self.fired, [])
+        self.wheel._advance(2)
+        self.assertEqual(self.fired, [1])
+
+    def test_cancel(self):
+        timer = self.schedule(2)
+        timer.cancel()
+        timer.cancel()
+        self.assertFalse(timer.active)
+        self.assertEqual(len(self.wheel), 0)
+        self.wheel._advance(5)
+        self.assertEqual(self.fired, [])
+
+    def test_reschedule_from_callback(self):
+        def callback():
+            self.fired.append(self.wheel.current_tick)
+            if len(self.fired) < 3:
+                self.wheel.schedule(2, callback)
+        self.wheel.schedule(2, callback)
+        self.wheel._advance(10)
+        self.assertEqual(self.fired, [2, 4, 6])
+
+
+class TestTimerWheelClock(TestCase):
+    """Let the wheel turn on its own"""
+
+    def test_never_early(self):
+        wheel = TimerWheel(resolution=0.05)
+        fired = []
+        try:
+            # Schedule in the middle of a tick
+            wheel.schedule(0.01, lambda: None)
+            gevent.sleep(0.03)
+            start = time.time()
+            wheel.schedule(0.1, lambda: fired.append(time.time() - start))
+            gevent.sleep(0.3)
+        finally:
+            wheel.stop()
+        self.assertEqual(len(fired), 1)
+        self.assertTrue(fired[0] >= 0.1, fired)
+
+
+if __name__ == '__main__':
+    main()
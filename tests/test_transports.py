@@ -0,0 +1,241 @@
+import io
+from unittest import TestCase, main
+
+import gevent
+from gevent import socket
+
+from socketio.binary import BinaryFrame
+from socketio.handler import Router, SocketIORequest
+from socketio.packet import Frame, PingFrame
+from socketio.transports import SocketStream, WebsocketTransport, \
+    XHRPollingTransport, send_frames, send_text_frame
+from socketio.virtsocket import Socket
+
+
+class MockSocketIOServer(object):
+    """Mock a SocketIO server"""
+    def __init__(self, *args, **kwargs):
+        self.sockets = {}
+        self.rooms = {}
+        self.endpoints = {}
+        self.metrics = {}
+
+
+class TestDecodePayload(TestCase):
+
+    def setUp(self):
+        self.transport = XHRPollingTransport(None, {})
+
+    def decode(self, payload):
+        return self.transport.decode_payload(payload.encode('utf-8'))
+
+    def test_single_message(self):
+        self.assertEqual(self.decode(u'5:::{"name":"a"}'),
+                         [u'5:::{"name":"a"}'])
+        self.assertEqual(self.decode(u''), [])
+
+    def test_multiple_messages(self):
+        messages = [u'3:::h\ufffdllo', u'2::', u'3:::\xe9t\xe9', u'']
+        payload = u''.join(u'\ufffd%d\ufffd%s' % (len(m), m)
+                           for m in messages)
+        self.assertEqual(self.decode(payload), messages)
+        # Without separators in the messages, and with padded lengths
+        self.assertEqual(self.decode(payload.replace(u'h\ufffdllo', u'hello')),
+                         [u'3:::hello', u'2::', u'3:::\xe9t\xe9', u''])
+        self.assertEqual(self.decode(u'\ufffd03\ufffd2::'), [u'2::'])
+
+    def test_malformed_lengths(self):
+        for payload in (u'\ufffd3x\ufffd2::',
+                        u'\ufffd\ufffd2::',
+                        u'\ufffd3',
+                        u'\ufffd' + u'1' * 20 + u'\ufffd2::',
+                        u'\ufffd5\ufffd2::',
+                        u'\ufffd3\ufffd2::junk'):
+            self.assertRaises(ValueError, self.decode, payload)
+
+
+class TestEncodePayload(TestCase):
+
+    def setUp(self):
+        self.transport = XHRPollingTransport(None, {})
+
+    def test_single_frame_is_not_copied(self):
+        frame = Frame(u'3:::\xe9t\xe9')
+        self.assertTrue(self.transport.encode_payload([frame]) is frame)
+        self.assertEqual(self.transport.encode_payload([]), b'')
+        self.assertEqual(self.transport.encode_payload([None]), b'')
+
+    def test_lengths_in_characters(self):
+        messages = [u'3:::\xe9t\xe9', u'2::']
+        payload = self.transport.encode_payload(
+            [Frame(m) for m in messages] + [None])
+        self.assertEqual(payload.decode('utf-8'),
+                         u'\ufffd7\ufffd3:::\xe9t\xe9\ufffd3\ufffd2::')
+        self.assertEqual(self.transport.decode_payload(payload), messages)
+
+    def test_lengths_in_utf16_units(self):
+        # The client counts astral characters twice, like String.length
+        message = u'3:::\U0001f600'
+        self.assertEqual(Frame(message).length, 6)
+        payload = self.transport.encode_payload(
+            [message.encode('utf-8'), Frame(u'2::')])
+        self.assertEqual(payload.decode('utf-8'),
+                         u'\ufffd6\ufffd3:::\U0001f600\ufffd3\ufffd2::')
+
+
+class TestPollingBatches(TestCase):
+
+    def setUp(self):
+        self.socket = Socket(MockSocketIOServer(), {})
+
+    def test_unlimited_by_default(self):
+        transport = XHRPollingTransport(None, {})
+        for i in range(3):
+            self.socket.put_client_msg('3:::%d' % i)
+        self.assertEqual(transport.get_messages_payload(self.socket),
+                         b'\xef\xbf\xbd5\xef\xbf\xbd3:::0'
+                         b'\xef\xbf\xbd5\xef\xbf\xbd3:::1'
+                         b'\xef\xbf\xbd5\xef\xbf\xbd3:::2')
+
+    def test_size_cap(self):
+        transport = XHRPollingTransport(None, {
+            'polling_batch_max_bytes': 10,
+            'polling_batch_max_messages': 3})
+        for i in range(5):
+            self.socket.put_client_msg('3:::%d' % i)
+        payload = transport.get_messages_payload(self.socket)
+        self.assertEqual(transport.decode_payload(payload),
+                         ['3:::0', '3:::1'])
+        self.assertEqual(self.socket.client_queue.qsize(), 3)
+
+    def test_linger(self):
+        transport = XHRPollingTransport(None, {'polling_linger': 0.05})
+        self.socket.put_client_msg('3:::0')
+        gevent.spawn_later(0.001, self.socket.put_client_msg, '3:::1')
+        payload = transport.get_messages_payload(self.socket, timeout=1)
+        self.assertEqual(transport.decode_payload(payload),
+                         ['3:::0', '3:::1'])
+
+
+class MockWebSocket(object):
+    """Mock a geventwebsocket WebSocket"""
+    OPCODE_TEXT = 0x1
+    OPCODE_BINARY = 0x2
+    OPCODE_PING = 0x9
+    closed = False
+
+    def __init__(self):
+        self.written = []
+        self.sent = []
+
+    def raw_write(self, data):
+        self.written.append(data)
+
+    def send(self, message):
+        self.sent.append(message)
+
+    def receive(self):
+        return None
+
+
+class MockHandler(object):
+    """Mock a SocketIO handler"""
+    def __init__(self, websocket):
+        self.environ = {'wsgi.websocket': websocket}
+        self.socketio_request = SocketIORequest()
+
+
+class TestSendTextFrame(TestCase):
+
+    def test_frame_is_not_encoded_again(self):
+        websocket = MockWebSocket()
+        send_text_frame(websocket, Frame(u'3:::\xe9t\xe9'))
+        self.assertEqual(websocket.written,
+                         [b'\x81\x09' + u'3:::\xe9t\xe9'.encode('utf-8')])
+
+
+class TestSendFrames(TestCase):
+
+    def test_single_write(self):
+        websocket = MockWebSocket()
+        send_frames(websocket, [Frame(u'2::'), BinaryFrame(b'5:::\x81'),
+                                Frame(u'8::'), PingFrame(b'1.5')])
+        self.assertEqual(websocket.written,
+                         [b'\x81\x032::\x82\x055:::\x81\x81\x038::'
+                          b'\x89\x031.5'])
+
+    def test_burst_is_coalesced(self):
+        websocket = MockWebSocket()
+        socket = Socket(MockSocketIOServer(), {})
+        for i in range(10):
+            socket.put_client_msg('3:::%d' % i)
+        transport = WebsocketTransport(MockHandler(websocket),
+                                       {'websocket_batch_max_messages': 4})
+        transport.do_exchange(socket, 'GET')
+        gevent.sleep(0)
+        self.assertEqual(websocket.sent, ['1::'])
+        self.assertEqual(len(websocket.written), 3)
+        self.assertEqual(websocket.written[2], b'\x81\x053:::8\x81\x053:::9')
+
+        socket.put_client_msg('3:::a')
+        socket.kill()
+        gevent.sleep(0)
+        self.assertEqual(websocket.written[3], b'\x81\x053:::a')
+        self.assertTrue(all(job.dead for job in socket.jobs))
+
+
+class TestSocketStream(TestCase):
+
+    def setUp(self):
+        self.sock, self.peer = socket.socketpair()
+
+    def tearDown(self):
+        self.sock.close()
+        self.peer.close()
+
+    def test_takes_buffered_frames(self):
+        self.peer.sendall(b'\x81\x00\x81\x00')
+        rfile = self.sock.makefile('rb')
+        self.assertEqual(rfile.read(2), b'\x81\x00')
+        stream = SocketStream(self.sock, rfile)
+        self.assertEqual(bytes(stream.buffer), b'\x81\x00')
+
+    def test_rfile_without_peek(self):
+        # Like the socket._fileobject of Python 2
+        stream = SocketStream(self.sock, io.BytesIO(b'\x81\x00'))
+        self.assertEqual(bytes(stream.buffer), b'')
+
+
+class TestRouter(TestCase):
+
+    def setUp(self):
+        self.router = Router('socket.io')
+
+    def test_handshake(self):
+        request = self.router.match('/socket.io/1/', 'jsonp=3')
+        self.assertEqual(request.kind, SocketIORequest.HANDSHAKE)
+        self.assertEqual(request.query, {'jsonp': ['3']})
+
+    def test_request(self):
+        for path in ('/socket.io/1/xhr-polling/123',
+                     '/socket.io/1/xhr-polling/123/'):
+            request = self.router.match(path)
+            self.assertEqual(request.kind, SocketIORequest.REQUEST)
+            self.assertEqual(request.transport_id, 'xhr-polling')
+            self.assertEqual(request.sessid, '123')
+
+    def test_disconnect(self):
+        request = self.router.match('/socket.io/1//123', 'disconnect')
+        self.assertEqual(request.kind, SocketIORequest.DISCONNECT)
+        self.assertEqual(request.sessid, '123')
+        self.assertEqual(request.query_string, 'disconnect')
+
+    def test_no_match(self):
+        for path in ('/', '/socket.io', '/socket.io/', '/socket.io/2/',
+                     '/other/1/', '/socket.io/1/xhr-polling',
+                     '/socket.io/1/xhr-polling/123/extra'):
+            self.assertTrue(self.router.match(path) is None, path)
+
+
+if __name__ == '__main__':
+    main()